@@ -0,0 +1,218 @@
+"""
+Benchmark of the PII analyzer profiles of the OCR (see `lethe.pii_analyzer`): analyzes the
+text of synthetic burned-in annotations, as the redactor engine does with the text found by
+the OCR (with the deny lists of the DICOM metadata of each image), and reports for each
+profile its recall (of the PII words), the number of false positives (of the other words),
+its throughput, its load time and memory, and the private memory of a worker process forked
+after loading it (i.e. the memory that each additional OCR worker costs).
+
+    python scripts/analyzer_benchmark.py [--profiles full small blank] [--images N] [--json]
+
+Each profile is measured in its own process. Requires the OCR dependencies of lethe (and
+en_core_web_sm for the "small" profile).
+"""
+
+import argparse
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+
+FIRST_NAMES = ["John", "Maria", "Georgios", "Anna", "Pierre", "Elena", "Nikos", "Sofia"]
+LAST_NAMES = ["Smith", "Papadopoulos", "Dubois", "Rossi", "Muller", "Garcia", "Ivanova"]
+INSTITUTIONS = ["General Hospital", "St Mary Clinic", "University Medical Center"]
+# Burned-in text that is not PII
+OTHER_WORDS = [
+    "L", "R", "AX", "COR", "SAG", "T2", "FLAIR", "HFS", "kVp:120", "mA:250",
+    "W:400", "L:40", "SE:3", "IM:45", "5.0mm", "FOV", "350", "TR", "4000",
+    "TE", "90", "Slice", "12", "DFOV", "C+", "ANT", "POST", "Zoom", "1.2",
+]  # fmt: skip
+
+
+def _date(rng: random.Random) -> str:
+    return f"{rng.randint(1940, 2024)}{rng.randint(1, 12):02d}{rng.randint(1, 28):02d}"
+
+
+def synthetic_images(count: int, seed: int = 0) -> list[tuple[dict, list[tuple]]]:
+    """
+    The metadata and the burned-in words of synthetic images: each word is labeled as
+    PII or not. Some of the PII (e.g. the name of a referring physician that is not in
+    the metadata, or a phone number) can only be found by the NER or the regexes.
+    """
+    rng = random.Random(seed)
+    images = []
+    for _ in range(count):
+        first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+        study_date = _date(rng)
+        metadata = {
+            "PatientName": f"{last}^{first}",
+            "PatientID": f"{rng.randint(10**6, 10**9)}",
+            "PatientBirthDate": _date(rng),
+            "AccessionNumber": f"ACC{rng.randint(10**5, 10**7)}",
+            "StudyDate": study_date,
+            "InstitutionName": rng.choice(INSTITUTIONS),
+        }
+        day, month, year = study_date[6:], study_date[4:6], study_date[:4]
+        pii = [
+            f"{last.upper()}^{first.upper()}",
+            metadata["PatientID"],
+            metadata["AccessionNumber"],
+            rng.choice([f"{day}/{month}/{year}", f"{year}-{month}-{day}", study_date]),
+            f"Dr {rng.choice(LAST_NAMES)}",
+            f"+30-210-{rng.randint(1000000, 9999999)}",
+        ]
+        words = [(w, False) for w in rng.sample(OTHER_WORDS, 8)]
+        for text in rng.sample(pii, rng.randint(2, len(pii))):
+            words.insert(rng.randint(0, len(words)), (text, True))
+        images.append((metadata, words))
+    return images
+
+
+def _private_memory_mb() -> float:
+    """The private (not shared) memory of the current process, in MB"""
+    private = 0
+    with open("/proc/self/smaps_rollup") as f:
+        for line in f:
+            if line.startswith(("Private_Clean:", "Private_Dirty:")):
+                private += int(line.split()[1])
+    return private / 1024
+
+
+def _analyze(analyzer, profile, images) -> tuple[int, int, int, float]:
+    """
+    Analyzes the text of the images, returns the number of the PII words found and
+    missed, the number of the false positives and the time taken
+    """
+    from presidio_analyzer import PatternRecognizer
+    from presidio_image_redactor import DicomImageRedactorEngine
+    from pydicom import Dataset
+
+    from lethe.pii_analyzer import metadata_recognizers
+
+    found = missed = false_positives = 0
+    start = time.perf_counter()
+    for metadata, words in images:
+        ds = Dataset()
+        for keyword, value in metadata.items():
+            setattr(ds, keyword, value)
+        # The deny list of the redactor engine (`use_metadata=True`)
+        text_metadata, is_name, is_patient = (
+            DicomImageRedactorEngine._get_text_metadata(ds)
+        )
+        phi = DicomImageRedactorEngine._make_phi_list(
+            text_metadata, is_name, is_patient
+        )
+        recognizers = [PatternRecognizer(supported_entity="PERSON", deny_list=phi)]
+        recognizers += metadata_recognizers(profile, ds) or []
+        text = " ".join(w for w, _ in words)
+        results = analyzer.analyze(
+            text=text, language="en", ad_hoc_recognizers=recognizers
+        )
+        offset = 0
+        for word, is_pii in words:
+            end = offset + len(word)
+            hit = any(r.start < end and r.end > offset for r in results)
+            if is_pii:
+                found += hit
+                missed += not hit
+            else:
+                false_positives += hit
+            offset = end + 1
+    return found, missed, false_positives, time.perf_counter() - start
+
+
+def measure(profile_name: str, count: int) -> dict:
+    """Measures a profile in the current process"""
+    from lethe.pii_analyzer import AnalyzerProfile, load_analyzer, preload_analyzer
+
+    profile = AnalyzerProfile(profile_name)
+    images = synthetic_images(count)
+    start = time.perf_counter()
+    preload_analyzer(profile)
+    load_time = time.perf_counter() - start
+    analyzer = load_analyzer(profile)
+    found, missed, false_positives, elapsed = _analyze(analyzer, profile, images)
+
+    # The memory that a forked worker does not share with this process after it
+    # has analyzed the same text
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        _analyze(analyzer, profile, images)
+        os.write(write_fd, f"{_private_memory_mb():.1f}".encode())
+        os._exit(0)
+    os.close(write_fd)
+    worker_private = float(os.read(read_fd, 64) or 0)
+    os.waitpid(pid, 0)
+    return {
+        "profile": profile_name,
+        "images": count,
+        "recall": round(found / max(1, found + missed), 4),
+        "pii_missed": missed,
+        "false_positives": false_positives,
+        "images_per_s": round(count / elapsed, 1),
+        "load_s": round(load_time, 2),
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024),
+        "worker_private_mb": worker_private,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--profiles", nargs="+", default=["full", "small", "blank"], metavar="PROFILE"
+    )
+    parser.add_argument("--images", type=int, default=500)
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    parser.add_argument("--measure", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        print(json.dumps(measure(args.measure, args.images)))
+        return
+    results = []
+    for profile in args.profiles:
+        proc = subprocess.run(
+            [
+                sys.executable,
+                __file__,
+                "--measure",
+                profile,
+                "--images",
+                str(args.images),
+            ],
+            capture_output=True,
+            text=True,
+        )
+        if proc.returncode != 0:
+            error = proc.stderr.strip().splitlines()[-1:] or ["failed"]
+            results.append({"profile": profile, "error": error[0]})
+            continue
+        results.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    columns = [
+        "profile",
+        "recall",
+        "pii_missed",
+        "false_positives",
+        "images_per_s",
+        "load_s",
+        "max_rss_mb",
+        "worker_private_mb",
+    ]
+    print("  ".join(f"{c:>17}" for c in columns))
+    for result in results:
+        if "error" in result:
+            print(f"{result['profile']:>17}  {result['error']}")
+            continue
+        print("  ".join(f"{result[c]!s:>17}" for c in columns))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+Startup benchmark of the lethe CLI: runs a command (by default `lethe utils secret`) with
+`python -X importtime`, prints the slowest imports and fails if the total import time
+exceeds a budget, so that heavy imports do not creep back into the startup of the CLI.
+
+    python scripts/startup_benchmark.py [--budget MS] [--runs N] [-- COMMAND ARGS...]
+"""
+
+import argparse
+import subprocess
+import sys
+import time
+
+DEFAULT_BUDGET_MS = 250
+DEFAULT_COMMAND = ["utils", "secret"]
+
+
+def import_times(args: list[str]) -> tuple[dict[str, int], float]:
+    """
+    Runs `python -X importtime -m lethe *args` and returns the cumulative import time
+    (in microseconds) of each top level import and the wall time (in seconds) of the run
+    """
+    start = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-m", "lethe", *args],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    wall = time.perf_counter() - start
+    if proc.returncode != 0:
+        sys.exit(f"The command failed:\n{proc.stderr}")
+    times = {}
+    for line in proc.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line.split("|")
+        # The nested imports are indented and are included in their parent's time
+        if cumulative.strip().isdigit() and not name.startswith("  "):
+            times[name.strip()] = int(cumulative)
+    return times, wall
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--budget",
+        type=float,
+        default=DEFAULT_BUDGET_MS,
+        help=f"The maximum total import time in ms (default: {DEFAULT_BUDGET_MS})",
+    )
+    parser.add_argument(
+        "--runs",
+        type=int,
+        default=5,
+        help="The number of runs, the fastest one is reported (default: 5)",
+    )
+    parser.add_argument(
+        "--top", type=int, default=10, help="The number of slowest imports to print"
+    )
+    parser.add_argument("command", nargs="*", default=DEFAULT_COMMAND)
+    args = parser.parse_args()
+
+    runs = [import_times(args.command) for _ in range(args.runs)]
+    times, wall = min(runs, key=lambda r: sum(r[0].values()))
+    total_ms = sum(times.values()) / 1000
+    print(f"lethe {' '.join(args.command)}")
+    print(f"  wall time: {wall * 1000:.0f} ms, import time: {total_ms:.0f} ms")
+    for name, us in sorted(times.items(), key=lambda t: t[1], reverse=True)[: args.top]:
+        print(f"  {us / 1000:8.1f} ms  {name}")
+    if total_ms > args.budget:
+        print(f"FAILED: the import time exceeds the budget of {args.budget:.0f} ms")
+        sys.exit(1)
+    print(f"OK: within the budget of {args.budget:.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,38 +1,55 @@
+"""
+The command line interface. The commands are run many times (e.g. `utils secret` and
+`utils series-info` in scripts), so only what is needed to build the CLI is imported
+here: each command imports the (heavy) modules that it uses when it runs.
+"""
+
 import os
 import sys
-import tempfile
-import textwrap
-from itertools import groupby
-from operator import attrgetter
+from enum import Enum
 from pathlib import Path
 
-import rich
 import typer
-import uuid7
 from loguru import logger
-from rich.console import Console
-from rich.table import Table
-from stdnum import luhn
 from typing_extensions import Annotated
 
-from .dcm_deidentify import run_ctp
+from .benchmark import CohortSyntax
 from .defaults import (
+    DEFAULT_BENCH_BURNED_IN_TEXT,
+    DEFAULT_BENCH_CSV_MB,
+    DEFAULT_BENCH_FRAMES,
+    DEFAULT_BENCH_IMAGE_SIZE,
+    DEFAULT_BENCH_IMAGES,
+    DEFAULT_BENCH_MODALITIES,
+    DEFAULT_BENCH_PATIENTS,
+    DEFAULT_BENCH_SERIES,
+    DEFAULT_BENCH_STUDIES,
+    DEFAULT_CACHE_MAX_SIZE,
     DEFAULT_CPU_THREADS,
     DEFAULT_IGNORE_CSV_PREFIX,
+    DEFAULT_INDEX_FILE,
+    DEFAULT_OCR_BATCH_SIZE,
+    DEFAULT_OCR_SERIES_SAMPLES,
+    DEFAULT_OCR_SOCKET,
+    DEFAULT_OCR_WORKERS,
     DEFAULT_PATIENT_ID_PREFIX,
+    DEFAULT_SCAN_THREADS,
     DEFAULT_STUDIES_METADATA_CSV,
     DEFAULT_UIDROOT,
 )
-from .dicom_utils import series_information
-from .hash_clinical import hash_clinical_csvs
-from .ocr_deidentify import perform_ocr
-from .output_dir import copy_and_organize
-from .version import __version__
+from .output_dir import OrganizeMode, OrganizeOrder
+from .paddle_backend import PaddleBackend
+from .pii_analyzer import AnalyzerProfile
 
 INPUT_DIR: Path = Path("/input")
 OUTPUT_DIR: Path = Path("/output")
 
 
+class Engine(str, Enum):
+    ctp = "ctp"
+    native = "native"
+
+
 cli = typer.Typer(add_completion=False)
 utils_cli = typer.Typer()
 cli.add_typer(utils_cli, name="utils", help="Additional utilities")
@@ -50,6 +67,9 @@ logger.add(
 
 
 def _create_secret_key() -> str:
+    import uuid7
+    from stdnum import luhn
+
     u = uuid7.create().hex
     d = luhn.calc_check_digit(u, alphabet="0123456789abcdef")
     return f"{u}{d}"
@@ -58,10 +78,16 @@ def _create_secret_key() -> str:
 def _valid_secret_key(secret_key: str) -> bool:
     if len(secret_key) != 33:
         return False
+    from stdnum import luhn
+
     return luhn.is_valid(secret_key, alphabet="0123456789abcdef")
 
 
 def _header_info() -> str:
+    import textwrap
+
+    from .version import __version__
+
     return textwrap.dedent(
         f"""
     ██╗     ███████╗████████╗██╗  ██╗███████╗
@@ -80,8 +106,10 @@ def _header_info() -> str:
 
 
 def version_callback(value: bool):
-    console = Console()
     if value:
+        from rich.console import Console
+
+        console = Console()
         console.print(_header_info(), justify="left")
         console.print("Default settings", style="bold underline", justify="left")
         console.print(f"UID root: {DEFAULT_UIDROOT}")
@@ -89,14 +117,53 @@ def version_callback(value: bool):
         console.print(f"Studies metadata CSV: {DEFAULT_STUDIES_METADATA_CSV}")
         console.print(f"Ignore CSV prefix: {DEFAULT_IGNORE_CSV_PREFIX}")
         console.print(f"CPU threads: {DEFAULT_CPU_THREADS}")
+        console.print(f"OCR workers: {DEFAULT_OCR_WORKERS}")
         raise typer.Exit()
 
 
 @utils_cli.command(help="Create a new 'secret' key to use for anonymization")
 def secret():
     secret = _create_secret_key()
-    console = Console()
-    console.print(f"[bold][magenta]{secret}[/]")
+    typer.secho(secret, fg=typer.colors.MAGENTA, bold=True)
+
+
+@utils_cli.command(
+    help=(
+        "Create or update an index of the headers of the input DICOM files, "
+        "that the other commands can use instead of reading all the files again"
+    )
+)
+def index(
+    index_file: Annotated[
+        Path,
+        typer.Option(
+            "--index-file",
+            help=(
+                "The index file, in a writable directory (the input directory is "
+                f"usually read-only), e.g. /work/{DEFAULT_INDEX_FILE}"
+            ),
+        ),
+    ],
+    input_dir: Annotated[
+        Path,
+        typer.Argument(
+            help="Input directory to read DICOM files from", show_default=True
+        ),
+    ] = INPUT_DIR,
+    threads: Annotated[
+        int,
+        typer.Option(
+            help="Number of threads to use for reading the DICOM files",
+            show_default=True,
+            min=1,
+        ),
+    ] = DEFAULT_SCAN_THREADS,
+):
+    from .dicom_index import DicomIndex
+
+    dicom_index = DicomIndex(index_file, input_dir)
+    dicom_index.update(threads=threads)
+    dicom_index.close()
 
 
 @utils_cli.command(
@@ -117,8 +184,39 @@ def series_info(
         bool,
         typer.Option("--csv", help="Print series information in CSV format"),
     ] = False,
+    threads: Annotated[
+        int,
+        typer.Option(
+            help="Number of threads to use for reading the DICOM files",
+            show_default=True,
+            min=1,
+        ),
+    ] = DEFAULT_SCAN_THREADS,
+    index_file: Annotated[
+        Path | None,
+        typer.Option(
+            "--index-file",
+            help="Use (and update) the given index of the input DICOM files",
+        ),
+    ] = None,
 ):
-    series_info_list = series_information(input_dir)
+    from itertools import groupby
+    from operator import attrgetter
+
+    from rich.console import Console
+    from rich.table import Table
+
+    from .dicom_index import DicomIndex
+    from .dicom_utils import series_information
+
+    dicom_index = DicomIndex(index_file, input_dir) if index_file else None
+    try:
+        series_info_list = series_information(
+            input_dir, threads=threads, index=dicom_index
+        )
+    finally:
+        if dicom_index is not None:
+            dicom_index.close()
     # UnGrouped but sorted by PatientID:
     if not grouped:
         if csv:
@@ -237,6 +335,97 @@ def series_info(
     console.print(f"Total count of DICOM files: {total_img_count}", style="bold")
 
 
+@cli.command(
+    "serve-ocr",
+    help=(
+        "Run a local OCR server that keeps the OCR models loaded, for the 'run' "
+        "commands to use instead of loading the models each time"
+    ),
+)
+def serve_ocr(
+    socket: Annotated[
+        Path,
+        typer.Option(
+            "--socket", help="The Unix socket to listen on", show_default=True
+        ),
+    ] = Path(DEFAULT_OCR_SOCKET),
+    paddle_ocr: Annotated[
+        bool,
+        typer.Option("--paddle-ocr", help="Use PaddleOCR (instead of Tesseract OCR)"),
+    ] = False,
+    threads: Annotated[
+        int,
+        typer.Option(
+            help="Number of threads that PaddleOCR (if enabled) will use",
+            show_default=True,
+        ),
+    ] = DEFAULT_CPU_THREADS,
+    ocr_workers: Annotated[
+        int,
+        typer.Option(
+            "--ocr-workers",
+            help=(
+                "Number of worker processes to use for OCR. "
+                "The threads are split among the workers"
+            ),
+            show_default=True,
+            min=1,
+        ),
+    ] = DEFAULT_OCR_WORKERS,
+    ocr_batch_size: Annotated[
+        int,
+        typer.Option(
+            "--ocr-batch-size",
+            help="Number of images that PaddleOCR processes together in each batch",
+            show_default=True,
+            min=1,
+        ),
+    ] = DEFAULT_OCR_BATCH_SIZE,
+    ocr_analyzer: Annotated[
+        AnalyzerProfile,
+        typer.Option(
+            "--ocr-analyzer",
+            help=(
+                "The profile of the analyzer that finds the PII in the text found by "
+                "the OCR: 'full' (large spaCy NER model), 'small' (small spaCy NER "
+                "model) or 'blank' (no NER). The 'small' and 'blank' profiles also use "
+                "deny lists of the DICOM metadata and regular expressions"
+            ),
+            show_default=True,
+        ),
+    ] = AnalyzerProfile.full,
+    paddle_backend: Annotated[
+        PaddleBackend | None,
+        typer.Option(
+            "--paddle-backend",
+            help=(
+                "The backend that runs the PaddleOCR models, overriding the 'backend' "
+                "of PaddleOCR.yaml: 'paddle' (PaddleOCR), 'onnx' (the ONNX exports of "
+                "the models with ONNX Runtime) or 'onnx-int8' (the same, quantized)"
+            ),
+        ),
+    ] = None,
+):
+    import rich
+
+    from .ocr_server import serve
+
+    rich.print(_header_info())
+    try:
+        serve(
+            socket,
+            paddle_ocr=paddle_ocr,
+            threads=threads,
+            workers=ocr_workers,
+            batch_size=ocr_batch_size,
+            analyzer=ocr_analyzer,
+            paddle_backend=paddle_backend,
+        )
+    except RuntimeError as e:
+        rich.print(f"[red][bold]Error:[/bold] {e}[/red]")
+        sys.exit(1)
+
+
 @cli.command(help="Run the DICOM anonymization pipeline")
 def run(
     ctx: typer.Context,
@@ -269,6 +458,18 @@ def run(
             ),
         ),
     ] = True,
+    engine: Annotated[
+        Engine,
+        typer.Option(
+            "--engine",
+            help=(
+                "The engine for the deidentification of the DICOM metadata: the RSNA "
+                "CTP anonymizer (Java) or its native (Python) reimplementation that "
+                "uses the same script"
+            ),
+            show_default=True,
+        ),
+    ] = Engine.ctp,
     ocr: Annotated[
         bool,
         typer.Option("--ocr", help="Perform OCR (using Tesseract OCR)"),
@@ -287,6 +488,161 @@ def run(
             show_default=True,
         ),
     ] = DEFAULT_CPU_THREADS,
+    ocr_workers: Annotated[
+        int,
+        typer.Option(
+            "--ocr-workers",
+            help=(
+                "Number of worker processes to use for OCR (if enabled). "
+                "The threads are split among the workers"
+            ),
+            show_default=True,
+            min=1,
+        ),
+    ] = DEFAULT_OCR_WORKERS,
+    ocr_batch_size: Annotated[
+        int,
+        typer.Option(
+            "--ocr-batch-size",
+            help=(
+                "Number of images that PaddleOCR (if enabled) processes together in "
+                "each batch"
+            ),
+            show_default=True,
+            min=1,
+        ),
+    ] = DEFAULT_OCR_BATCH_SIZE,
+    ocr_analyzer: Annotated[
+        AnalyzerProfile,
+        typer.Option(
+            "--ocr-analyzer",
+            help=(
+                "The profile of the analyzer that finds the PII in the text found by "
+                "the OCR: 'full' (large spaCy NER model), 'small' (small spaCy NER "
+                "model) or 'blank' (no NER). The 'small' and 'blank' profiles also use "
+                "deny lists of the DICOM metadata and regular expressions"
+            ),
+            show_default=True,
+        ),
+    ] = AnalyzerProfile.full,
+    paddle_backend: Annotated[
+        PaddleBackend | None,
+        typer.Option(
+            "--paddle-backend",
+            help=(
+                "The backend that runs the PaddleOCR models, overriding the 'backend' "
+                "of PaddleOCR.yaml: 'paddle' (PaddleOCR), 'onnx' (the ONNX exports of "
+                "the models with ONNX Runtime) or 'onnx-int8' (the same, quantized)"
+            ),
+        ),
+    ] = None,
+    ocr_server: Annotated[
+        Path,
+        typer.Option(
+            "--ocr-server",
+            help=(
+                "The Unix socket of an OCR server ('lethe serve-ocr') to use for OCR, "
+                "if one is running with the same OCR settings"
+            ),
+            show_default=True,
+        ),
+    ] = Path(DEFAULT_OCR_SOCKET),
+    ocr_max_side: Annotated[
+        int | None,
+        typer.Option(
+            "--ocr-max-side",
+            help=(
+                "OCR the multi-frame images and the images larger than this (e.g. "
+                "2048) one frame at a time, detecting the text on a copy of each "
+                "frame downscaled to this size"
+            ),
+            min=64,
+        ),
+    ] = None,
+    ocr_prefilter: Annotated[
+        bool,
+        typer.Option(
+            "--ocr-prefilter",
+            help=(
+                "Skip the OCR of the files that cannot contain burned-in text, "
+                "according to their headers and a quick check of their pixels. "
+                "These files are passed through untouched"
+            ),
+        ),
+    ] = False,
+    ocr_prefilter_config: Annotated[
+        Path | None,
+        typer.Option(
+            "--ocr-prefilter-config",
+            help="A JSON file that overrides the rules of the OCR pre-filter",
+            exists=True,
+            dir_okay=False,
+            readable=True,
+        ),
+    ] = None,
+    ocr_series: Annotated[
+        bool,
+        typer.Option(
+            "--ocr-series",
+            help=(
+                "Detect the text regions of each series in a few sample slices and "
+                "redact them in all its slices, OCRing each slice only if the samples "
+                "disagree"
+            ),
+        ),
+    ] = False,
+    ocr_series_samples: Annotated[
+        int,
+        typer.Option(
+            "--ocr-series-samples",
+            help="Number of sample slices per series for --ocr-series",
+            show_default=True,
+            min=1,
+        ),
+    ] = DEFAULT_OCR_SERIES_SAMPLES,
+    organize_mode: Annotated[
+        OrganizeMode,
+        typer.Option(
+            "--organize-mode",
+            help=(
+                "How the anonymized files are placed in the hierarchical output "
+                "folders: 'move', 'hardlink' and 'reflink' avoid copying the data "
+                "when possible"
+            ),
+            show_default=True,
+        ),
+    ] = OrganizeMode.copy,
+    organize_order: Annotated[
+        OrganizeOrder,
+        typer.Option(
+            "--organize-order",
+            help=(
+                "How the files of each series are numbered in the hierarchical output "
+                "folders: by their InstanceNumber (so that the same input always gives "
+                "the same output) or in the order they are found"
+            ),
+            show_default=True,
+        ),
+    ] = OrganizeOrder.instance,
+    ctp_shards: Annotated[
+        int,
+        typer.Option(
+            "--ctp-shards",
+            help=(
+                "Number of concurrent RSNA CTP processes, each anonymizing the files "
+                "of a part of the patients. The threads are split among them"
+            ),
+            show_default=True,
+            min=1,
+        ),
+    ] = 1,
+    ctp_heap: Annotated[
+        str | None,
+        typer.Option(
+            "--ctp-heap",
+            help="Maximum Java heap size of each RSNA CTP process, e.g. '4g'",
+        ),
+    ] = None,
     pepper: Annotated[
         str | None,
         typer.Option(
@@ -305,6 +661,67 @@ def run(
             ),
         ),
     ] = True,
+    single_pass: Annotated[
+        bool,
+        typer.Option(
+            "--single-pass",
+            help=(
+                "Read each DICOM file once and perform OCR, deidentification and the "
+                "writing to the output folder in memory, without temporary folders. "
+                "Requires '--engine native'"
+            ),
+        ),
+    ] = False,
+    cache_dir: Annotated[
+        Path | None,
+        typer.Option(
+            "--cache-dir",
+            help=(
+                "Directory of a persistent cache of processed files, so that "
+                "re-runs skip the files that were already redacted/anonymized"
+            ),
+        ),
+    ] = None,
+    cache_max_size: Annotated[
+        int,
+        typer.Option(
+            "--cache-max-size",
+            help="Maximum size of the cache in GiB",
+            show_default=True,
+            min=1,
+        ),
+    ] = DEFAULT_CACHE_MAX_SIZE // 1024**3,
+    index_file: Annotated[
+        Path | None,
+        typer.Option(
+            "--index-file",
+            help=(
+                "Use (and update) the given index of the input DICOM files, "
+                "see 'utils index'"
+            ),
+        ),
+    ] = None,
+    resume: Annotated[
+        bool,
+        typer.Option(
+            "--resume",
+            help=(
+                "Resume an interrupted run with the same settings and secret key, "
+                "skipping the stages and the files that have already been processed"
+            ),
+        ),
+    ] = False,
+    work_dir: Annotated[
+        Path | None,
+        typer.Option(
+            "--work-dir",
+            help=(
+                "Directory for the intermediate (not yet anonymized) results of the "
+                "run, outside the output directory, e.g. a persistent volume for "
+                "resuming runs. Defaults to the system's temporary directory"
+            ),
+        ),
+    ] = None,
     verbose: Annotated[
         bool,
         typer.Option("--verbose", "-v", help="Enable verbose logging"),
@@ -320,48 +737,549 @@ def run(
         ),
     ] = None,
 ):
+    from contextlib import closing
+    from hashlib import sha256
+
+    import rich
+
+    from .cache import FileCache, file_hash
+    from .dcm_deidentify import run_ctp
+    from .dicom_index import DicomIndex
+    from .dicom_utils import NOT_DICOM
+    from .hash_clinical import hash_clinical_csvs
+    from .manifest import JobManifest, secret_fingerprint
+    from .native_deidentify import run_native
+    from .ocr_deidentify import perform_ocr
+    from .ocr_prefilter import load_prefilter_rules
+    from .output_dir import copy_and_organize
+    from .pipeline import run_pipeline
+    from .version import __version__
+
     if paddle_ocr and ocr:
         rich.print(
             "[red][bold]Error:[/bold] Cannot use both PaddleOCR and TesseractOCR: please choose one, use --help for usage information[/red]"
         )
         sys.exit(1)
 
+    if single_pass and dcm_deintify and engine != Engine.native:
+        rich.print(
+            "[red][bold]Error:[/bold] The single pass pipeline can only be used with the native engine: please add '--engine native', use --help for usage information[/red]"
+        )
+        sys.exit(1)
+
+    if single_pass and ocr_series:
+        rich.print(
+            "[red][bold]Error:[/bold] The series OCR cannot be used with the single pass pipeline, use --help for usage information[/red]"
+        )
+        sys.exit(1)
+
+    if resume and not pepper:
+        rich.print(
+            "[red][bold]Error:[/bold] Resuming a run requires the secret key that was used for it: please add '--secret', use --help for usage information[/red]"
+        )
+        sys.exit(1)
+
+    if work_dir is not None and work_dir.absolute().is_relative_to(
+        output_dir.absolute()
+    ):
+        rich.print(
+            "[red][bold]Error:[/bold] The work directory cannot be inside the output directory, since it contains data that is not anonymized yet[/red]"
+        )
+        sys.exit(1)
+
     if not pepper:
         pepper = _create_secret_key()  # Create a time based (UUIDv7) string as secret
     elif not _valid_secret_key(pepper):
         rich.print("[red][bold]Error:[/bold] Invalid secret key[/red]")
         sys.exit(1)
 
+    prefilter = None
+    if ocr_prefilter or ocr_prefilter_config is not None:
+        try:
+            prefilter = load_prefilter_rules(ocr_prefilter_config)
+        except (ValueError, TypeError) as e:
+            rich.print(
+                f"[red][bold]Error:[/bold] Invalid OCR pre-filter rules: {e}[/red]"
+            )
+            sys.exit(1)
+
     rich.print(_header_info())
     if verbose:
         logger.debug(f"Using secret key: {pepper}")
-    # Step 1: Run OCR if enabled
-    input_dir_images = input_dir
-    if ocr or paddle_ocr:
-        ocr_output_dir = Path(tempfile.mkdtemp())
-        perform_ocr(input_dir_images, ocr_output_dir, paddle_ocr, verbose, threads)
-        input_dir_images = ocr_output_dir
-
-    # Step 2: Run RSNA CTP
-    if dcm_deintify:
-        anon_script = Path(os.getcwd()) / "ctp" / "anon.script"
-        ctp_output_dir = (
-            Path(tempfile.mkdtemp()) if hierarchical else output_dir.absolute()
+    cache = None
+    if cache_dir is not None:
+        cache = FileCache(cache_dir, cache_max_size * 1024**3)
+        logger.info(f"Using cache directory {cache_dir}")
+    dicom_index = None
+    if index_file is not None:
+        dicom_index = DicomIndex(index_file, input_dir)
+        dicom_index.update(threads=threads)
+
+    anon_script = Path(os.getcwd()) / "ctp" / "anon.script"
+    # The job manifest keeps the progress of the run in the output directory:
+    with closing(JobManifest(output_dir, pepper)) as manifest:
+        settings = {
+            "version": __version__,
+            # Hashed, since the manifest remains in the output directory:
+            "input_dir": sha256(os.fspath(input_dir.absolute()).encode()).hexdigest(),
+            "site_id": sha256(site_id.encode()).hexdigest(),
+            "secret": secret_fingerprint(pepper),
+            "script": file_hash(anon_script) if dcm_deintify else "",
+            "engine": engine.value if dcm_deintify else "",
+            "ocr": "paddle" if paddle_ocr else "tesseract" if ocr else "",
+            "hierarchical": str(hierarchical),
+            "single_pass": str(single_pass),
+            "ocr_prefilter": repr(prefilter) if prefilter is not None else "",
+            "ocr_series": str(ocr_series_samples) if ocr_series else "",
+            "ocr_max_side": str(ocr_max_side or ""),
+            "ocr_analyzer": ocr_analyzer.value if ocr or paddle_ocr else "",
+            "paddle_backend": paddle_backend.value
+            if paddle_ocr and paddle_backend
+            else "",
+        }
+        if not resume:
+            manifest.start(settings, work_dir)
+        elif not manifest.settings():
+            logger.warning(
+                f"No run to resume found in {output_dir}, starting a new one"
+            )
+            manifest.start(settings, work_dir)
+        elif mismatched := manifest.resume(settings):
+            rich.print(
+                f"[red][bold]Error:[/bold] Cannot resume the run in {output_dir} because its settings differ: {', '.join(mismatched)}[/red]"
+            )
+            sys.exit(1)
+        elif not single_pass and not manifest.has_work_dir():
+            logger.warning(
+                f"The work directory {manifest.work_dir} of the run to resume does not "
+                "exist anymore, starting a new run"
+            )
+            manifest.start(settings, work_dir)
+        logger.info(f"Using work directory {manifest.work_dir}")
+
+        if single_pass:
+            # Steps 1, 2 and 2.1 in a single pass over the DICOM files (if interrupted,
+            # this stage is run again from the start):
+            if not manifest.is_completed("pipeline"):
+                workers = ocr_workers if ocr or paddle_ocr else threads
+                run_pipeline(
+                    input_dir=input_dir,
+                    output_dir=output_dir,
+                    anon_script=anon_script if dcm_deintify else None,
+                    site_id=site_id,
+                    pepper=pepper,
+                    redact=ocr or paddle_ocr,
+                    paddle_ocr=paddle_ocr,
+                    hierarchical=hierarchical,
+                    order=organize_order,
+                    workers=workers,
+                    threads=threads,
+                    max_in_flight=4 * workers,
+                    cache=cache,
+                    index=dicom_index,
+                    prefilter=prefilter,
+                    analyzer=ocr_analyzer,
+                    paddle_backend=paddle_backend,
+                    max_side=ocr_max_side,
+                )
+                manifest.complete("pipeline")
+            hash_clinical_csvs(
+                input_dir,
+                output_dir,
+                secret_key=pepper,
+                verbose=verbose,
+                workers=threads,
+            )
+            manifest.finish()
+            return
+
+        # The stages that must be completed (without failed files) for finishing the run:
+        stages = []
+        # Step 1: Run OCR if enabled
+        input_dir_images = input_dir
+        if ocr or paddle_ocr:
+            stages.append("ocr")
+            ocr_output_dir = manifest.stage_dir("ocr")
+            if not manifest.is_completed("ocr"):
+                record = manifest.recorder("ocr", input_dir_images)
+                perform_ocr(
+                    input_dir_images,
+                    ocr_output_dir,
+                    paddle_ocr,
+                    verbose,
+                    threads,
+                    workers=ocr_workers,
+                    cache=cache,
+                    index=dicom_index,
+                    skip=manifest.skip_function("ocr", input_dir_images),
+                    on_result=lambda r: record(r.path, r.error),
+                    prefilter=prefilter,
+                    series_samples=ocr_series_samples if ocr_series else None,
+                    batch_size=ocr_batch_size,
+                    max_side=ocr_max_side,
+                    server=ocr_server,
+                    analyzer=ocr_analyzer,
+                    paddle_backend=paddle_backend,
+                )
+                manifest.complete_if_done("ocr")
+            input_dir_images = ocr_output_dir
+
+        # Step 2: Run RSNA CTP
+        if dcm_deintify:
+            stages.append("anonymize")
+            ctp_output_dir = (
+                manifest.stage_dir("anonymize")
+                if hierarchical
+                else output_dir.absolute()
+            )
+            if not manifest.is_completed("anonymize"):
+                record = manifest.recorder("anonymize", input_dir_images)
+                skip = manifest.skip_function("anonymize", input_dir_images)
+                if engine == Engine.native:
+                    run_native(
+                        input_dir=input_dir_images,
+                        output_dir=ctp_output_dir,
+                        anon_script=anon_script,
+                        site_id=site_id,
+                        pepper=pepper,
+                        threads=threads,
+                        cache=cache,
+                        skip=skip,
+                        on_result=lambda r: record(
+                            r.path, r.error if r.error != NOT_DICOM else None
+                        ),
+                    )
+                else:
+                    run_ctp(
+                        input_dir=input_dir_images,
+                        output_dir=ctp_output_dir,
+                        anon_script=anon_script,
+                        site_id=site_id,
+                        pepper=pepper,
+                        threads=threads,
+                        cache=cache,
+                        shards=ctp_shards,
+                        heap=ctp_heap,
+                        skip=skip,
+                        on_result=lambda r: record(
+                            r.input, r.error if r.status == "failed" else None
+                        ),
+                    )
+                manifest.complete_if_done("anonymize", *stages[:-1])
+            # Step 2.1: Copy and organize files if hierarchical
+            if hierarchical and not manifest.is_completed("organize"):
+                stages.append("organize")
+                if manifest.is_completed("anonymize"):
+                    copy_and_organize(
+                        ctp_output_dir,
+                        output_dir,
+                        mode=organize_mode,
+                        order=organize_order,
+                        threads=threads,
+                        # Before the moved files are removed from the work folder
+                        on_organized=lambda: manifest.complete("organize"),
+                    )
+                else:
+                    # Organized again when the failed files are processed, so the files
+                    # are kept in the work folder
+                    copy_and_organize(
+                        ctp_output_dir,
+                        output_dir,
+                        mode=OrganizeMode.hardlink
+                        if organize_mode == OrganizeMode.move
+                        else organize_mode,
+                        order=organize_order,
+                        threads=threads,
+                    )
+
+        # Step 3: Hash any clinical CSVs found in the input directory:
+        hash_clinical_csvs(
+            input_dir, output_dir, secret_key=pepper, verbose=verbose, workers=threads
         )
-        run_ctp(
-            input_dir=input_dir_images,
-            output_dir=ctp_output_dir,
-            anon_script=anon_script,
-            site_id=site_id,
-            pepper=pepper,
-            threads=threads,
+        if all(manifest.is_completed(stage) for stage in stages):
+            manifest.finish()
+        else:
+            logger.warning(
+                f"Some files failed: the intermediate results are kept in {manifest.work_dir} "
+                "so that the run can be resumed (--resume) for processing them again"
+            )
+
+
+@cli.command(
+    help=(
+        "Benchmark the stages of the pipeline on a synthetic cohort (or an existing "
+        "one) and report the throughput, peak memory and CPU utilisation of each "
+        "stage as JSON"
+    )
+)
+def bench(
+    patients: Annotated[
+        int,
+        typer.Option(help="Number of patients of the cohort", show_default=True, min=1),
+    ] = DEFAULT_BENCH_PATIENTS,
+    studies: Annotated[
+        int,
+        typer.Option(help="Number of studies per patient", show_default=True, min=1),
+    ] = DEFAULT_BENCH_STUDIES,
+    series: Annotated[
+        int,
+        typer.Option(help="Number of series per study", show_default=True, min=0),
+    ] = DEFAULT_BENCH_SERIES,
+    images: Annotated[
+        int,
+        typer.Option(help="Number of images per series", show_default=True, min=1),
+    ] = DEFAULT_BENCH_IMAGES,
+    modalities: Annotated[
+        list[str],
+        typer.Option(
+            "--modality",
+            help=(
+                "The modalities of the series, in turn (CT, MR, CR, DX, MG, US, XA "
+                "or OT), can be repeated"
+            ),
+            show_default=True,
+        ),
+    ] = DEFAULT_BENCH_MODALITIES,
+    size: Annotated[
+        int,
+        typer.Option(
+            help="The rows and columns of the images", show_default=True, min=32
+        ),
+    ] = DEFAULT_BENCH_IMAGE_SIZE,
+    multiframe_series: Annotated[
+        int,
+        typer.Option(
+            "--multiframe-series",
+            help="Number of multi-frame (XA cine) series per study, of one image each",
+            show_default=True,
+            min=0,
+        ),
+    ] = 0,
+    frames: Annotated[
+        int,
+        typer.Option(
+            help="Number of frames of the multi-frame images",
+            show_default=True,
+            min=1,
+        ),
+    ] = DEFAULT_BENCH_FRAMES,
+    syntaxes: Annotated[
+        list[CohortSyntax],
+        typer.Option(
+            "--syntax",
+            help=(
+                "The transfer syntaxes of the series, in turn, can be repeated. The "
+                "'jpeg-ls' and 'jpeg2000' ones require the pydicom plugins of their "
+                "encoders"
+            ),
+            show_default=True,
+        ),
+    ] = [CohortSyntax.explicit],
+    burned_in_text: Annotated[
+        float,
+        typer.Option(
+            "--burned-in-text",
+            help="The fraction of the series with burned-in text (requires Pillow)",
+            show_default=True,
+            min=0,
+            max=1,
+        ),
+    ] = DEFAULT_BENCH_BURNED_IN_TEXT,
+    csv_mb: Annotated[
+        float,
+        typer.Option(
+            "--csv-mb", help="The size of the clinical CSV in MB", show_default=True
+        ),
+    ] = DEFAULT_BENCH_CSV_MB,
+    seed: Annotated[
+        int,
+        typer.Option(help="The seed of the synthetic cohort", show_default=True),
+    ] = 0,
+    input_dir: Annotated[
+        Path | None,
+        typer.Option(
+            "--input-dir",
+            help="Benchmark an existing cohort instead of generating one",
+            exists=True,
+            file_okay=False,
+        ),
+    ] = None,
+    engine: Annotated[
+        Engine,
+        typer.Option(
+            "--engine",
+            help="The engine for the deidentification of the DICOM metadata",
+            show_default=True,
+        ),
+    ] = Engine.ctp,
+    ocr: Annotated[
+        bool,
+        typer.Option("--ocr", help="Benchmark the OCR (using Tesseract OCR)"),
+    ] = False,
+    paddle_ocr: Annotated[
+        bool,
+        typer.Option("--paddle-ocr", help="Benchmark the OCR using PaddleOCR"),
+    ] = False,
+    threads: Annotated[
+        int,
+        typer.Option(
+            help="Number of threads that the stages will use", show_default=True
+        ),
+    ] = DEFAULT_CPU_THREADS,
+    ocr_workers: Annotated[
+        int,
+        typer.Option(
+            "--ocr-workers",
+            help="Number of worker processes to use for OCR (if enabled)",
+            show_default=True,
+            min=1,
+        ),
+    ] = DEFAULT_OCR_WORKERS,
+    ocr_batch_size: Annotated[
+        int,
+        typer.Option(
+            "--ocr-batch-size",
+            help=(
+                "Number of images that PaddleOCR (if enabled) processes together in "
+                "each batch"
+            ),
+            show_default=True,
+            min=1,
+        ),
+    ] = DEFAULT_OCR_BATCH_SIZE,
+    ocr_analyzer: Annotated[
+        AnalyzerProfile,
+        typer.Option(
+            "--ocr-analyzer",
+            help="The profile of the analyzer that finds the PII in the text",
+            show_default=True,
+        ),
+    ] = AnalyzerProfile.full,
+    paddle_backend: Annotated[
+        PaddleBackend | None,
+        typer.Option(
+            "--paddle-backend",
+            help="The backend that runs the PaddleOCR models",
+        ),
+    ] = None,
+    ocr_max_side: Annotated[
+        int | None,
+        typer.Option(
+            "--ocr-max-side",
+            help=(
+                "OCR the multi-frame images and the images larger than this one "
+                "frame at a time, downscaled to this size"
+            ),
+            min=64,
+        ),
+    ] = None,
+    organize_mode: Annotated[
+        OrganizeMode,
+        typer.Option(
+            "--organize-mode",
+            help="How the anonymized files are placed in the output folders",
+            show_default=True,
+        ),
+    ] = OrganizeMode.copy,
+    work_dir: Annotated[
+        Path | None,
+        typer.Option(
+            "--work-dir",
+            help=(
+                "The directory of the cohort and of the outputs of the stages "
+                "(by default a temporary directory, removed afterwards)"
+            ),
+            file_okay=False,
+        ),
+    ] = None,
+    keep: Annotated[
+        bool,
+        typer.Option("--keep", help="Keep the temporary directory of the benchmark"),
+    ] = False,
+    output: Annotated[
+        Path | None,
+        typer.Option(
+            "--output",
+            "-o",
+            help="Write the JSON report to this file (instead of the standard output)",
+            dir_okay=False,
+        ),
+    ] = None,
+):
+    import json
+    import shutil
+    import tempfile
+
+    import rich
+
+    from .benchmark import CohortSpec, run_benchmark
+
+    if paddle_ocr and ocr:
+        rich.print(
+            "[red][bold]Error:[/bold] Cannot use both PaddleOCR and TesseractOCR: please choose one, use --help for usage information[/red]"
         )
-        # Step 2.1: Copy and organize files if hierarchical
-        if hierarchical:
-            copy_and_organize(ctp_output_dir, output_dir)
+        sys.exit(1)
+
+    spec = None
+    if input_dir is None:
+        spec = CohortSpec(
+            patients=patients,
+            studies=studies,
+            series=series,
+            images=images,
+            modalities=[m.upper() for m in modalities],
+            size=size,
+            multiframe_series=multiframe_series,
+            frames=frames,
+            syntaxes=syntaxes,
+            burned_in_text=burned_in_text,
+            csv_mb=csv_mb,
+            seed=seed,
+        )
+        try:
+            spec.check()
+        except ValueError as e:
+            rich.print(f"[red][bold]Error:[/bold] {e}[/red]")
+            sys.exit(1)
 
-    # Step 3: Hash any clinical CSVs found in the input directory:
-    hash_clinical_csvs(input_dir, output_dir, secret_key=pepper, verbose=verbose)
+    temporary = work_dir is None
+    if work_dir is None:
+        work_dir = Path(tempfile.mkdtemp(prefix="lethe-bench-"))
+    work_dir.mkdir(parents=True, exist_ok=True)
+    try:
+        report = run_benchmark(
+            work_dir,
+            spec=spec,
+            input_dir=input_dir,
+            anon_script=Path(os.getcwd()) / "ctp" / "anon.script",
+            site_id="BENCH",
+            secret_key=_create_secret_key(),
+            ocr=ocr,
+            paddle_ocr=paddle_ocr,
+            native=engine == Engine.native,
+            threads=threads,
+            ocr_workers=ocr_workers,
+            ocr_options={
+                "batch_size": ocr_batch_size,
+                "analyzer": ocr_analyzer,
+                "paddle_backend": paddle_backend,
+                "max_side": ocr_max_side,
+            }
+            if ocr or paddle_ocr
+            else None,
+            organize_options={"mode": organize_mode},
+        )
+    finally:
+        if temporary and not keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        else:
+            logger.info(f"The cohort and the outputs of the stages are in {work_dir}")
+    text = json.dumps(report, indent=2)
+    if output is None:
+        print(text)
+    else:
+        output.write_text(text + "\n")
+        logger.info(f"Wrote the benchmark report to {output}")
 
 
 if __name__ == "__main__":
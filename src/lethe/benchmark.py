@@ -0,0 +1,799 @@
+"""
+Benchmark of the stages of the anonymization pipeline (`lethe bench`), so that the releases
+of lethe can be compared on the same workloads.
+
+A synthetic cohort is generated locally (see `CohortSpec`): patients with studies of series
+of DICOM images of the given modalities, sizes and transfer syntaxes, multi-frame series,
+burned-in text (patient name, ID and dates) in a fraction of the series, and clinical CSVs
+of a given size. The stages of `lethe run` are then run on it, one after the other, as they
+are run by the pipeline:
+
+- `series_information`: the scan of the headers of the input files
+- `ocr`: the redaction of the burned-in text (if enabled)
+- `run_ctp` (or `run_native`): the deidentification of the DICOM metadata
+- `copy_and_organize`: the hierarchical output folders
+- `hash_clinical_csvs`: the hashing of the patient IDs of the clinical CSVs
+
+Each stage is run in its own (forked) process, whose process tree is sampled while it runs,
+and the report gives for each stage its wall time, its throughput (files/s and MB/s of its
+input), the peak PSS of its processes (the proportional set size: the pages shared by the
+forked worker processes are split between them instead of being counted once per worker,
+summed over the processes that run at the same time) and its CPU time and utilisation (of
+all the CPUs), as JSON. Where `/proc` is not available, the peak RSS of the largest process
+is reported instead.
+
+The clinical CSVs of the generated cohort are written next to its DICOM files (in their
+own folder), so that the DICOM stages only see DICOM files.
+"""
+
+import importlib.util
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import time
+from collections.abc import Callable
+from dataclasses import asdict, dataclass, field
+from enum import Enum
+from functools import partial
+from pathlib import Path
+from typing import TYPE_CHECKING, NamedTuple
+
+from loguru import logger
+
+from .defaults import (
+    DEFAULT_BENCH_BURNED_IN_TEXT,
+    DEFAULT_BENCH_CSV_MB,
+    DEFAULT_BENCH_FRAMES,
+    DEFAULT_BENCH_IMAGE_SIZE,
+    DEFAULT_BENCH_IMAGES,
+    DEFAULT_BENCH_MODALITIES,
+    DEFAULT_BENCH_PATIENTS,
+    DEFAULT_BENCH_SERIES,
+    DEFAULT_BENCH_STUDIES,
+    DEFAULT_CPU_THREADS,
+    DEFAULT_OCR_WORKERS,
+)
+
+if TYPE_CHECKING:
+    import numpy as np
+
+MB = 1_000_000
+# How often the memory of the process tree of a stage is sampled
+SAMPLE_INTERVAL = 0.1
+CLINICAL_CSV = "clinical.csv"
+STUDIES_CSV = "dcm_studies_metadata.csv"
+
+
+class CohortSyntax(str, Enum):
+    explicit = "explicit"
+    implicit = "implicit"
+    rle = "rle"
+    jpeg_ls = "jpeg-ls"
+    jpeg2000 = "jpeg2000"
+
+
+SYNTAX_UIDS = {
+    CohortSyntax.explicit: "1.2.840.10008.1.2.1",
+    CohortSyntax.implicit: "1.2.840.10008.1.2",
+    CohortSyntax.rle: "1.2.840.10008.1.2.5",
+    CohortSyntax.jpeg_ls: "1.2.840.10008.1.2.4.80",
+    CohortSyntax.jpeg2000: "1.2.840.10008.1.2.4.90",
+}
+UNCOMPRESSED_SYNTAXES = [CohortSyntax.explicit, CohortSyntax.implicit]
+
+
+class ModalityImage(NamedTuple):
+    sop_class_uid: str
+    photometric: str
+    bits_stored: int
+
+
+MODALITY_IMAGES = {
+    "CT": ModalityImage("1.2.840.10008.5.1.4.1.1.2", "MONOCHROME2", 12),
+    "MR": ModalityImage("1.2.840.10008.5.1.4.1.1.4", "MONOCHROME2", 12),
+    "CR": ModalityImage("1.2.840.10008.5.1.4.1.1.1", "MONOCHROME2", 12),
+    "DX": ModalityImage("1.2.840.10008.5.1.4.1.1.1.1", "MONOCHROME2", 12),
+    "MG": ModalityImage("1.2.840.10008.5.1.4.1.1.1.2", "MONOCHROME2", 12),
+    "US": ModalityImage("1.2.840.10008.5.1.4.1.1.6.1", "RGB", 8),
+    "XA": ModalityImage("1.2.840.10008.5.1.4.1.1.12.1", "MONOCHROME2", 8),
+    "OT": ModalityImage("1.2.840.10008.5.1.4.1.1.7", "RGB", 8),
+}
+# The modality of the multi-frame (cine) series
+MULTIFRAME_MODALITY = "XA"
+
+FIRST_NAMES = ["John", "Maria", "Georgios", "Anna", "Pierre", "Elena", "Nikos", "Sofia"]
+LAST_NAMES = ["Smith", "Papadopoulos", "Dubois", "Rossi", "Muller", "Garcia", "Ivanova"]
+DIAGNOSES = ["Adenocarcinoma", "Squamous cell carcinoma", "Glioblastoma", "Benign"]
+
+
+@dataclass(kw_only=True)
+class CohortSpec:
+    patients: int = DEFAULT_BENCH_PATIENTS
+    studies: int = DEFAULT_BENCH_STUDIES  # per patient
+    series: int = DEFAULT_BENCH_SERIES  # per study
+    images: int = DEFAULT_BENCH_IMAGES  # per series
+    # The modalities of the series, in turn
+    modalities: list[str] = field(
+        default_factory=lambda: list(DEFAULT_BENCH_MODALITIES)
+    )
+    # The rows and columns of the images
+    size: int = DEFAULT_BENCH_IMAGE_SIZE
+    # The multi-frame series per study (in addition to `series`), of one image each
+    multiframe_series: int = 0
+    frames: int = DEFAULT_BENCH_FRAMES
+    # The transfer syntaxes of the series, in turn
+    syntaxes: list[CohortSyntax] = field(
+        default_factory=lambda: [CohortSyntax.explicit]
+    )
+    # The fraction of the series whose images have burned-in text
+    burned_in_text: float = DEFAULT_BENCH_BURNED_IN_TEXT
+    # The size of the clinical CSV
+    csv_mb: float = DEFAULT_BENCH_CSV_MB
+    seed: int = 0
+
+    def check(self) -> None:
+        """Raises a ValueError if the cohort cannot be generated"""
+        if not self.modalities or not self.syntaxes:
+            raise ValueError("At least one modality and transfer syntax are needed")
+        if unknown := [m for m in self.modalities if m not in MODALITY_IMAGES]:
+            raise ValueError(
+                f"Unknown modalities {', '.join(unknown)}, use any of "
+                f"{', '.join(MODALITY_IMAGES)}"
+            )
+        if not 0 <= self.burned_in_text <= 1:
+            raise ValueError("The fraction of series with burned-in text must be 0-1")
+        if self.burned_in_text > 0 and importlib.util.find_spec("PIL") is None:
+            raise ValueError("The burned-in text requires Pillow")
+        from pydicom.pixels import get_encoder
+
+        for syntax in self.syntaxes:
+            if syntax in UNCOMPRESSED_SYNTAXES:
+                continue
+            encoder = get_encoder(SYNTAX_UIDS[syntax])
+            if not encoder.is_available:
+                raise ValueError(
+                    f"No encoder of the '{syntax.value}' transfer syntax is available: "
+                    f"{'; '.join(encoder.missing_dependencies)}"
+                )
+
+
+class CohortInfo(NamedTuple):
+    files: int
+    bytes: int
+    patients: int
+    studies: int
+    series: int
+    csv_files: int
+    csv_bytes: int
+
+
+@dataclass(kw_only=True)
+class StageResult:
+    name: str
+    files: int
+    mb: float
+    seconds: float = 0.0
+    files_per_second: float = 0.0
+    mb_per_second: float = 0.0
+    peak_pss_mb: float = 0.0
+    cpu_seconds: float = 0.0
+    # The CPU time over the wall time: the number of CPUs busy on average, and the
+    # fraction of all the CPUs of the machine
+    cpu_cores: float = 0.0
+    cpu_utilisation: float = 0.0
+    error: str | None = None
+
+
+def _patient_id(patient: int) -> str:
+    return f"BENCH{patient:06d}"
+
+
+def _date(rng: "np.random.Generator", first_year: int, last_year: int) -> str:
+    year = int(rng.integers(first_year, last_year + 1))
+    return f"{year}{int(rng.integers(1, 13)):02d}{int(rng.integers(1, 29)):02d}"
+
+
+def _uid(spec: CohortSpec, *parts: object) -> str:
+    from pydicom.uid import generate_uid
+
+    return generate_uid(entropy_srcs=[str(spec.seed), *(str(p) for p in parts)])
+
+
+def _phantom(
+    rng: "np.random.Generator", size: int, image: int, max_value: float
+) -> "np.ndarray":
+    """An image of an ellipse with a few inner discs that move along the series, and noise"""
+    import numpy as np
+
+    y, x = np.mgrid[0:size, 0:size].astype(np.float32) / size - 0.5
+    pixels = np.where((x / 0.42) ** 2 + (y / 0.35) ** 2 <= 1, 0.45, 0.02)
+    shift = 0.1 * np.sin(image / 8)
+    for cx, cy, r, value in [(-0.15, shift, 0.08, 0.8), (0.15, -shift, 0.06, 0.65)]:
+        pixels[(x - cx) ** 2 + (y - cy) ** 2 <= r**2] = value
+    pixels += rng.normal(0, 0.01, pixels.shape)
+    return (np.clip(pixels, 0, 1) * max_value).astype(np.float32)
+
+
+def _text_mask(size: int, lines: list[str], corner_lines: list[str]) -> "np.ndarray":
+    """The pixels of the burned-in text, at the top left and bottom right corners"""
+    import numpy as np
+    from PIL import Image, ImageDraw, ImageFont
+
+    font_size = max(10, size // 40)
+    try:
+        font = ImageFont.load_default(size=font_size)
+    except TypeError:
+        # Pillow < 10.1
+        font = ImageFont.load_default()
+    image = Image.new("L", (size, size))
+    draw = ImageDraw.Draw(image)
+    margin, spacing = size // 50, int(font_size * 1.4)
+    for i, line in enumerate(lines):
+        draw.text((margin, margin + i * spacing), line, fill=255, font=font)
+    for i, line in enumerate(reversed(corner_lines)):
+        draw.text(
+            (size - margin, size - margin - i * spacing),
+            line,
+            fill=255,
+            font=font,
+            anchor="rd",
+        )
+    return np.asarray(image) > 127
+
+
+def _pixels(
+    rng: "np.random.Generator",
+    modality: ModalityImage,
+    size: int,
+    image: int,
+    text: "np.ndarray | None",
+) -> "np.ndarray":
+    import numpy as np
+
+    max_value = 2**modality.bits_stored - 1
+    pixels = _phantom(rng, size, image, max_value * 0.8)
+    if text is not None:
+        pixels[text] = max_value
+    dtype = np.uint8 if modality.bits_stored <= 8 else np.uint16
+    pixels = pixels.astype(dtype)
+    if modality.photometric == "RGB":
+        # Tinted, so that the channels differ
+        pixels = np.stack([pixels, pixels // 4 * 3, pixels // 2], axis=-1)
+        if text is not None:
+            pixels[text] = max_value
+    return pixels
+
+
+def _write_series(
+    output_dir: Path, spec: CohortSpec, patient: int, study: int, series: int
+) -> int:
+    """Writes the files of a series, returning their total size"""
+    import numpy as np
+    from pydicom.dataset import Dataset, FileMetaDataset
+    from pydicom.uid import PYDICOM_IMPLEMENTATION_UID
+
+    multiframe = series >= spec.series
+    series_index = (patient * spec.studies + study) * spec.series + series
+    modality_name = (
+        MULTIFRAME_MODALITY
+        if multiframe
+        else spec.modalities[series_index % len(spec.modalities)]
+    )
+    modality = MODALITY_IMAGES[modality_name]
+    syntax = spec.syntaxes[series_index % len(spec.syntaxes)]
+    patient_rng = np.random.default_rng([spec.seed, patient])
+    first, last = (
+        str(patient_rng.choice(FIRST_NAMES)),
+        str(patient_rng.choice(LAST_NAMES)),
+    )
+    birth_date = _date(patient_rng, 1940, 2000)
+    physician = f"{patient_rng.choice(LAST_NAMES)}^Doctor"
+    study_rng = np.random.default_rng([spec.seed, patient, study])
+    study_date = _date(study_rng, 2010, 2024)
+    accession = f"ACC{int(study_rng.integers(10**6, 10**7))}"
+    rng = np.random.default_rng([spec.seed, patient, study, series])
+    burned_in = rng.random() < spec.burned_in_text
+    patient_id = _patient_id(patient)
+    study_uid = _uid(spec, "study", patient, study)
+    series_uid = _uid(spec, "series", patient, study, series)
+
+    series_dir = output_dir / patient_id / f"study{study + 1}" / f"series{series + 1}"
+    series_dir.mkdir(parents=True, exist_ok=True)
+    images, frames = (1, spec.frames) if multiframe else (spec.images, 1)
+    size = 0
+    for image in range(images):
+        ds = Dataset()
+        ds.file_meta = FileMetaDataset()
+        ds.file_meta.MediaStorageSOPClassUID = modality.sop_class_uid
+        ds.file_meta.MediaStorageSOPInstanceUID = _uid(
+            spec, "image", patient, study, series, image
+        )
+        ds.file_meta.TransferSyntaxUID = SYNTAX_UIDS[CohortSyntax.explicit]
+        ds.file_meta.ImplementationClassUID = PYDICOM_IMPLEMENTATION_UID
+        ds.SOPClassUID = modality.sop_class_uid
+        ds.SOPInstanceUID = ds.file_meta.MediaStorageSOPInstanceUID
+        ds.ImageType = ["ORIGINAL", "PRIMARY"]
+        ds.StudyDate = ds.SeriesDate = ds.ContentDate = study_date
+        ds.StudyTime = ds.SeriesTime = ds.ContentTime = "101500"
+        ds.AccessionNumber = accession
+        ds.Modality = modality_name
+        ds.Manufacturer = "Lethe"
+        ds.InstitutionName = "General Hospital"
+        ds.ReferringPhysicianName = physician
+        ds.StudyDescription = "Benchmark study"
+        ds.SeriesDescription = f"Benchmark {modality_name} series"
+        ds.PatientName = f"{last}^{first}"
+        ds.PatientID = patient_id
+        ds.PatientBirthDate = birth_date
+        ds.PatientSex = "F" if patient % 2 else "M"
+        ds.StudyInstanceUID = study_uid
+        ds.SeriesInstanceUID = series_uid
+        ds.StudyID = f"{study + 1}"
+        ds.SeriesNumber = series + 1
+        ds.InstanceNumber = image + 1
+        ds.BurnedInAnnotation = "YES" if burned_in else "NO"
+        ds.SamplesPerPixel = 3 if modality.photometric == "RGB" else 1
+        ds.PhotometricInterpretation = modality.photometric
+        if ds.SamplesPerPixel == 3:
+            ds.PlanarConfiguration = 0
+        ds.Rows = ds.Columns = spec.size
+        ds.BitsAllocated = 8 if modality.bits_stored <= 8 else 16
+        ds.BitsStored = modality.bits_stored
+        ds.HighBit = modality.bits_stored - 1
+        ds.PixelRepresentation = 0
+        if modality_name == "CT":
+            ds.RescaleIntercept, ds.RescaleSlope = -1024, 1
+            ds.WindowCenter, ds.WindowWidth = 40, 400
+        pixels = []
+        for frame in range(frames):
+            number = image + frame + 1
+            text = None
+            if burned_in:
+                text = _text_mask(
+                    spec.size,
+                    [
+                        f"{last.upper()}^{first.upper()}",
+                        f"ID: {patient_id}",
+                        f"DOB: {birth_date[6:]}/{birth_date[4:6]}/{birth_date[:4]}",
+                        f"{study_date[:4]}-{study_date[4:6]}-{study_date[6:]}",
+                        ds.InstitutionName,
+                    ],
+                    ["W:400 L:40", f"SE:{series + 1} IM:{number}"],
+                )
+            pixels.append(_pixels(rng, modality, spec.size, number, text))
+        arr = np.stack(pixels) if multiframe else pixels[0]
+        if multiframe:
+            ds.NumberOfFrames = frames
+        path = series_dir / f"{image + 1:04d}.dcm"
+        if syntax in UNCOMPRESSED_SYNTAXES:
+            ds.file_meta.TransferSyntaxUID = SYNTAX_UIDS[syntax]
+            ds.PixelData = arr.tobytes()
+        else:
+            ds.compress(SYNTAX_UIDS[syntax], arr, generate_instance_uid=False)
+        ds.save_as(path, enforce_file_format=True)
+        size += path.stat().st_size
+    return size
+
+
+def _write_csvs(output_dir: Path, spec: CohortSpec) -> tuple[int, int]:
+    """
+    Writes the clinical CSV (of about `csv_mb`, with a row per visit of each patient) and
+    the CSV of the studies, returning their number and total size
+    """
+    import numpy as np
+
+    rng = np.random.default_rng(spec.seed)
+    target = int(spec.csv_mb * MB)
+    clinical_file = output_dir / CLINICAL_CSV
+    with open(clinical_file, "w", newline="") as fp:
+        fp.write("PatientID,Visit,Age,Sex,Weight,Diagnosis,Notes\n")
+        written, visit = 0, 0
+        while written < target and spec.patients:
+            rows = []
+            for patient in range(spec.patients):
+                rows.append(
+                    f"{_patient_id(patient)},{visit + 1},{int(rng.integers(20, 90))},"
+                    f"{'F' if patient % 2 else 'M'},{rng.normal(75, 12):.1f},"
+                    f"{DIAGNOSES[int(rng.integers(len(DIAGNOSES)))]},"
+                    f"follow-up visit {visit + 1} of patient {patient + 1}\n"
+                )
+            chunk = "".join(rows)
+            fp.write(chunk)
+            written += len(chunk)
+            visit += 1
+    studies_file = output_dir / STUDIES_CSV
+    with open(studies_file, "w", newline="") as fp:
+        fp.write("PatientID,StudyInstanceUID,Timepoint\n")
+        for patient in range(spec.patients):
+            for study in range(spec.studies):
+                study_uid = _uid(spec, "study", patient, study)
+                fp.write(f"{_patient_id(patient)},{study_uid},{study + 1}\n")
+    return 2, clinical_file.stat().st_size + studies_file.stat().st_size
+
+
+def generate_cohort(
+    output_dir: Path,
+    csv_dir: Path,
+    spec: CohortSpec,
+    *,
+    workers: int = DEFAULT_CPU_THREADS,
+) -> CohortInfo:
+    """
+    Generates the synthetic cohort of `spec`: the DICOM files in Patient / Study / Series
+    folders of `output_dir`, and the clinical CSVs in `csv_dir`. The same spec always
+    gives the same cohort. The series are written by a pool of `workers` processes.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    spec.check()
+    output_dir.mkdir(parents=True, exist_ok=True)
+    csv_dir.mkdir(parents=True, exist_ok=True)
+    series_per_study = spec.series + spec.multiframe_series
+    tasks = [
+        (patient, study, series)
+        for patient in range(spec.patients)
+        for study in range(spec.studies)
+        for series in range(series_per_study)
+    ]
+    logger.info(f"Generating {len(tasks)} series of the benchmark cohort")
+    with ProcessPoolExecutor(
+        max_workers=max(1, workers), mp_context=multiprocessing.get_context("fork")
+    ) as executor:
+        sizes = list(
+            executor.map(partial(_write_series, output_dir, spec), *zip(*tasks))
+            if tasks
+            else []
+        )
+    csv_files, csv_bytes = _write_csvs(csv_dir, spec)
+    return CohortInfo(
+        files=spec.patients
+        * spec.studies
+        * (spec.series * spec.images + spec.multiframe_series),
+        bytes=sum(sizes),
+        patients=spec.patients,
+        studies=spec.patients * spec.studies,
+        series=len(tasks),
+        csv_files=csv_files,
+        csv_bytes=csv_bytes,
+    )
+
+
+def _dicom_files(directory: Path) -> tuple[int, int]:
+    """The number and total size of the files in `directory`, except the root CSVs"""
+    files = size = 0
+    for path in directory.rglob("*"):
+        if not path.is_file() or (path.parent == directory and path.suffix == ".csv"):
+            continue
+        files += 1
+        size += path.stat().st_size
+    return files, size
+
+
+def _csv_files(directory: Path) -> tuple[int, int]:
+    paths = list(directory.glob("*.csv"))
+    return len(paths), sum(p.stat().st_size for p in paths)
+
+
+def _pss(pid: int) -> int | None:
+    """The PSS (in bytes) of a process, if the kernel reports it"""
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                if line.startswith("Pss:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def _process_tree_pss(pid: int) -> int:
+    """
+    The total PSS (in bytes) of a process and all its descendants (Linux only), or their
+    RSS for the processes whose PSS cannot be read
+    """
+    children: dict[int, list[int]] = {}
+    rss: dict[int, int] = {}
+    for entry in os.scandir("/proc"):
+        if not entry.name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry.name}/stat") as f:
+                # The command in parentheses may contain spaces
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        child = int(entry.name)
+        children.setdefault(int(fields[1]), []).append(child)
+        rss[child] = int(fields[21])
+    page_size = os.sysconf("SC_PAGE_SIZE")
+    total, pending = 0, [pid]
+    while pending:
+        p = pending.pop()
+        if p in rss:
+            pss = _pss(p)
+            total += pss if pss is not None else rss[p] * page_size
+        pending.extend(children.get(p, []))
+    return total
+
+
+def _run_stage_process(function: Callable[[], object], conn) -> None:
+    import traceback
+
+    error = None
+    try:
+        function()
+    except BaseException as e:
+        # Including the SystemExit of the stages that exit on errors
+        logger.error(traceback.format_exc())
+        error = f"{type(e).__name__}: {e}"
+    # The peak RSS of this process and of the largest of its (waited) children, for
+    # the systems without /proc
+    peak = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    conn.send((error, peak * 1024))
+    conn.close()
+
+
+def measure_stage(
+    name: str, function: Callable[[], object], files: int, size: int
+) -> StageResult:
+    """
+    Runs a stage in a forked process, measuring its wall time, CPU time and peak memory,
+    with the throughput of its input (`files` of `size` bytes)
+    """
+    context = multiprocessing.get_context("fork")
+    receiver, sender = context.Pipe(duplex=False)
+    children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.perf_counter()
+    process = context.Process(target=_run_stage_process, args=(function, sender))
+    process.start()
+    sender.close()
+    peak = 0
+    sample = Path("/proc").is_dir()
+    while process.is_alive():
+        if sample:
+            peak = max(peak, _process_tree_pss(process.pid))
+        process.join(SAMPLE_INTERVAL)
+    seconds = time.perf_counter() - start
+    children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    if receiver.poll():
+        error, process_peak = receiver.recv()
+    else:
+        error, process_peak = f"The process exited with code {process.exitcode}", 0
+    # The stage process and all its descendants have been waited for
+    cpu_seconds = (
+        children_after.ru_utime
+        - children_before.ru_utime
+        + children_after.ru_stime
+        - children_before.ru_stime
+    )
+    result = StageResult(
+        name=name,
+        files=files,
+        mb=round(size / MB, 3),
+        seconds=round(seconds, 3),
+        files_per_second=round(files / seconds, 3),
+        mb_per_second=round(size / MB / seconds, 3),
+        peak_pss_mb=round((peak or process_peak) / MB, 1),
+        cpu_seconds=round(cpu_seconds, 3),
+        cpu_cores=round(cpu_seconds / seconds, 2),
+        cpu_utilisation=round(cpu_seconds / seconds / (os.cpu_count() or 1), 3),
+        error=error,
+    )
+    logger.info(
+        f"{name}: {result.seconds} s, {result.files_per_second} files/s, "
+        f"{result.mb_per_second} MB/s, {result.peak_pss_mb} MB peak PSS, "
+        f"{result.cpu_cores} CPUs" + (f", failed: {error}" if error else "")
+    )
+    return result
+
+
+class Stage(NamedTuple):
+    name: str
+    function: Callable[[], object]
+    # The directory whose files are the input of the stage
+    input_dir: Path
+    # The stage that writes its input, if any
+    after: str | None = None
+    # Whether the input is the clinical CSVs (instead of the DICOM files)
+    csv: bool = False
+
+
+def _series_information(input_dir: Path, threads: int) -> None:
+    from .dicom_utils import series_information
+
+    list(series_information(input_dir, threads=threads))
+
+
+def _jsonable(value: object) -> object:
+    if isinstance(value, Enum):
+        return value.value
+    if isinstance(value, Path):
+        return str(value)
+    if isinstance(value, list):
+        return [_jsonable(v) for v in value]
+    return value
+
+
+def run_benchmark(
+    work_dir: Path,
+    *,
+    spec: CohortSpec | None = None,
+    input_dir: Path | None = None,
+    anon_script: Path,
+    site_id: str,
+    secret_key: str,
+    ocr: bool = False,
+    paddle_ocr: bool = False,
+    native: bool = False,
+    threads: int = DEFAULT_CPU_THREADS,
+    ocr_workers: int = DEFAULT_OCR_WORKERS,
+    ocr_options: dict | None = None,
+    organize_options: dict | None = None,
+) -> dict:
+    """
+    Runs the stages of the pipeline on the cohort of `spec` (generated in `work_dir`) or
+    on an existing cohort in `input_dir` (with its clinical CSVs in it, as for `run`),
+    writing the output of each stage in `work_dir`,
+    and returns the report. The `ocr_options` and `organize_options` are passed to
+    `perform_ocr` and `copy_and_organize`. A stage whose input stage failed is not run.
+    """
+    from .dcm_deidentify import run_ctp
+    from .hash_clinical import hash_clinical_csvs
+    from .native_deidentify import run_native
+    from .output_dir import copy_and_organize
+    from .version import __version__
+
+    ocr_options = ocr_options or {}
+    organize_options = organize_options or {}
+    report: dict = {
+        "version": __version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "settings": {
+            "ocr": "paddle" if paddle_ocr else "tesseract" if ocr else "",
+            "engine": "native" if native else "ctp",
+            "threads": threads,
+            "ocr_workers": ocr_workers,
+            **{k: _jsonable(v) for k, v in ocr_options.items()},
+            **{k: _jsonable(v) for k, v in organize_options.items()},
+        },
+    }
+    if input_dir is None:
+        if spec is None:
+            raise ValueError("Either the spec of a cohort or its directory is needed")
+        input_dir = work_dir / "cohort"
+        csv_dir = work_dir / "clinical"
+        for directory in (input_dir, csv_dir):
+            shutil.rmtree(directory, ignore_errors=True)
+        start = time.perf_counter()
+        cohort = generate_cohort(input_dir, csv_dir, spec, workers=threads)
+        report["cohort"] = {
+            "spec": {k: _jsonable(v) for k, v in asdict(spec).items()},
+            **cohort._asdict(),
+            "generation_seconds": round(time.perf_counter() - start, 3),
+        }
+    else:
+        csv_dir = input_dir
+        files, size = _dicom_files(input_dir)
+        csv_files, csv_bytes = _csv_files(input_dir)
+        report["cohort"] = {
+            "input_dir": str(input_dir),
+            "files": files,
+            "bytes": size,
+            "csv_files": csv_files,
+            "csv_bytes": csv_bytes,
+        }
+
+    ocr_dir = work_dir / "ocr"
+    anonymize_dir = work_dir / "anonymize"
+    output_dir = work_dir / "output"
+    for directory in (ocr_dir, anonymize_dir, output_dir):
+        shutil.rmtree(directory, ignore_errors=True)
+    output_dir.mkdir()
+
+    stages = [
+        Stage(
+            "series_information",
+            partial(_series_information, input_dir, threads),
+            input_dir,
+        )
+    ]
+    images_dir, images_stage = input_dir, None
+    if ocr or paddle_ocr:
+        from .ocr_deidentify import perform_ocr
+
+        stages.append(
+            Stage(
+                "ocr",
+                partial(
+                    perform_ocr,
+                    input_dir,
+                    ocr_dir,
+                    paddle_ocr,
+                    False,
+                    threads,
+                    workers=ocr_workers,
+                    **ocr_options,
+                ),
+                input_dir,
+            )
+        )
+        images_dir, images_stage = ocr_dir, "ocr"
+    anonymize_options = {
+        "input_dir": images_dir,
+        "output_dir": anonymize_dir,
+        "anon_script": anon_script,
+        "site_id": site_id,
+        "pepper": secret_key,
+        "threads": threads,
+    }
+    anonymize = run_native if native else run_ctp
+    stages += [
+        Stage(
+            anonymize.__name__,
+            partial(anonymize, **anonymize_options),
+            images_dir,
+            images_stage,
+        ),
+        Stage(
+            "copy_and_organize",
+            partial(
+                copy_and_organize,
+                anonymize_dir,
+                output_dir,
+                threads=threads,
+                **organize_options,
+            ),
+            anonymize_dir,
+            anonymize.__name__,
+        ),
+        Stage(
+            "hash_clinical_csvs",
+            partial(
+                hash_clinical_csvs,
+                csv_dir,
+                output_dir,
+                secret_key=secret_key,
+                workers=threads,
+            ),
+            csv_dir,
+            csv=True,
+        ),
+    ]
+
+    results: list[StageResult] = []
+    failed: list[str] = []
+    for stage in stages:
+        if stage.csv:
+            files, size = _csv_files(stage.input_dir)
+        else:
+            files, size = _dicom_files(stage.input_dir)
+        if stage.after in failed:
+            result = StageResult(
+                name=stage.name,
+                files=files,
+                mb=round(size / MB, 3),
+                error=f"Not run, since {stage.after} failed",
+            )
+        else:
+            logger.info(f"Running {stage.name} on {files} files")
+            result = measure_stage(stage.name, stage.function, files, size)
+        if result.error:
+            failed.append(stage.name)
+        results.append(result)
+
+    report["stages"] = [asdict(r) for r in results]
+    report["total"] = {
+        "seconds": round(sum(r.seconds for r in results), 3),
+        "cpu_seconds": round(sum(r.cpu_seconds for r in results), 3),
+        "peak_pss_mb": max(r.peak_pss_mb for r in results),
+        "failed_stages": failed,
+    }
+    return report
@@ -0,0 +1,168 @@
+"""
+A persistent, content addressed cache of the files produced by the pipeline stages, so that
+re-runs over (mostly) the same input can skip the files that were already processed.
+
+Each cached file is stored under a key that is computed by hashing the contents of the input
+file together with everything else that affects the output of a stage (e.g. the secret key,
+the anonymization script, the OCR configuration). The total size of the cache is bounded and
+the least recently used entries are evicted when it is exceeded.
+"""
+
+import os
+import shutil
+import sqlite3
+import time
+from hashlib import file_digest, sha256
+from pathlib import Path
+
+from loguru import logger
+
+from .version import __version__
+
+# When the cache is full, the least recently used files are evicted until its size is
+# below this fraction of the maximum size, so that not every `put` has to evict
+EVICT_TO_RATIO = 0.9
+# The number of entries that are read from the database at a time when evicting
+EVICT_BATCH = 256
+
+# The total size of the entries is kept up to date by triggers, so that it is not
+# summed on every `put`. It is computed once when the table is created (e.g. for a cache
+# that was created by an older version)
+_SCHEMA = """
+BEGIN IMMEDIATE;
+CREATE TABLE IF NOT EXISTS entries
+    (key TEXT PRIMARY KEY, size INTEGER NOT NULL, last_used REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used);
+CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL);
+INSERT OR IGNORE INTO meta
+    SELECT 'total_size', COALESCE(SUM(size), 0) FROM entries;
+CREATE TRIGGER IF NOT EXISTS entries_insert AFTER INSERT ON entries BEGIN
+    UPDATE meta SET value = value + NEW.size WHERE name = 'total_size';
+END;
+CREATE TRIGGER IF NOT EXISTS entries_update AFTER UPDATE OF size ON entries BEGIN
+    UPDATE meta SET value = value + NEW.size - OLD.size WHERE name = 'total_size';
+END;
+CREATE TRIGGER IF NOT EXISTS entries_delete AFTER DELETE ON entries BEGIN
+    UPDATE meta SET value = value - OLD.size WHERE name = 'total_size';
+END;
+COMMIT;
+"""
+
+
+def file_hash(path: Path) -> str:
+    """Returns the SHA-256 hex digest of the contents of the given file"""
+    with open(path, "rb") as f:
+        return file_digest(f, "sha256").hexdigest()
+
+
+def cache_key(*parts: str) -> str:
+    """
+    Combines the given parts (e.g. the content hash of a file, the secret key, etc.) into a
+    single cache key. The version of Lethe is always included, so that upgrading invalidates
+    the cached entries.
+    """
+    h = sha256(__version__.encode())
+    for part in parts:
+        h.update(b"\0")
+        h.update(part.encode())
+    return h.hexdigest()
+
+
+class FileCache:
+    """
+    An on-disk cache of files indexed by a (content based) key.
+
+    The files are kept in the `objects` subfolder of the cache directory while a SQLite
+    database keeps their sizes and last access times to support the LRU eviction. The
+    cache can be used concurrently by multiple (worker) processes: a `FileCache` can be
+    pickled and passed to a worker, where it opens its own connection to the database.
+    """
+
+    def __init__(self, cache_dir: Path, max_size: int):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.objects_dir = cache_dir / "objects"
+        self.objects_dir.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(
+            os.fspath(cache_dir / "index.sqlite"), timeout=60, isolation_level=None
+        )
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(_SCHEMA)
+
+    def __getstate__(self):
+        return {"cache_dir": self.cache_dir, "max_size": self.max_size}
+
+    def __setstate__(self, state):
+        self.__init__(state["cache_dir"], state["max_size"])
+
+    def _object_path(self, key: str) -> Path:
+        return self.objects_dir / key[:2] / key
+
+    def get(self, key: str, dest: Path) -> bool:
+        """
+        Copies the cached file with the given key to `dest`.
+        Returns False if there's no such file in the cache.
+        """
+        path = self._object_path(key)
+        try:
+            shutil.copyfile(path, dest)
+        except FileNotFoundError:
+            return False
+        self.db.execute(
+            "UPDATE entries SET last_used = ? WHERE key = ?", (time.time(), key)
+        )
+        return True
+
+    def put(self, key: str, src: Path) -> None:
+        """Stores a copy of the `src` file in the cache under the given key"""
+        path = self._object_path(key)
+        path.parent.mkdir(exist_ok=True)
+        # Copy to a temporary file first and then rename it, so that concurrent readers
+        # never see a partially written file:
+        tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+        shutil.copyfile(src, tmp_path)
+        os.replace(tmp_path, path)
+        # An upsert (instead of a replace, i.e. a delete and an insert) so that the
+        # triggers keep the total size right
+        self.db.execute(
+            "INSERT INTO entries (key, size, last_used) VALUES (?, ?, ?) "
+            "ON CONFLICT (key) DO UPDATE SET "
+            "size = excluded.size, last_used = excluded.last_used",
+            (key, path.stat().st_size, time.time()),
+        )
+        self.evict()
+
+    def total_size(self) -> int:
+        (total,) = self.db.execute(
+            "SELECT value FROM meta WHERE name = 'total_size'"
+        ).fetchone()
+        return total
+
+    def evict(self) -> None:
+        """
+        Removes the least recently used files, if the cache does not fit in `max_size`,
+        until it fits in `EVICT_TO_RATIO` of it
+        """
+        total = self.total_size()
+        if total <= self.max_size:
+            return
+        target = self.max_size * EVICT_TO_RATIO
+        evicted = 0
+        while total > target:
+            entries = self.db.execute(
+                "SELECT key, size FROM entries ORDER BY last_used LIMIT ?",
+                (EVICT_BATCH,),
+            ).fetchall()
+            if not entries:
+                break
+            for key, size in entries:
+                if total <= target:
+                    break
+                self._object_path(key).unlink(missing_ok=True)
+                self.db.execute("DELETE FROM entries WHERE key = ?", (key,))
+                total -= size
+                evicted += 1
+        logger.debug(f"Evicted {evicted} file(s) from the cache")
+
+    def close(self) -> None:
+        self.db.close()
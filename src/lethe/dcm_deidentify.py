@@ -1,27 +1,123 @@
+import os
+import re
+import shutil
 import subprocess
-from collections import namedtuple
+import tempfile
+import threading
+from collections import Counter, defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from hashlib import sha256
 from pathlib import Path
+from typing import Callable, Iterable
+from uuid import uuid4
 
 from loguru import logger
+from tqdm import tqdm
 
+from .cache import FileCache, cache_key, file_hash
 from .defaults import DEFAULT_UIDROOT
+from .dicom_utils import read_headers, walk_files
 
-CTPResults = namedtuple("CTPResults", ["elapsed_time", "processed_count"])
+CTPResults = namedtuple(
+    "CTPResults", ["elapsed_time", "processed_count", "skipped_count", "failed_count"]
+)
 
+# The result of the anonymization of a single input file by CTP. The `status` is one
+# of "anonymized", "skipped" (e.g. not a DICOM file) or "failed"
+CTPFileResult = namedtuple("CTPFileResult", ["input", "output", "status", "error"])
 
-def _process_ctp_output(lines: list[str]) -> CTPResults:
-    elapsed_time = 0
-    processed_count = 0
-    for line in lines:
+# How many times a CTP shard is run, if its DAT.jar process fails
+CTP_SHARD_ATTEMPTS = 3
+
+_ANONYMIZING_RE = re.compile(r"Anonymizing (.+)$")
+_ANONYMIZED_RE = re.compile(r"Anonymized file: (.+)$")
+_SKIPPING_RE = re.compile(r"Skipping non-(?:matching )?DICOM file: (.+)$")
+_FAILURE_RE = re.compile(
+    r"(The DICOM(?:Pixel)?Anonymizer returned .*|Anonymization failed.*"
+    r"|Decompression failure.*)$"
+)
+
+
+class _CTPOutputParser:
+    """
+    Parses the output of DAT.jar line by line, as it is produced, and reports a
+    `CTPFileResult` for each input file. Only the files currently being processed
+    are kept in memory, so the memory used does not depend on the size of the output.
+
+    DAT.jar keeps the relative paths of the input files in the output directory,
+    which is used to match the anonymized files with their inputs. The files are
+    reported under the `input_base` and `output_base` folders (when CTP runs on a
+    "staging" folder of links to the real input files). The messages of the files
+    processed in parallel may be interleaved, so an error message can be attributed
+    to a file only when it is the single one being processed.
+    """
+
+    def __init__(
+        self,
+        input_dir: Path,
+        output_dir: Path,
+        on_result: Callable[[CTPFileResult], None],
+        *,
+        input_base: Path | None = None,
+        output_base: Path | None = None,
+    ):
+        self.input_dir = input_dir.absolute()
+        self.output_dir = output_dir.absolute()
+        self.input_base = input_base or self.input_dir
+        self.output_base = output_base or self.output_dir
+        self.on_result = on_result
+        self.pending: dict[Path, str | None] = {}
+        self.stats: Counter[str] = Counter()
+        self.elapsed_time = 0.0
+
+    def _report(self, rel_path: Path, status: str, error: str | None = None) -> None:
+        self.stats[status] += 1
+        output = self.output_base / rel_path if status == "anonymized" else None
+        self.on_result(CTPFileResult(self.input_base / rel_path, output, status, error))
+
+    def _relative(self, path: str, base: Path) -> Path:
+        try:
+            return Path(path).relative_to(base)
+        except ValueError:
+            return Path(path)
+
+    def feed(self, line: str) -> None:
+        line = line.strip()
         if line.startswith("Elapsed time:"):
-            elapsed_time = float(line.strip().split(":")[1].strip())
-        elif "Anonymized file" in line:
-            processed_count += 1
-    return CTPResults(elapsed_time, processed_count)
+            self.elapsed_time = float(line.split(":")[1].strip())
+        elif m := _ANONYMIZED_RE.search(line):
+            rel_path = self._relative(m.group(1), self.output_dir)
+            self.pending.pop(rel_path, None)
+            self._report(rel_path, "anonymized")
+        elif m := _ANONYMIZING_RE.search(line):
+            self.pending[self._relative(m.group(1), self.input_dir)] = None
+        elif m := _SKIPPING_RE.search(line):
+            rel_path = self._relative(m.group(1), self.input_dir)
+            self.pending.pop(rel_path, None)
+            self._report(rel_path, "skipped", m.group(0).split(":")[0])
+        elif m := _FAILURE_RE.search(line):
+            if len(self.pending) == 1:
+                (rel_path,) = self.pending
+                self.pending[rel_path] = m.group(1)
 
+    def close(self) -> CTPResults:
+        """Reports the files that were not anonymized as failed"""
+        for rel_path, error in self.pending.items():
+            self._report(rel_path, "failed", error or "No output from CTP")
+        self.pending.clear()
+        return CTPResults(
+            self.elapsed_time,
+            self.stats["anonymized"],
+            self.stats["skipped"],
+            self.stats["failed"],
+        )
 
-def run_ctp(
+
+def _count_files(input_dir: Path) -> int:
+    return sum(len(files) for _, _, files in os.walk(os.fspath(input_dir)))
+
+
+def _ctp_command(
     *,
     input_dir: Path,
     output_dir: Path,
@@ -29,10 +125,8 @@ def run_ctp(
     site_id: str,
     pepper: str,
     threads: int,
-) -> None:
-    # use the folder of the anon.script as the current working directory
-    cwd = anon_script.parent
-
+    heap: str | None,
+) -> list[str]:
     # To make more difficult the identification of the original provider given
     # the contents of the anonymized DICOM files, we hash the "site id" and add
     # its hex digest as the "provider id" in the result DICOM images. We are using
@@ -44,8 +138,10 @@ def run_ctp(
     #
     providerId = sha256(site_id.encode()).hexdigest()
 
-    cmd = [
-        "java",
+    cmd = ["java"]
+    if heap:
+        cmd.append(f"-Xmx{heap}")
+    cmd += [
         "-jar",
         "DAT.jar",
         "-n",
@@ -63,16 +159,369 @@ def run_ctp(
         "-out",
         str(output_dir.absolute()),
     ]
-    logger.info("Running CTP command, output will be saved to {}".format(output_dir))
+    return cmd
+
+
+def _run_dat(
+    cmd: list[str],
+    *,
+    cwd: Path,
+    input_dir: Path,
+    output_dir: Path,
+    progress: tqdm,
+    on_result: Callable[[CTPFileResult], None] | None,
+    input_base: Path | None = None,
+    output_base: Path | None = None,
+) -> tuple[CTPResults, int]:
+    """
+    Runs the DAT.jar `cmd`, parsing its output while it runs. Returns the results
+    and the exit code of the process.
+    """
+
+    def report(result: CTPFileResult) -> None:
+        progress.update()
+        if result.status == "failed":
+            logger.warning(f"CTP failed to anonymize {result.input}: {result.error}")
+        if on_result is not None:
+            on_result(result)
+
+    parser = _CTPOutputParser(
+        input_dir,
+        output_dir,
+        report,
+        input_base=input_base,
+        output_base=output_base,
+    )
     process = subprocess.Popen(
-        cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=cwd
+        cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        cwd=cwd,
+        text=True,
+        errors="replace",
     )
-    output, err = process.communicate()
-    results = _process_ctp_output(output.decode("utf-8").splitlines())
-    for line in err.decode("utf-8").splitlines():
-        print(f"CTP ERROR: {line}")
+
+    def print_errors() -> None:
+        for line in process.stderr:
+            progress.write(f"CTP ERROR: {line.rstrip()}")
+
+    # The stderr is consumed in parallel so that CTP never blocks on a full pipe:
+    stderr_thread = threading.Thread(target=print_errors, daemon=True)
+    stderr_thread.start()
+    for line in process.stdout:
+        parser.feed(line)
+    process.wait()
+    stderr_thread.join()
+    return parser.close(), process.returncode
+
+
+def _log_results(results: CTPResults) -> None:
     logger.info(
-        "CTP command completed, elapsed time: {} seconds, files anonymized: {}".format(
-            results.elapsed_time, results.processed_count
+        f"CTP command completed, elapsed time: {results.elapsed_time} seconds, "
+        f"files anonymized: {results.processed_count}, skipped: "
+        f"{results.skipped_count}, failed: {results.failed_count}"
+    )
+
+
+def run_ctp(
+    *,
+    input_dir: Path,
+    output_dir: Path,
+    anon_script: Path,
+    site_id: str,
+    pepper: str,
+    threads: int,
+    cache: FileCache | None = None,
+    on_result: Callable[[CTPFileResult], None] | None = None,
+    shards: int = 1,
+    heap: str | None = None,
+    skip: Callable[[Path], bool] | None = None,
+) -> CTPResults | None:
+    """
+    Runs the RSNA CTP anonymizer (DAT.jar) on the files of the `input_dir`. The output
+    of CTP is parsed while it runs to show the progress and to report the result of
+    each file to the `on_result` callback (if given); the failed files are logged.
+
+    If `shards` is more than 1, the input files are split by patient into `shards`
+    parts that are anonymized by as many concurrent DAT.jar processes, which share
+    the `threads`. The maximum Java heap size of each process can be set with `heap`
+    (e.g. "4g").
+
+    The input files for which `skip` returns True are not anonymized (e.g. files
+    already anonymized by an interrupted run).
+    """
+    if cache is not None:
+        _run_ctp_cached(
+            input_dir=input_dir,
+            output_dir=output_dir,
+            anon_script=anon_script,
+            site_id=site_id,
+            pepper=pepper,
+            threads=threads,
+            cache=cache,
+            on_result=on_result,
+            shards=shards,
+            heap=heap,
+            skip=skip,
+        )
+        return None
+    if shards > 1 or skip is not None:
+        return _run_ctp_staged(
+            (
+                Path(p)
+                for p in walk_files(input_dir)
+                if skip is None or not skip(Path(p))
+            ),
+            input_dir=input_dir,
+            output_dir=output_dir,
+            anon_script=anon_script,
+            site_id=site_id,
+            pepper=pepper,
+            threads=threads,
+            on_result=on_result,
+            shards=shards,
+            heap=heap,
+        )
+
+    cmd = _ctp_command(
+        input_dir=input_dir,
+        output_dir=output_dir,
+        anon_script=anon_script,
+        site_id=site_id,
+        pepper=pepper,
+        threads=threads,
+        heap=heap,
+    )
+    total = _count_files(input_dir)
+    logger.info(
+        f"Running CTP command for {total} files, output will be saved to {output_dir}"
+    )
+    with tqdm(total=total, unit="file", desc="CTP") as progress:
+        # use the folder of the anon.script as the current working directory
+        results, returncode = _run_dat(
+            cmd,
+            cwd=anon_script.parent,
+            input_dir=input_dir,
+            output_dir=output_dir,
+            progress=progress,
+            on_result=on_result,
+        )
+    _log_results(results)
+    if returncode != 0:
+        logger.error(f"CTP exited with code {returncode}")
+    return results
+
+
+def _partition_by_patient(
+    files: Iterable[Path], shards: int, threads: int
+) -> list[list[Path]]:
+    """
+    Splits the `files` into (at most) `shards` parts, so that all the files of a patient
+    are in the same part and the parts have about the same number of files. Files
+    that are not DICOM are treated as belonging to the same "empty" patient.
+    """
+    by_patient: dict[str, list[Path]] = defaultdict(list)
+    for result in read_headers(
+        (os.fspath(f) for f in files), ["PatientID"], threads=threads
+    ):
+        ds = result.dataset
+        patient_id = str(ds.get("PatientID", "")) if ds is not None else ""
+        by_patient[patient_id].append(Path(result.path))
+    partitions: list[list[Path]] = [[] for _ in range(shards)]
+    # Assign the largest patients first, each to the smallest part so far:
+    for patient_id in sorted(by_patient, key=lambda p: (-len(by_patient[p]), p)):
+        smallest = min(partitions, key=len)
+        smallest.extend(by_patient[patient_id])
+    return [p for p in partitions if p]
+
+
+def _merge_dir(src_dir: Path, dest_dir: Path) -> None:
+    """Moves the files of `src_dir` to the same relative paths in the `dest_dir`"""
+    for root, dirs, files in os.walk(os.fspath(src_dir)):
+        for file in files:
+            src_path = Path(root) / file
+            dest_path = dest_dir / src_path.relative_to(src_dir)
+            dest_path.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(src_path, dest_path)
+
+
+def _run_ctp_staged(
+    files: Iterable[Path],
+    *,
+    input_dir: Path,
+    output_dir: Path,
+    anon_script: Path,
+    site_id: str,
+    pepper: str,
+    threads: int,
+    on_result: Callable[[CTPFileResult], None] | None,
+    shards: int,
+    heap: str | None,
+) -> CTPResults:
+    """
+    Runs CTP on the given `files` of the `input_dir`, which are linked into "staging"
+    directories, one for each of the `shards` DAT.jar processes that run concurrently.
+    Each process writes to its own output directory and a shard is retried if its
+    process fails (e.g. runs out of memory). The outputs of the successful shards are
+    moved to the `output_dir`, keeping the relative paths of the input files.
+    """
+    if shards > 1:
+        partitions = _partition_by_patient(files, shards, threads)
+    else:
+        partitions = [list(files)]
+    if not partitions:
+        logger.warning(f"No files to be anonymized found in {input_dir}")
+        return CTPResults(0.0, 0, 0, 0)
+    shard_threads = max(1, threads // len(partitions))
+    total = sum(len(p) for p in partitions)
+    logger.info(
+        f"Running CTP for {total} files in {len(partitions)} shard(s), "
+        f"output will be saved to {output_dir}"
+    )
+    staging_dir = Path(tempfile.mkdtemp())
+    # The output of each shard is in the output directory, so that it can be moved
+    # (renamed) in its final place:
+    shards_output_dir = output_dir / f".lethe-ctp-{uuid4().hex}"
+    progress = tqdm(total=total, unit="file", desc="CTP")
+
+    def run_shard(shard: int, shard_files: list[Path]) -> CTPResults:
+        shard_input_dir = staging_dir / f"{shard}"
+        shard_output_dir = shards_output_dir / f"{shard}"
+        for file_path in shard_files:
+            staged_path = shard_input_dir / file_path.relative_to(input_dir)
+            staged_path.parent.mkdir(parents=True, exist_ok=True)
+            os.symlink(file_path.absolute(), staged_path)
+        cmd = _ctp_command(
+            input_dir=shard_input_dir,
+            output_dir=shard_output_dir,
+            anon_script=anon_script,
+            site_id=site_id,
+            pepper=pepper,
+            threads=shard_threads,
+            heap=heap,
         )
+        for attempt in range(1, CTP_SHARD_ATTEMPTS + 1):
+            # The results of an attempt are reported only if it succeeds, since the
+            # outputs of a failed one are removed:
+            attempt_results: list[CTPFileResult] = []
+            results, returncode = _run_dat(
+                cmd,
+                cwd=anon_script.parent,
+                input_dir=shard_input_dir,
+                output_dir=shard_output_dir,
+                progress=progress,
+                on_result=attempt_results.append,
+                input_base=input_dir,
+                output_base=output_dir,
+            )
+            if returncode == 0:
+                break
+            logger.warning(
+                f"CTP shard {shard} failed with exit code {returncode} "
+                f"(attempt {attempt} of {CTP_SHARD_ATTEMPTS})"
+            )
+            # The files of the shard will be reported again:
+            progress.update(-sum(results[1:]))
+            shutil.rmtree(shard_output_dir, ignore_errors=True)
+        else:
+            logger.error(
+                f"CTP shard {shard} failed, its {len(shard_files)} files are not "
+                "anonymized"
+            )
+            error = f"CTP failed with exit code {returncode}"
+            attempt_results = [
+                CTPFileResult(file_path, None, "failed", error)
+                for file_path in shard_files
+            ]
+            progress.update(len(shard_files))
+            results = CTPResults(results.elapsed_time, 0, 0, len(shard_files))
+        if on_result is not None:
+            for result in attempt_results:
+                on_result(result)
+        _merge_dir(shard_output_dir, output_dir)
+        return results
+
+    try:
+        with ThreadPoolExecutor(len(partitions)) as executor:
+            all_results = list(
+                executor.map(run_shard, range(len(partitions)), partitions)
+            )
+    finally:
+        progress.close()
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        shutil.rmtree(shards_output_dir, ignore_errors=True)
+    results = CTPResults(
+        max(r.elapsed_time for r in all_results),
+        *(sum(counts) for counts in zip(*(r[1:] for r in all_results))),
+    )
+    _log_results(results)
+    return results
+
+
+def _run_ctp_cached(
+    *,
+    input_dir: Path,
+    output_dir: Path,
+    anon_script: Path,
+    site_id: str,
+    pepper: str,
+    threads: int,
+    cache: FileCache,
+    on_result: Callable[[CTPFileResult], None] | None = None,
+    shards: int = 1,
+    heap: str | None = None,
+    skip: Callable[[Path], bool] | None = None,
+) -> None:
+    """
+    Runs CTP only for the input files that are not found in the `cache`. The cached
+    files are copied directly to the output directory while the rest are linked into
+    a "staging" directory that is given as input to CTP. CTP (DAT.jar) keeps the
+    relative paths of the input files, so we can then find and cache their outputs.
+    """
+    script_hash = file_hash(anon_script)
+    misses: list[tuple[Path, str]] = []
+    hits = 0
+    for root, dirs, files in os.walk(os.fspath(input_dir)):
+        for file in files:
+            file_path = Path(root) / file
+            if skip is not None and skip(file_path):
+                continue
+            rel_path = file_path.relative_to(input_dir)
+            key = cache_key(
+                "ctp",
+                file_hash(file_path),
+                pepper,
+                site_id,
+                DEFAULT_UIDROOT,
+                script_hash,
+            )
+            output_path = output_dir / rel_path
+            output_path.parent.mkdir(parents=True, exist_ok=True)
+            if cache.get(key, output_path):
+                hits += 1
+                if on_result is not None:
+                    on_result(CTPFileResult(file_path, output_path, "anonymized", None))
+                continue
+            misses.append((rel_path, key))
+    logger.info(
+        f"Found {hits} file(s) in the cache, {len(misses)} file(s) will be anonymized"
+    )
+    if not misses:
+        return
+    _run_ctp_staged(
+        (input_dir / rel_path for rel_path, _ in misses),
+        input_dir=input_dir,
+        output_dir=output_dir,
+        anon_script=anon_script,
+        site_id=site_id,
+        pepper=pepper,
+        threads=threads,
+        on_result=on_result,
+        shards=shards,
+        heap=heap,
     )
+    for rel_path, key in misses:
+        output_path = output_dir / rel_path
+        # CTP skips the non DICOM files, so there may be no output for them:
+        if output_path.is_file():
+            cache.put(key, output_path)
@@ -1,5 +1,30 @@
+import os
+
 DEFAULT_UIDROOT = "1.3.6.1.4.1.58108.2023"
 DEFAULT_PATIENT_ID_PREFIX = "EUCAIM-"
 DEFAULT_IGNORE_CSV_PREFIX = "_"
 DEFAULT_STUDIES_METADATA_CSV = "dcm_studies_metadata.csv"
 DEFAULT_CPU_THREADS = 10
+DEFAULT_OCR_WORKERS = 1
+DEFAULT_CACHE_MAX_SIZE = 50 * 1024**3  # 50 GiB
+DEFAULT_SCAN_THREADS = 16
+DEFAULT_INDEX_FILE = ".lethe_index.sqlite"
+DEFAULT_HASH_MEMO_SIZE = 200_000
+DEFAULT_OCR_SERIES_SAMPLES = 3
+DEFAULT_OCR_BATCH_SIZE = 1
+# In the runtime directory of the user, or else in a private directory (created by the
+# OCR server) in /tmp, never directly in a directory that others can write to
+DEFAULT_OCR_SOCKET = os.path.join(
+    os.environ.get("XDG_RUNTIME_DIR") or f"/tmp/lethe-ocr-{os.getuid()}",
+    "lethe-ocr.sock",
+)
+# The synthetic cohort of `lethe bench`
+DEFAULT_BENCH_PATIENTS = 10
+DEFAULT_BENCH_STUDIES = 1
+DEFAULT_BENCH_SERIES = 3
+DEFAULT_BENCH_IMAGES = 20
+DEFAULT_BENCH_MODALITIES = ["CT", "MR", "US"]
+DEFAULT_BENCH_IMAGE_SIZE = 512
+DEFAULT_BENCH_FRAMES = 30
+DEFAULT_BENCH_BURNED_IN_TEXT = 0.2
+DEFAULT_BENCH_CSV_MB = 1.0
@@ -0,0 +1,181 @@
+"""
+A persistent index (in a SQLite database) of the DICOM headers of the files in an input
+folder, so that the files are not opened and parsed again by each command that needs them.
+The index is updated incrementally: only new files or files whose size or modification
+time have changed are read again.
+"""
+
+import os
+import sqlite3
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Generator
+
+from loguru import logger
+
+from .defaults import DEFAULT_SCAN_THREADS
+from .dicom_utils import (
+    NOT_DICOM,
+    REQUIRED_TAGS,
+    DcmFileInfo,
+    SeriesInfo,
+    count_result,
+    parse_int,
+    read_headers,
+)
+
+INDEX_TAGS = [
+    "PatientID",
+    "StudyInstanceUID",
+    "SeriesInstanceUID",
+    "SOPInstanceUID",
+    "Modality",
+    "StudyDescription",
+    "SeriesDescription",
+    "InstanceNumber",
+]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    dir TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    is_dicom INTEGER NOT NULL,
+    patient_id TEXT,
+    study_uid TEXT,
+    series_uid TEXT,
+    sop_uid TEXT,
+    modality TEXT,
+    study_description TEXT,
+    series_description TEXT,
+    instance_number INTEGER,
+    transfer_syntax TEXT
+);
+CREATE INDEX IF NOT EXISTS files_dir ON files (dir);
+CREATE INDEX IF NOT EXISTS files_series ON files (patient_id, study_uid, series_uid);
+"""
+
+
+class DicomIndex:
+    """
+    The index of the DICOM files of the `input_dir`, kept in the `index_file`.
+    The paths are stored relative to the `input_dir`, so the index remains valid
+    if the input folder is mounted in a different place.
+    """
+
+    def __init__(self, index_file: Path, input_dir: Path):
+        self.index_file = index_file
+        self.input_dir = input_dir
+        self.db = sqlite3.connect(os.fspath(index_file))
+        self.db.executescript(_SCHEMA)
+
+    def update(self, *, threads: int = DEFAULT_SCAN_THREADS) -> None:
+        """Brings the index up to date with the contents of the input folder"""
+        time_start = time.time()
+        stats: Counter[str] = Counter()
+        changed: list[tuple[str, str, int, int]] = []
+        seen_dirs: set[str] = set()
+        # The index file (and its journal) may be in the input folder:
+        index_path = os.path.abspath(self.index_file)
+        for root, dirs, files in os.walk(os.fspath(self.input_dir), topdown=True):
+            rel_dir = os.path.relpath(root, self.input_dir)
+            seen_dirs.add(rel_dir)
+            indexed = {
+                path: (size, mtime)
+                for path, size, mtime in self.db.execute(
+                    "SELECT path, size, mtime FROM files WHERE dir = ?", (rel_dir,)
+                )
+            }
+            current = set()
+            for file in files:
+                if os.path.abspath(os.path.join(root, file)).startswith(index_path):
+                    continue
+                rel_path = os.path.normpath(os.path.join(rel_dir, file))
+                current.add(rel_path)
+                st = os.stat(os.path.join(root, file))
+                if indexed.get(rel_path) == (st.st_size, st.st_mtime_ns):
+                    stats["unchanged"] += 1
+                    continue
+                changed.append((rel_path, rel_dir, st.st_size, st.st_mtime_ns))
+            deleted = [(p,) for p in indexed.keys() - current]
+            self.db.executemany("DELETE FROM files WHERE path = ?", deleted)
+            stats["deleted"] += len(deleted)
+        for (rel_dir,) in self.db.execute("SELECT DISTINCT dir FROM files").fetchall():
+            if rel_dir not in seen_dirs:
+                cur = self.db.execute("DELETE FROM files WHERE dir = ?", (rel_dir,))
+                stats["deleted"] += cur.rowcount
+
+        paths = (os.path.join(self.input_dir, c[0]) for c in changed)
+        for (rel_path, rel_dir, size, mtime), result in zip(
+            changed, read_headers(paths, INDEX_TAGS, threads=threads)
+        ):
+            count_result(result, stats)
+            ds = result.dataset
+            if ds is None and result.error != NOT_DICOM:
+                # Files that failed to be read are not indexed, to be retried
+                self.db.execute("DELETE FROM files WHERE path = ?", (rel_path,))
+                continue
+            row = [rel_path, rel_dir, size, mtime, ds is not None]
+            if ds is not None and all(tag in ds for tag in REQUIRED_TAGS):
+                row += [
+                    ds.PatientID,
+                    ds.StudyInstanceUID,
+                    ds.SeriesInstanceUID,
+                    ds.get("SOPInstanceUID", ""),
+                    ds.get("Modality", ""),
+                    ds.get("StudyDescription", ""),
+                    ds.get("SeriesDescription", ""),
+                    parse_int(ds.get("InstanceNumber")),
+                    str(ds.file_meta.get("TransferSyntaxUID", "")),
+                ]
+            else:
+                row += [None] * 9
+            self.db.execute(
+                f"INSERT OR REPLACE INTO files VALUES ({','.join('?' * len(row))})",
+                row,
+            )
+        self.db.commit()
+        logger.info(
+            f"Updated the index {self.index_file} in {time.time() - time_start:.3f} "
+            f"seconds: {stats['unchanged']} files unchanged, {len(changed)} "
+            f"(re)indexed, {stats['deleted']} removed"
+        )
+
+    def dicom_files(self) -> Generator[Path, None, None]:
+        """The (absolute) paths of the indexed DICOM files, in path order"""
+        for (path,) in self.db.execute(
+            "SELECT path FROM files WHERE is_dicom ORDER BY path"
+        ):
+            yield self.input_dir / path
+
+    def file_infos(self) -> Generator[DcmFileInfo, None, None]:
+        for row in self.db.execute(
+            "SELECT path, patient_id, study_uid, series_uid, instance_number, sop_uid "
+            "FROM files WHERE patient_id IS NOT NULL ORDER BY path"
+        ):
+            yield DcmFileInfo(self.input_dir / row[0], *row[1:])
+
+    def series_information(self) -> list[SeriesInfo]:
+        return [
+            SeriesInfo(
+                patient_id=row[0],
+                study_uid=row[1],
+                series_uid=row[2],
+                series_description=row[3],
+                study_description=row[4],
+                modality=row[5],
+                image_count=row[6],
+            )
+            for row in self.db.execute(
+                "SELECT patient_id, study_uid, series_uid, MIN(series_description), "
+                "MIN(study_description), MIN(modality), COUNT(*) "
+                "FROM files WHERE patient_id IS NOT NULL "
+                "GROUP BY patient_id, study_uid, series_uid "
+                "ORDER BY patient_id, study_uid, series_uid"
+            )
+        ]
+
+    def close(self) -> None:
+        self.db.close()
@@ -1,12 +1,20 @@
 import os
-from collections import namedtuple
+from collections import Counter, deque, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
 from dataclasses import dataclass
+from io import BytesIO
 from pathlib import Path
-from typing import Generator, Iterable
+from typing import TYPE_CHECKING, Generator, Iterable
 
+from loguru import logger
 from pydicom import FileDataset, dcmread
 from sortedcontainers import SortedDict
 
+from .defaults import DEFAULT_INDEX_FILE, DEFAULT_SCAN_THREADS
+
+if TYPE_CHECKING:
+    from .dicom_index import DicomIndex
+
 DcmFileInfo = namedtuple(
     "DcmFileInfo",
     [
@@ -15,9 +23,44 @@ DcmFileInfo = namedtuple(
         "study_uid",
         "series_uid",
         "instance_number",
+        "sop_uid",
     ],
 )
 
+# The result of reading the header of a file: `dataset` is None if the file is not
+# DICOM or could not be read (and then `error` explains why)
+HeaderResult = namedtuple("HeaderResult", ["path", "dataset", "error"])
+
+# How many bytes to read from the start of a file for parsing its header. The
+# "interesting" tags are usually well within this prefix, otherwise the whole
+# header is read
+HEADER_PREFIX_SIZE = 64 * 1024
+
+NOT_DICOM = "Not a DICOM file"
+
+# The (little endian) tag of the Pixel Data, that marks the end of the header
+PIXEL_DATA_TAG_BYTES = b"\xe0\x7f\x10\x00"
+
+# The tags that every DICOM file should have, to be placed in a series
+REQUIRED_TAGS = ["PatientID", "StudyInstanceUID", "SeriesInstanceUID"]
+
+SERIES_INFO_TAGS = [
+    "PatientID",
+    "StudyInstanceUID",
+    "SeriesInstanceUID",
+    "SeriesDescription",
+    "StudyDescription",
+    "Modality",
+]
+
+FILE_INFO_TAGS = [
+    "PatientID",
+    "StudyInstanceUID",
+    "SeriesInstanceUID",
+    "InstanceNumber",
+    "SOPInstanceUID",
+]
+
 
 @dataclass(kw_only=True, eq=False)
 class SeriesInfo:
@@ -30,48 +73,194 @@ class SeriesInfo:
     image_count: int
 
 
-def series_information(input_dir: Path) -> Iterable[SeriesInfo]:
-    seen_so_far: SortedDict[tuple[str, str, str], SeriesInfo] = SortedDict()
+def parse_int(value) -> int | None:
+    """Converts the value of an integer tag (e.g. InstanceNumber) to int, if possible"""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def is_dicom_file(file_path: Path | str) -> bool:
+    """Checks for the "DICM" prefix after the 128-byte preamble of a DICOM file"""
+    with open(file_path, "rb") as f:
+        return f.seek(128) == 128 and f.read(4) == b"DICM"
+
+
+def _ends_within(ds: FileDataset, tag: str, size: int) -> bool:
+    """Whether the value of a (not yet converted) element ends within `size` bytes"""
+    elem = ds.get_item(tag)
+    value_tell = getattr(elem, "value_tell", None)
+    if value_tell is None or elem.is_undefined_length:
+        return False
+    return value_tell + elem.length <= size
+
+
+def read_header(file_path: Path | str, tags: list[str]) -> FileDataset:
+    """
+    Reads only the given `tags` from the header of a DICOM file, trying first to
+    parse a bounded prefix of the file
+    """
+    with open(file_path, "rb") as f:
+        prefix = f.read(HEADER_PREFIX_SIZE)
+        if prefix[128:132] != b"DICM":
+            raise ValueError(NOT_DICOM)
+        if len(prefix) < HEADER_PREFIX_SIZE:
+            # The whole file has been read
+            return dcmread(BytesIO(prefix), stop_before_pixels=True, specific_tags=tags)
+        try:
+            ds = dcmread(BytesIO(prefix), stop_before_pixels=True, specific_tags=tags)
+            # If the prefix contains the whole header then the missing tags are
+            # really missing from the file, but the values of the tags found must
+            # not be cut off by the end of the prefix
+            complete = all(
+                _ends_within(ds, tag, len(prefix)) for tag in tags if tag in ds
+            )
+            if complete and (
+                PIXEL_DATA_TAG_BYTES in prefix or all(tag in ds for tag in tags)
+            ):
+                return ds
+        except Exception:
+            pass
+        f.seek(0)
+        return dcmread(f, stop_before_pixels=True, specific_tags=tags)
+
+
+def _read_header_result(file_path: str, tags: list[str]) -> HeaderResult:
+    try:
+        return HeaderResult(file_path, read_header(file_path, tags), None)
+    except Exception as e:
+        error = str(e) if str(e) == NOT_DICOM else f"{type(e).__name__}: {e}"
+        return HeaderResult(file_path, None, error)
+
+
+def count_result(result: HeaderResult, stats: Counter[str]) -> HeaderResult:
+    stats["files"] += 1
+    if result.dataset is not None:
+        stats["dicom"] += 1
+    elif result.error == NOT_DICOM:
+        stats["non_dicom"] += 1
+    else:
+        stats["failed"] += 1
+        logger.warning(f"Failed to read DICOM file {result.path}: {result.error}")
+    return result
+
+
+def read_headers(
+    file_paths: Iterable[str],
+    tags: list[str],
+    *,
+    threads: int = DEFAULT_SCAN_THREADS,
+) -> Generator[HeaderResult, None, None]:
+    """
+    Reads the given `tags` from the headers of the given files using a pool of
+    `threads` threads. The results are generated in the order of the `file_paths`.
+    """
+    in_flight: deque[Future] = deque()
+    with ThreadPoolExecutor(threads) as executor:
+        for file_path in file_paths:
+            in_flight.append(executor.submit(_read_header_result, file_path, tags))
+            # Keep a bounded number of files in flight
+            if len(in_flight) >= 4 * threads:
+                yield in_flight.popleft().result()
+        while in_flight:
+            yield in_flight.popleft().result()
+
+
+def is_index_file(name: str) -> bool:
+    """Whether a file name is the one of an index (see `dicom_index`) or its journal"""
+    return name.startswith(DEFAULT_INDEX_FILE)
+
+
+def walk_files(input_dir: Path | str) -> Generator[str, None, None]:
     for root, dirs, files in os.walk(os.fspath(input_dir), topdown=True):
         for file in files:
-            file_path = os.path.join(root, file)
-            try:
-                dataset: FileDataset = dcmread(file_path, stop_before_pixels=True)
-                key = (
-                    dataset.PatientID,
-                    dataset.StudyInstanceUID,
-                    dataset.SeriesInstanceUID,
-                )
-                if key in seen_so_far:
-                    seen_so_far[key].image_count += 1
-                    continue
-                series_info = SeriesInfo(
-                    patient_id=dataset.PatientID,
-                    study_uid=dataset.StudyInstanceUID,
-                    series_uid=dataset.SeriesInstanceUID,
-                    series_description=dataset.get("SeriesDescription", ""),
-                    study_description=dataset.get("StudyDescription", ""),
-                    modality=dataset.get("Modality", ""),
-                    image_count=1,
-                )
-                seen_so_far[key] = series_info
-            except Exception:
-                continue
+            if not is_index_file(file):
+                yield os.path.join(root, file)
+
+
+def scan_headers(
+    input_dir: Path | str,
+    tags: list[str],
+    *,
+    threads: int = DEFAULT_SCAN_THREADS,
+) -> Generator[HeaderResult, None, None]:
+    """
+    Walks the `input_dir` and reads the given `tags` from the headers of all the files
+    using a pool of `threads` threads. The results are generated in the order of the
+    walk. Files that are not DICOM or could not be read have no `dataset` in their
+    result; the failures are logged, and a summary is logged at the end of the scan.
+    """
+    stats: Counter[str] = Counter()
+    for result in read_headers(walk_files(input_dir), tags, threads=threads):
+        yield count_result(result, stats)
+    logger.info(
+        f"Scanned {stats['files']} files in {input_dir}: {stats['dicom']} DICOM, "
+        f"{stats['non_dicom']} non DICOM (skipped), {stats['failed']} failed"
+    )
+
+
+def _has_required_tags(result: HeaderResult) -> bool:
+    missing = [tag for tag in REQUIRED_TAGS if tag not in result.dataset]
+    if missing:
+        logger.warning(f"Skipping DICOM file {result.path}, missing: {missing}")
+    return not missing
+
+
+def series_information(
+    input_dir: Path,
+    *,
+    threads: int = DEFAULT_SCAN_THREADS,
+    index: "DicomIndex | None" = None,
+) -> Iterable[SeriesInfo]:
+    if index is not None:
+        index.update(threads=threads)
+        return index.series_information()
+    seen_so_far: SortedDict[tuple[str, str, str], SeriesInfo] = SortedDict()
+    for result in scan_headers(input_dir, SERIES_INFO_TAGS, threads=threads):
+        dataset = result.dataset
+        if dataset is None or not _has_required_tags(result):
+            continue
+        key = (
+            dataset.PatientID,
+            dataset.StudyInstanceUID,
+            dataset.SeriesInstanceUID,
+        )
+        if key in seen_so_far:
+            seen_so_far[key].image_count += 1
+            continue
+        series_info = SeriesInfo(
+            patient_id=key[0],
+            study_uid=key[1],
+            series_uid=key[2],
+            series_description=dataset.get("SeriesDescription", ""),
+            study_description=dataset.get("StudyDescription", ""),
+            modality=dataset.get("Modality", ""),
+            image_count=1,
+        )
+        seen_so_far[key] = series_info
     return seen_so_far.values()
 
 
-def dcm_generator(input_folder: Path | str) -> Generator[DcmFileInfo, None, None]:
-    for root, dirs, files in os.walk(os.fspath(input_folder), topdown=True):
-        for file in files:
-            file_path = os.path.join(root, file)
-            try:
-                ds: FileDataset = dcmread(file_path, stop_before_pixels=True)
-                yield DcmFileInfo(
-                    Path(file_path),
-                    ds.PatientID,
-                    ds.StudyInstanceUID,
-                    ds.SeriesInstanceUID,
-                    ds.InstanceNumber,
-                )
-            except Exception:
-                continue
+def dcm_generator(
+    input_folder: Path | str,
+    *,
+    threads: int = DEFAULT_SCAN_THREADS,
+    index: "DicomIndex | None" = None,
+) -> Generator[DcmFileInfo, None, None]:
+    if index is not None:
+        index.update(threads=threads)
+        yield from index.file_infos()
+        return
+    for result in scan_headers(input_folder, FILE_INFO_TAGS, threads=threads):
+        ds = result.dataset
+        if ds is None or not _has_required_tags(result):
+            continue
+        yield DcmFileInfo(
+            Path(result.path),
+            ds.PatientID,
+            ds.StudyInstanceUID,
+            ds.SeriesInstanceUID,
+            parse_int(ds.get("InstanceNumber")),
+            ds.get("SOPInstanceUID", ""),
+        )
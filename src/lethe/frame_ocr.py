@@ -0,0 +1,173 @@
+"""
+OCR of large and multi-frame images (e.g. mammography, tomosynthesis) with bounded memory: the
+frames are decoded lazily one at a time, the text is detected on a downscaled copy of each
+frame and the boxes found are mapped back to the full resolution and redacted.
+
+The frames are written by `pixel_redaction.write_redacted`: natively encoded (uncompressed)
+pixel data are redacted in place in a copy of the input file, only rewriting the frames that
+contain text, and compressed pixel data are streamed to the output file, re-encoding only the
+frames that contain text if their transfer syntax is lossless. If no text is found the input
+file is copied unchanged.
+
+When the OCR can process batches of images, the text of the frames is detected in a first pass
+over them, a batch of downscaled frames at a time, and then only the frames with text are
+decoded again and redacted.
+"""
+
+import math
+import shutil
+from pathlib import Path
+from typing import Callable
+
+import numpy as np
+from pydicom import Dataset, dcmread
+from pydicom.pixels import apply_voi_lut, convert_color_space, iter_pixels
+
+from .pixel_redaction import fill_boxes, frame_count, is_greyscale, write_redacted
+from .series_ocr import Box
+
+# A function that detects the text (to redact) in a batch of 8 bit images, returning
+# the boxes of each one
+Detector = Callable[[list[np.ndarray]], list[list[Box]]]
+
+
+def needs_frame_ocr(ds: Dataset, max_side: int) -> bool:
+    """Whether the image of a dataset (header) is multi-frame or larger than `max_side`"""
+    if "Rows" not in ds or "Columns" not in ds:
+        return False
+    return frame_count(ds) > 1 or max(ds.Rows, ds.Columns) > max_side
+
+
+def ocr_image(frame: np.ndarray, ds: Dataset) -> np.ndarray:
+    """
+    Converts a frame to the 8 bit image that is passed to the OCR, as the redactor
+    engine does: greyscale frames are windowed (if the dataset has a window) and
+    inverted, color frames are used as they are
+    """
+    if frame.ndim == 3:
+        if str(ds.get("PhotometricInterpretation", "")).startswith("YBR"):
+            # A frame as it is stored (see `write_redacted`)
+            frame = convert_color_space(frame, "YBR_FULL", "RGB")
+        return frame.astype(np.uint8, copy=False)
+    if "WindowWidth" in ds:
+        frame = apply_voi_lut(frame, ds)
+    frame = frame.astype(np.float32)
+    lo, hi = frame.min(), frame.max()
+    if hi <= lo:
+        return np.zeros(frame.shape, dtype=np.uint8)
+    return ((hi - frame) / (hi - lo) * 255.0).astype(np.uint8)
+
+
+def downscale(image: np.ndarray, factor: int) -> np.ndarray:
+    """Downscales an image by an integer factor, averaging blocks of pixels"""
+    if factor <= 1:
+        return image
+    rows, columns = image.shape[:2]
+    pad = [(0, -rows % factor), (0, -columns % factor)] + [(0, 0)] * (image.ndim - 2)
+    padded = np.pad(image, pad, mode="edge")
+    blocks = padded.reshape(
+        padded.shape[0] // factor, factor, padded.shape[1] // factor, factor, -1
+    )
+    small = blocks.mean(axis=(1, 3)).astype(np.uint8)
+    return small if image.ndim == 3 else small[..., 0]
+
+
+def scale_boxes(boxes: list[Box], factor: int, rows: int, columns: int) -> list[Box]:
+    """
+    Maps the boxes found in an image downscaled by `factor` to the full resolution,
+    enlarged by one (downscaled) pixel on each side to cover the rounding
+    """
+    scaled = []
+    for box in boxes:
+        top = max(0, (box["top"] - 1) * factor)
+        left = max(0, (box["left"] - 1) * factor)
+        bottom = min(rows, (box["top"] + box["height"] + 1) * factor)
+        right = min(columns, (box["left"] + box["width"] + 1) * factor)
+        if bottom > top and right > left:
+            scaled.append(
+                {
+                    "left": left,
+                    "top": top,
+                    "width": right - left,
+                    "height": bottom - top,
+                }
+            )
+    return scaled
+
+
+def _redact_frame(
+    frame: np.ndarray, ds: Dataset, detect: Detector, max_side: int, greyscale: bool
+) -> bool:
+    """Redacts (in place) the text of a frame, returns whether any was found"""
+    image = ocr_image(frame, ds)
+    factor = max(1, math.ceil(max(image.shape[:2]) / max_side))
+    (boxes,) = detect([downscale(image, factor)])
+    return fill_boxes(
+        frame, scale_boxes(boxes, factor, frame.shape[0], frame.shape[1]), greyscale
+    )
+
+
+def _detect_frames(
+    file_path: Path, header: Dataset, detect: Detector, max_side: int, batch_size: int
+) -> dict[int, list[Box]]:
+    """
+    Detects the text of the frames of a file in batches of `batch_size` downscaled
+    frames, returning the boxes (in full resolution) of the frames that have text
+    """
+    found: dict[int, list[Box]] = {}
+    batch: list[tuple[int, int, tuple[int, int]]] = []
+    images: list[np.ndarray] = []
+
+    def detect_batch() -> None:
+        for (index, factor, (rows, columns)), boxes in zip(batch, detect(images)):
+            if scaled := scale_boxes(boxes, factor, rows, columns):
+                found[index] = scaled
+        batch.clear()
+        images.clear()
+
+    # The frames as stored, as they are passed to the filler by `write_redacted`
+    for index, frame in enumerate(iter_pixels(file_path, raw=True)):
+        image = ocr_image(frame, header)
+        factor = max(1, math.ceil(max(image.shape[:2]) / max_side))
+        batch.append((index, factor, frame.shape[:2]))
+        images.append(downscale(image, factor))
+        if len(images) >= batch_size:
+            detect_batch()
+    if images:
+        detect_batch()
+    return found
+
+
+def redact_frames(
+    file_path: Path,
+    output_path: Path,
+    detect: Detector,
+    max_side: int,
+    batch_size: int = 1,
+) -> bool:
+    """
+    Redacts the text of a large or multi-frame image, one frame at a time, detecting
+    the text with `detect` on a copy of each frame downscaled so that its largest side
+    is at most `max_side`. If `batch_size` is more than 1 the text is detected in batches
+    of frames before the redaction. Returns True if any text was redacted.
+    """
+    header = dcmread(file_path, stop_before_pixels=True)
+    greyscale = is_greyscale(header)
+    if batch_size > 1:
+        found = _detect_frames(file_path, header, detect, max_side, batch_size)
+        if not found:
+            shutil.copyfile(file_path, output_path)
+            return False
+        return write_redacted(
+            file_path,
+            output_path,
+            header,
+            lambda index, frame: fill_boxes(frame, found[index], greyscale),
+            sorted(found),
+        )
+
+    def fill(index: int, frame: np.ndarray) -> bool:
+        # The header describes the frames as they are passed (see `write_redacted`)
+        return _redact_frame(frame, header, detect, max_side, greyscale)
+
+    return write_redacted(file_path, output_path, header, fill)
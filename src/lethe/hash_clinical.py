@@ -1,20 +1,34 @@
 import shutil
-from functools import cache
+import time
+from collections import Counter, deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from functools import cache, lru_cache, partial
 from hashlib import md5
+from itertools import islice
 from pathlib import Path
-from typing import Callable
+from typing import Callable, Iterable, Iterator
 from xml.etree import ElementTree as ET
 
 import clevercsv
 from loguru import logger
 
 from .defaults import (
+    DEFAULT_HASH_MEMO_SIZE,
     DEFAULT_IGNORE_CSV_PREFIX,
     DEFAULT_PATIENT_ID_PREFIX,
     DEFAULT_STUDIES_METADATA_CSV,
     DEFAULT_UIDROOT,
 )
 
+# The size of the buffer for writing the output CSV files, so that the rows are written
+# to the disk in large chunks while the memory used remains bounded
+CSV_WRITE_BUFFER_SIZE = 1024 * 1024
+
+# CSV files larger than this are split into batches of rows that are hashed in
+# parallel by the worker processes (smaller files are hashed by a single worker)
+CSV_CHUNKED_MIN_SIZE = 64 * 1024 * 1024
+CSV_BATCH_ROWS = 10_000
+
 
 @cache
 def _anonymization_info(anon_script: str):
@@ -103,11 +117,44 @@ def hash_patient_id(patient_id: str, *, secret_key: str, prefix: str) -> str:
     return f"{prefix}{hashed_pid}"
 
 
-@cache
+class HashMemo:
+    """
+    Bounded (LRU) memo tables of the hashed patient IDs and UIDs, to be shared by all
+    the CSV files of a run: clinical tables usually repeat the same patient IDs in many
+    rows, so hashing them once saves most of the time.
+    """
+
+    def __init__(self, maxsize: int = DEFAULT_HASH_MEMO_SIZE):
+        self.hash_patient_id = lru_cache(maxsize)(hash_patient_id)
+        self.hash_uid = lru_cache(maxsize)(hash_uid_using_anon_patient_id)
+
+    def stats(self) -> Counter[tuple[str, str]]:
+        """The numbers of "hits" and "misses" of each memo table, by (table, kind)"""
+        stats: Counter[tuple[str, str]] = Counter()
+        for name, func in [
+            ("patient IDs", self.hash_patient_id),
+            ("UIDs", self.hash_uid),
+        ]:
+            info = func.cache_info()
+            stats[name, "hits"] = info.hits
+            stats[name, "misses"] = info.misses
+        return stats
+
+
+def log_memo_stats(stats: Counter[tuple[str, str]]) -> None:
+    """Logs the hit rates of the memo tables (e.g. the sum of those of all the workers)"""
+    for name in ("patient IDs", "UIDs"):
+        hits = stats[name, "hits"]
+        total = hits + stats[name, "misses"]
+        if total:
+            logger.info(f"Hashed {total} {name}, {hits / total:.1%} found in memo")
+
+
 def _clinical_hasher_factory(
     *,
     secret_key: str,
     prefix: str = DEFAULT_PATIENT_ID_PREFIX,
+    memo: HashMemo,
 ) -> Callable[[list[str]], list[str]]:
     """
     Returns a "mapper" that given a list of strings (a row), hashes the patient IDs (assumed to be in the first column)
@@ -117,23 +164,26 @@ def _clinical_hasher_factory(
         secret_key: The secret key ("pepper") to use for hashing.
         prefix: The prefix to use for the hashed patient IDs, defaults to "EUCAIM-"
                 Note that this should be aligned with the anon.script !!!
+        memo: The memo tables of the hashed values.
     Returns:
         the mapper function
     """
 
     def mapper(row: list[str]) -> list[str]:
-        new_patient_id = hash_patient_id(row[0], secret_key=secret_key, prefix=prefix)
+        new_patient_id = memo.hash_patient_id(
+            row[0], secret_key=secret_key, prefix=prefix
+        )
         return [new_patient_id, *row[1:]]
 
     return mapper
 
 
-@cache
 def _studies_hasher_factory(
     *,
     prefix: str,
     secret_key: str,
     uidroot: str,
+    memo: HashMemo,
 ) -> Callable[[list[str]], list[str]]:
     """
     Returns a "mapper" that given a list of strings (a row), hashes the patient IDs (assumed to be in the first column)
@@ -143,14 +193,17 @@ def _studies_hasher_factory(
         secret_key: The secret key ("pepper") to use for hashing.
         prefix: The prefix to use for the hashed patient IDs, defaults to "EUCAIM-"
                 Note that this should be aligned with the anon.script !!!
+        memo: The memo tables of the hashed values.
     Returns:
         the mapper function
     """
 
     def mapper(row: list[str]) -> list[str]:
-        new_patient_id = hash_patient_id(row[0], secret_key=secret_key, prefix=prefix)
+        new_patient_id = memo.hash_patient_id(
+            row[0], secret_key=secret_key, prefix=prefix
+        )
 
-        hashed_study_uid = hash_uid_using_anon_patient_id(
+        hashed_study_uid = memo.hash_uid(
             uid=row[1],
             prefix=uidroot,
             anonymized_patient_id=new_patient_id,
@@ -161,25 +214,49 @@ def _studies_hasher_factory(
     return mapper
 
 
+def _create_mapper(
+    csv_name: str,
+    *,
+    secret_key: str,
+    prefix: str,
+    uidroot: str,
+    memo: HashMemo,
+) -> Callable[[list[str]], list[str]]:
+    """Returns the mapper for the CSV file with the given name"""
+    if csv_name == DEFAULT_STUDIES_METADATA_CSV:
+        return _studies_hasher_factory(
+            prefix=prefix, secret_key=secret_key, uidroot=uidroot, memo=memo
+        )
+    return _clinical_hasher_factory(prefix=prefix, secret_key=secret_key, memo=memo)
+
+
 def _parse_and_hash_csv(
     input_file: Path,
     output_file: Path,
-    mapper: Callable[[list[str]], list[str]],
+    mapper: Callable[[list[str]], list[str]] | None,
     verbose: bool = False,
+    *,
+    map_rows: Callable[[Iterator[list[str]]], Iterable[list[str]]] | None = None,
 ) -> None:
     """
     Parses an input CSV file, applies the given `mapper` function to each row, and writes the result to the output file.
+    The rows are streamed from the input to the output file one by one, so the memory used does not depend on
+    the size of the file.
 
     Args:
         input_file: The path to the input CSV file.
         output_file: The path to the output CSV file.
+        mapper: The function that transforms each row (except the header).
+        map_rows: If given, it is used instead of the `mapper` for transforming all the rows
+                  (except the header) in bulk, e.g. in parallel. It must keep their order.
     Returns:
         None
     """
     logger.info(f"Parsing and hashing CSV file {input_file.name}")
+    time_start = time.time()
     with (
         open(input_file, "r", newline="") as fp,
-        open(output_file, "w", newline="") as fp_out,
+        open(output_file, "w", newline="", buffering=CSV_WRITE_BUFFER_SIZE) as fp_out,
     ):
         dialect = clevercsv.Sniffer().sniff(fp.read(10000))
         if dialect is None:
@@ -187,8 +264,7 @@ def _parse_and_hash_csv(
         if verbose:
             logger.debug(f"Detected CSV dialect: {dialect.to_dict()}")
         fp.seek(0)
-        reader = clevercsv.reader(fp, dialect)
-        rows: list[list[str]] = list(reader)
+        reader = iter(clevercsv.reader(fp, dialect))
 
         # What will be the CSV dialect used for the output file? We have two sane options:
         # RFC4180, which is kind of standard, or the dialect used in the input file
@@ -199,13 +275,139 @@ def _parse_and_hash_csv(
 
         # We assume that the first row in the input file contains the header, so
         # we write it to the output file as is:
-        writer.writerow(rows[0])
+        header = next(reader, None)
+        if header is None:
+            logger.warning(f"CSV file {input_file.name} is empty")
+            return
+        writer.writerow(header)
+        row_count = 1
+        for row in map(mapper, reader) if map_rows is None else map_rows(reader):
+            writer.writerow(row)
+            row_count += 1
+    elapsed_time = time.time() - time_start
+    size_mb = input_file.stat().st_size / 1024**2
+    logger.info(
+        f"Wrote {row_count} rows to {output_file.name} in RFC4180 CSV format in "
+        f"{elapsed_time:.3f} seconds ({row_count / max(elapsed_time, 1e-6):.0f} rows/s, "
+        f"{size_mb / max(elapsed_time, 1e-6):.2f} MB/s)"
+    )
 
-        for row in rows[1:]:
-            writer.writerow(mapper(row))
-        logger.info(
-            f"Wrote {len(rows)} rows to {output_file.name} in RFC4180 CSV format"
-        )
+
+# Per (worker) process state, set up by `_init_worker`
+_hash_params: dict[str, str] = {}
+_memo: HashMemo | None = None
+# The memo statistics already sent to the main process
+_memo_reported: Counter[tuple[str, str]] = Counter()
+
+
+def _init_worker(secret_key: str, prefix: str, uidroot: str) -> None:
+    global _hash_params, _memo
+    _hash_params = {"secret_key": secret_key, "prefix": prefix, "uidroot": uidroot}
+    _memo = HashMemo()
+
+
+def _new_memo_stats() -> Counter[tuple[str, str]]:
+    """The memo statistics of the worker since they were last sent"""
+    global _memo_reported
+    stats = _memo.stats()
+    new_stats = stats - _memo_reported
+    _memo_reported = stats
+    return new_stats
+
+
+def _hash_csv_in_worker(
+    input_file: Path, output_file: Path, verbose: bool
+) -> Counter[tuple[str, str]]:
+    mapper = _create_mapper(input_file.name, memo=_memo, **_hash_params)
+    _parse_and_hash_csv(input_file, output_file, mapper, verbose=verbose)
+    return _new_memo_stats()
+
+
+def _map_rows_in_worker(
+    csv_name: str, rows: list[list[str]]
+) -> tuple[list[list[str]], Counter[tuple[str, str]]]:
+    mapper = _create_mapper(csv_name, memo=_memo, **_hash_params)
+    return [mapper(row) for row in rows], _new_memo_stats()
+
+
+def _map_rows_in_pool(
+    executor: ProcessPoolExecutor,
+    csv_name: str,
+    rows: Iterator[list[str]],
+    max_in_flight: int,
+    memo_stats: Counter[tuple[str, str]],
+) -> Iterator[list[str]]:
+    """
+    Sends batches of the `rows` to be hashed by the worker processes and yields the
+    hashed rows in their original order, keeping at most `max_in_flight` batches in
+    memory. The memo statistics of the workers are added to `memo_stats`.
+    """
+
+    def result(future: Future) -> list[list[str]]:
+        rows, stats = future.result()
+        memo_stats.update(stats)
+        return rows
+
+    in_flight: deque[Future] = deque()
+    while batch := list(islice(rows, CSV_BATCH_ROWS)):
+        in_flight.append(executor.submit(_map_rows_in_worker, csv_name, batch))
+        if len(in_flight) >= max_in_flight:
+            yield from result(in_flight.popleft())
+    while in_flight:
+        yield from result(in_flight.popleft())
+
+
+def _hash_csvs_in_pool(
+    csvs_to_be_hashed: list[Path],
+    csvs_to_copied: list[Path],
+    output_dir: Path,
+    *,
+    secret_key: str,
+    prefix: str,
+    uidroot: str,
+    workers: int,
+    verbose: bool,
+) -> None:
+    large_csvs = [
+        c for c in csvs_to_be_hashed if c.stat().st_size >= CSV_CHUNKED_MIN_SIZE
+    ]
+    if not large_csvs:
+        workers = min(workers, len(csvs_to_be_hashed))
+    logger.info(f"Hashing CSV files using {workers} worker processes")
+    memo_stats: Counter[tuple[str, str]] = Counter()
+    with ProcessPoolExecutor(
+        workers, initializer=_init_worker, initargs=(secret_key, prefix, uidroot)
+    ) as executor:
+        hash_futures = [
+            executor.submit(_hash_csv_in_worker, csv, output_dir / csv.name, verbose)
+            for csv in csvs_to_be_hashed
+            if csv not in large_csvs
+        ]
+        copy_futures = [
+            executor.submit(shutil.copy, csv, output_dir / csv.name)
+            for csv in csvs_to_copied
+        ]
+        # The large files are parsed and written here while their rows are hashed by
+        # the workers, along with the smaller files:
+        for csv in large_csvs:
+            _parse_and_hash_csv(
+                csv,
+                output_dir / csv.name,
+                None,
+                verbose=verbose,
+                map_rows=partial(
+                    _map_rows_in_pool,
+                    executor,
+                    csv.name,
+                    max_in_flight=2 * workers,
+                    memo_stats=memo_stats,
+                ),
+            )
+        for future in hash_futures:
+            memo_stats.update(future.result())
+        for future in copy_futures:
+            future.result()
+    log_memo_stats(memo_stats)
 
 
 def hash_clinical_csvs(
@@ -216,6 +418,7 @@ def hash_clinical_csvs(
     uidroot: str = DEFAULT_UIDROOT,
     ignore_prefix: str = DEFAULT_IGNORE_CSV_PREFIX,
     verbose: bool = False,
+    workers: int = 1,
 ) -> None:
     """
     Checks the input_dir and finds the clinical CSV files in it. Then, for each file,
@@ -223,6 +426,10 @@ def hash_clinical_csvs(
     located directly in the input directory (it does not search in subdirectories), and
     skips files that start with the given `ignore_prefix`. Any csv file with a name that
     starts with the given `ignore_prefix` is just copied to the output directory.
+
+    If `workers` is more than 1, the CSV files are processed in parallel by a pool of
+    worker processes, and the rows of large CSV files are hashed in parallel batches.
+    The output files are the same as when they are processed sequentially.
     """
     csvs = list(c for c in input_dir.glob("*.csv") if c.is_file())
     if not csvs:
@@ -241,19 +448,36 @@ def hash_clinical_csvs(
         f"and {len(csvs_to_copied)} CSV file(s) to be copied"
     )
     prefix: str = DEFAULT_PATIENT_ID_PREFIX
+    if workers > 1 and csvs_to_be_hashed:
+        _hash_csvs_in_pool(
+            csvs_to_be_hashed,
+            csvs_to_copied,
+            output_dir,
+            secret_key=secret_key,
+            prefix=prefix,
+            uidroot=uidroot,
+            workers=workers,
+            verbose=verbose,
+        )
+        return
+    # The hashed values are shared by all the CSV files:
+    memo = HashMemo()
     for input_clinical_csv in csvs_to_be_hashed:
         output_clinical_csv = output_dir / input_clinical_csv.name
-        mapper = _clinical_hasher_factory(prefix=prefix, secret_key=secret_key)
-        if input_clinical_csv.name == DEFAULT_STUDIES_METADATA_CSV:
-            mapper = _studies_hasher_factory(
-                prefix=prefix, secret_key=secret_key, uidroot=uidroot
-            )
+        mapper = _create_mapper(
+            input_clinical_csv.name,
+            secret_key=secret_key,
+            prefix=prefix,
+            uidroot=uidroot,
+            memo=memo,
+        )
         _parse_and_hash_csv(
             input_clinical_csv,
             output_clinical_csv,
             mapper,
             verbose=verbose,
         )
+    log_memo_stats(memo.stats())
     for csv in csvs_to_copied:
         output_csv = output_dir / csv.name
         shutil.copy(csv, output_csv)
@@ -0,0 +1,222 @@
+"""
+The manifest of a `run` job, kept in the output folder: it records the settings of the job
+(e.g. a fingerprint of the secret key, the hash of the anonymization script), the stages
+of the pipeline that have been completed, and the status of each file in the current
+stage, so that an interrupted run can be resumed where it stopped (`--resume`). Since the
+manifest remains in the output folder, the files are recorded by a keyed hash (with the
+secret key of the job) of their paths, which may contain e.g. the names of the patients.
+
+The intermediate results of the stages (which are not anonymized yet) are kept in a "work"
+folder outside of the output folder, whose path is recorded in the manifest so that a resumed
+run finds them. It is created in the system's temporary folder unless another parent folder
+is given (e.g. a persistent volume, so that the results survive a restart of the container).
+"""
+
+import hmac
+import os
+import shutil
+import sqlite3
+import tempfile
+from hashlib import sha256
+from pathlib import Path
+from typing import Callable
+
+from loguru import logger
+
+MANIFEST_FILE = ".lethe_job.sqlite"
+# The prefix of the work folders of the jobs
+WORK_DIR_PREFIX = "lethe-work-"
+# The key of the job table that keeps the path of the work folder (not a setting)
+_WORK_DIR_KEY = "work_dir"
+
+# The prefix of the temporary folders that the stages create in the output folder
+STALE_DIR_PREFIX = ".lethe-"
+
+# The status of the files that do not need to be processed again in a stage
+DONE = "done"
+FAILED = "failed"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS job (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS stages (stage TEXT PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS files (
+    stage TEXT NOT NULL,
+    path TEXT NOT NULL,
+    status TEXT NOT NULL,
+    PRIMARY KEY (stage, path)
+);
+"""
+
+
+def secret_fingerprint(pepper: str) -> str:
+    """A fingerprint of the secret key, to check that a job is resumed with the same key"""
+    return sha256(f"lethe-job:{pepper}".encode()).hexdigest()
+
+
+class JobManifest:
+    def __init__(self, output_dir: Path, pepper: str):
+        self.output_dir = output_dir
+        self.work_dir: Path | None = None
+        self._path_key = f"lethe-job-path:{pepper}".encode()
+        output_dir.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(
+            os.fspath(output_dir / MANIFEST_FILE), isolation_level=None
+        )
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(_SCHEMA)
+
+    def settings(self) -> dict[str, str]:
+        settings = dict(self.db.execute("SELECT key, value FROM job"))
+        settings.pop(_WORK_DIR_KEY, None)
+        return settings
+
+    def _recorded_work_dir(self) -> Path | None:
+        row = self.db.execute("SELECT value FROM job WHERE key = ?", (_WORK_DIR_KEY,))
+        value = row.fetchone()
+        return Path(value[0]) if value is not None else None
+
+    def start(self, settings: dict[str, str], work_parent: Path | None = None) -> None:
+        """
+        Starts a new job, removing the state and the work folder of any previous one.
+        The work folder of the new job is created in `work_parent` (the system's
+        temporary folder by default).
+        """
+        if (previous := self._recorded_work_dir()) is not None:
+            shutil.rmtree(previous, ignore_errors=True)
+        self.db.execute("DELETE FROM job")
+        self.db.execute("DELETE FROM stages")
+        self.db.execute("DELETE FROM files")
+        if work_parent is not None:
+            work_parent.mkdir(parents=True, exist_ok=True)
+        self.work_dir = Path(
+            tempfile.mkdtemp(prefix=WORK_DIR_PREFIX, dir=work_parent)
+        ).absolute()
+        self.db.executemany(
+            "INSERT INTO job VALUES (?, ?)",
+            [*settings.items(), (_WORK_DIR_KEY, os.fspath(self.work_dir))],
+        )
+        self.clean_stale()
+
+    def resume(self, settings: dict[str, str]) -> list[str]:
+        """
+        Prepares the resumption of the job, returning the names of the `settings` that
+        differ from the ones of the job (in which case it cannot be resumed)
+        """
+        previous = self.settings()
+        mismatched = [k for k, v in settings.items() if previous.get(k) != v]
+        if not mismatched:
+            self.work_dir = self._recorded_work_dir()
+            self.clean_stale()
+            stages = [s for (s,) in self.db.execute("SELECT stage FROM stages")]
+            logger.info(f"Resuming job, completed stages: {stages or 'none'}")
+        return mismatched
+
+    def clean_stale(self) -> None:
+        """Removes the temporary folders left in the output folder by an interrupted run"""
+        for path in self.output_dir.glob(f"{STALE_DIR_PREFIX}*"):
+            if path.is_dir():
+                logger.info(f"Removing stale temporary folder {path}")
+                shutil.rmtree(path, ignore_errors=True)
+
+    def has_work_dir(self) -> bool:
+        """Whether the work folder of the job (with the results of its stages) exists"""
+        return self.work_dir is not None and self.work_dir.is_dir()
+
+    def stage_dir(self, stage: str) -> Path:
+        """The folder where the output of the given stage is kept"""
+        path = self.work_dir / stage
+        path.mkdir(parents=True, exist_ok=True)
+        return path
+
+    def is_completed(self, stage: str) -> bool:
+        row = self.db.execute("SELECT 1 FROM stages WHERE stage = ?", (stage,))
+        return row.fetchone() is not None
+
+    def complete(self, stage: str) -> None:
+        self.db.execute("INSERT OR IGNORE INTO stages VALUES (?)", (stage,))
+        self.db.execute("DELETE FROM files WHERE stage = ?", (stage,))
+
+    def complete_if_done(self, stage: str, *previous: str) -> bool:
+        """
+        Completes the stage if none of its files failed and the `previous` stages have
+        been completed, so that the failed files are processed again when the job is
+        resumed. Returns whether the stage was completed.
+        """
+        (failed,) = self.db.execute(
+            "SELECT COUNT(*) FROM files WHERE stage = ? AND status = ?",
+            (stage, FAILED),
+        ).fetchone()
+        if failed:
+            logger.warning(
+                f"{failed} file(s) failed in stage {stage}, they are processed again "
+                "if the run is resumed (--resume)"
+            )
+            return False
+        if not all(self.is_completed(s) for s in previous):
+            return False
+        self.complete(stage)
+        return True
+
+    def _path_hash(self, path: Path, base: Path) -> str:
+        """The keyed hash of the path of a file relative to the stage's input"""
+        relative = os.fspath(path.absolute().relative_to(base))
+        return hmac.new(self._path_key, relative.encode(), sha256).hexdigest()
+
+    def record(self, stage: str, path_hash: str, status: str) -> None:
+        """Records the status of a file (by the hash of its path, see `_path_hash`)"""
+        self.db.execute(
+            "INSERT OR REPLACE INTO files (stage, path, status) VALUES (?, ?, ?)",
+            (stage, path_hash, status),
+        )
+
+    def done_files(self, stage: str) -> set[str]:
+        return {
+            path
+            for (path,) in self.db.execute(
+                "SELECT path FROM files WHERE stage = ? AND status = ?", (stage, DONE)
+            )
+        }
+
+    def skip_function(
+        self, stage: str, input_dir: Path
+    ) -> Callable[[Path], bool] | None:
+        """
+        Returns a function that checks whether a file of the `input_dir` has already
+        been processed in the given stage, or None if no files have been processed yet
+        """
+        done = self.done_files(stage)
+        if not done:
+            return None
+        logger.info(f"Skipping {len(done)} file(s) already processed in stage {stage}")
+        base = input_dir.absolute()
+        return lambda path: self._path_hash(path, base) in done
+
+    def recorder(
+        self, stage: str, input_dir: Path
+    ) -> Callable[[Path, str | None], None]:
+        """
+        Returns a function that records the status of a file of the `input_dir`, failed
+        if an error is given (the errors themselves are only logged)
+        """
+        base = input_dir.absolute()
+
+        def record(path: Path, error: str | None) -> None:
+            self.record(
+                stage, self._path_hash(path, base), DONE if error is None else FAILED
+            )
+
+        return record
+
+    def finish(self) -> None:
+        """
+        Marks the job as finished and removes the work folder. The per file records
+        have already been removed when each stage was completed.
+        """
+        self.complete("finished")
+        if self.work_dir is not None:
+            shutil.rmtree(self.work_dir, ignore_errors=True)
+        self.db.execute("VACUUM")
+
+    def close(self) -> None:
+        self.db.close()
@@ -0,0 +1,441 @@
+"""
+A "native" (pure Python) implementation of the DICOM metadata anonymization performed by the
+RSNA CTP anonymizer (DAT.jar) using the same anonymization script (`ctp/anon.script`).
+
+The script is compiled once into a table of actions indexed by the DICOM tag, which is then
+applied to each DICOM file using pydicom. The hashing functions are the ones used for
+the clinical CSVs (see `hash_clinical.py`) so the generated PatientIDs and UIDs are the same
+as the ones produced by CTP.
+"""
+
+import multiprocessing
+import re
+import time
+from collections import namedtuple
+from dataclasses import dataclass, field, replace
+from datetime import date, datetime, timedelta
+from functools import cache
+from hashlib import md5, sha256
+from pathlib import Path
+from typing import Callable
+from xml.etree import ElementTree as ET
+
+from loguru import logger
+from pydicom import Dataset, dcmread
+from pydicom.datadict import dictionary_VR, tag_for_keyword
+from pydicom.errors import InvalidDicomError
+from pydicom.multival import MultiValue
+from pydicom.tag import Tag
+
+from .cache import FileCache, cache_key, file_hash
+from .defaults import DEFAULT_UIDROOT
+from .dicom_utils import NOT_DICOM, is_index_file
+from .hash_clinical import hash_patient_id, hash_uid_using_anon_patient_id
+
+AnonResult = namedtuple("AnonResult", ["path", "error", "cached"])
+
+# A call of an anonymizer function in the script, e.g. `@hashuid(@UIDROOT,this,PatientID)`
+# (the `{...}` part is only used by the `@append` function)
+FnCall = namedtuple("FnCall", ["name", "args", "block"])
+
+_FN_CALL_RE = re.compile(r"@(\w+)\(([^)]*)\)(?:\{([^}]*)\})?")
+
+PATIENT_ID_TAG = Tag("PatientID")
+SOP_INSTANCE_UID_TAG = Tag("SOPInstanceUID")
+# The "CTP" private group, where e.g. the SiteID (0013,1013) is stored
+CTP_PRIVATE_GROUP = 0x0013
+CTP_PRIVATE_CREATOR = "CTP"
+
+
+@dataclass(kw_only=True, eq=False)
+class ElementAction:
+    keep: bool = False
+    remove: bool = False
+    empty: bool = False
+    always: bool = False
+    # The parsed script, a sequence of literal strings and function calls:
+    script: list[str | FnCall] = field(default_factory=list)
+
+
+@dataclass(kw_only=True, eq=False)
+class CompiledScript:
+    params: dict[str, str]
+    actions: dict[int, ElementAction]
+    keep_groups: set[int]
+    remove_private_groups: bool
+    remove_overlays: bool
+    remove_curves: bool
+    remove_unspecified: bool
+
+
+def _parse_script(text: str) -> list[str | FnCall]:
+    script: list[str | FnCall] = []
+    pos = 0
+    for m in _FN_CALL_RE.finditer(text):
+        if m.start() > pos:
+            script.append(text[pos : m.start()])
+        args = [a.strip() for a in m.group(2).split(",")] if m.group(2).strip() else []
+        script.append(FnCall(m.group(1), args, m.group(3)))
+        pos = m.end()
+    if pos < len(text):
+        script.append(text[pos:])
+    return script
+
+
+def _compile_action(script: list[str | FnCall]) -> ElementAction:
+    names = [s.name for s in script if isinstance(s, FnCall)]
+    always = "always" in names
+    script = [s for s in script if not (isinstance(s, FnCall) and s.name == "always")]
+    if names and all(n in ("keep", "always") for n in names) and len(script) == 1:
+        return ElementAction(keep=True, always=always)
+    if "remove" in names:
+        return ElementAction(remove=True)
+    if names == ["empty"]:
+        return ElementAction(empty=True, always=always)
+    return ElementAction(script=script, always=always)
+
+
+@cache
+def compile_script(anon_script: str) -> CompiledScript:
+    """
+    Compiles the given CTP anonymization script into a tag-indexed table of actions.
+    Elements that are disabled or have an empty script are considered "unspecified",
+    as in CTP.
+    """
+    root = ET.parse(anon_script).getroot()
+    params = {e.attrib["t"]: (e.text or "") for e in root.findall("p")}
+    actions: dict[int, ElementAction] = {}
+    for e in root.findall("e"):
+        text = (e.text or "").strip()
+        if e.attrib.get("en") != "T" or not text:
+            continue
+        script = _parse_script(text)
+        if not any(isinstance(s, FnCall) for s in script) and "(" in text:
+            logger.warning(
+                f"Anonymization script of {e.attrib.get('n')} looks like a function "
+                f"call without '@' and will be used as literal text: {text}"
+            )
+        actions[int(e.attrib["t"], 16)] = _compile_action(script)
+    keep_groups = {
+        int(k.attrib["t"], 16) for k in root.findall("k") if k.attrib.get("en") == "T"
+    }
+    removals = {r.attrib["t"] for r in root.findall("r") if r.attrib.get("en") == "T"}
+    return CompiledScript(
+        params=params,
+        actions=actions,
+        keep_groups=keep_groups,
+        remove_private_groups="privategroups" in removals,
+        remove_overlays="overlays" in removals,
+        remove_curves="curves" in removals,
+        remove_unspecified="unspecifiedelements" in removals,
+    )
+
+
+def _element_value(ds: Dataset, tag: int) -> str:
+    if tag not in ds:
+        return ""
+    value = ds[tag].value
+    if value is None:
+        return ""
+    if isinstance(value, (list, tuple, MultiValue)):
+        return "\\".join(str(v) for v in value)
+    return str(value)
+
+
+def _hash(value: str, max_len: int | None = None) -> str:
+    h = str(int.from_bytes(md5(value.encode()).digest(), byteorder="big"))
+    return h[:max_len] if max_len else h
+
+
+def _modify_date(value: str, year: str, month: str, day: str) -> str:
+    # Only the date part (first 8 characters) of DA and DT values is modified
+    if len(value) < 8 or not value[:8].isdigit():
+        return value
+    parts = [value[0:4], value[4:6], value[6:8]]
+    for i, (new, width) in enumerate(zip((year, month, day), (4, 2, 2))):
+        if new != "*":
+            parts[i] = f"{int(new):0{width}d}"
+    return "".join(parts) + value[8:]
+
+
+def _hash_date(value: str, key: str) -> str:
+    # Shifts the date back by a number of days (up to 10 years) derived from the
+    # hash of the `key`, so that intervals between the dates of a patient are kept
+    if len(value) < 8 or not value[:8].isdigit():
+        return value
+    days = int(_hash(key)) % 3652
+    try:
+        d = datetime.strptime(value[:8], "%Y%m%d").date() - timedelta(days=days)
+    except ValueError:
+        return value
+    return d.strftime("%Y%m%d") + value[8:]
+
+
+class _Evaluator:
+    """Evaluates the scripts for the elements of a single dataset"""
+
+    def __init__(self, compiled: CompiledScript, ds: Dataset):
+        self.compiled = compiled
+        self.ds = ds
+        # The new values of the elements processed so far
+        self.replaced: dict[int, str] = {}
+
+    def _value_of(self, ref: str, this: int, anonymized: bool = False) -> str:
+        if ref == "this":
+            return _element_value(self.ds, this)
+        tag = tag_for_keyword(ref)
+        if tag is None:
+            try:
+                tag = Tag(int(ref.strip("[]()").replace(",", ""), 16))
+            except ValueError:
+                return ""
+        if anonymized and tag in self.replaced:
+            return self.replaced[tag]
+        return _element_value(self.ds, tag)
+
+    def _arg(self, arg: str, this: int) -> str:
+        if arg.startswith("@"):
+            return self.compiled.params.get(arg[1:], "")
+        return self._value_of(arg, this)
+
+    def _call(self, fn: FnCall, tag: int) -> str:
+        args = fn.args
+        if fn.name == "param":
+            # Either a parameter (e.g. `@param(@PROVIDERID)`) or a literal string
+            return self._arg(args[0], tag) if args[0].startswith("@") else args[0]
+        if fn.name == "hashuid":
+            uid = self._value_of(args[1], tag)
+            if not uid.strip():
+                return uid
+            # The `@hashuid` uses the anonymized values of the extra elements,
+            # see `hash_clinical.hash_uid_using_anon_patient_id`
+            extra = "".join(self._value_of(a, tag, anonymized=True) for a in args[2:])
+            return hash_uid_using_anon_patient_id(
+                uid=uid, prefix=self._arg(args[0], tag), anonymized_patient_id=extra
+            )
+        if fn.name == "hashptid":
+            return hash_patient_id(
+                self._value_of(args[1], tag),
+                secret_key=self._arg(args[0], tag),
+                prefix="",
+            )
+        if fn.name == "hash":
+            value = self._value_of(args[0], tag)
+            max_len = int(args[1]) if len(args) > 1 else None
+            return _hash(value, max_len) if value else value
+        if fn.name == "hashdate":
+            return _hash_date(
+                self._value_of(args[0], tag), self._value_of(args[1], tag)
+            )
+        if fn.name == "modifydate":
+            return _modify_date(self._value_of(args[0], tag), *args[1:4])
+        if fn.name == "setSubstring":
+            # e.g. `@setSubstring(0,6)+"01"` keeps the year and month of a date
+            return self._value_of("this", tag)[int(args[0]) : int(args[1])]
+        if fn.name == "date":
+            return date.today().strftime("%Y%m%d")
+        if fn.name == "time":
+            return datetime.now().strftime("%H%M%S")
+        if fn.name == "append":
+            existing = self._value_of("this", tag)
+            new = self.evaluate(_parse_script(fn.block or ""), tag)
+            return f"{existing}\\{new}" if existing else new
+        if fn.name == "empty":
+            return ""
+        logger.warning(f"Unsupported anonymizer function @{fn.name} for {Tag(tag)}")
+        return ""
+
+    def evaluate(self, script: list[str | FnCall], tag: int) -> str:
+        result = []
+        for s in script:
+            if isinstance(s, FnCall):
+                result.append(self._call(s, tag))
+            elif s.startswith('+"') and s.endswith('"'):
+                # A literal concatenated to the result of a function
+                result.append(s[2:-1])
+            else:
+                result.append(s)
+        return "".join(result)
+
+
+def _is_removed_by_default(compiled: CompiledScript, tag: int) -> bool:
+    group = tag >> 16
+    if group == 0x7FE0 or group in compiled.keep_groups:
+        return False
+    if (tag & 0xFFFF) == 0:  # Group length
+        return True
+    if group % 2 == 1:
+        return compiled.remove_private_groups
+    if 0x6000 <= group <= 0x60FF:
+        return compiled.remove_overlays
+    if 0x5000 <= group <= 0x50FF:
+        return compiled.remove_curves
+    return compiled.remove_unspecified
+
+
+def _set_value(ds: Dataset, tag: int, value: str) -> None:
+    if tag in ds:
+        elem = ds[tag]
+        if elem.VR == "SQ":
+            # Sequences can only be emptied
+            if not value:
+                elem.value = []
+            return
+        elem.value = value or None
+        return
+    group = tag >> 16
+    if group == CTP_PRIVATE_GROUP:
+        creator_tag = (CTP_PRIVATE_GROUP << 16) | 0x0010
+        if creator_tag not in ds:
+            ds.add_new(creator_tag, "LO", CTP_PRIVATE_CREATOR)
+        ds.add_new(tag, "LO", value)
+        return
+    try:
+        vr = dictionary_VR(tag)
+    except KeyError:
+        vr = "LO"
+    ds.add_new(tag, vr, value or None)
+
+
+def anonymize_dataset(ds: Dataset, compiled: CompiledScript) -> None:
+    """
+    Anonymizes the given dataset in place according to the compiled script.
+    As in CTP, only the top level elements are processed, and sequences are
+    either kept (as is, like CTP does with `@keep()`) or removed.
+    """
+    evaluator = _Evaluator(compiled, ds)
+    actions = compiled.actions
+    # The PatientID is processed first, so that its anonymized value can be used by
+    # the `@hashuid(@UIDROOT,this,PatientID)` scripts of the UIDs
+    tags = [PATIENT_ID_TAG] if PATIENT_ID_TAG in ds else []
+    tags += [elem.tag for elem in ds if elem.tag != PATIENT_ID_TAG]
+    tags += [tag for tag, action in actions.items() if action.always and tag not in ds]
+    to_remove: list[int] = []
+    for tag in tags:
+        action = actions.get(tag)
+        if action is None:
+            if _is_removed_by_default(compiled, tag):
+                to_remove.append(tag)
+            continue
+        if action.keep:
+            continue
+        if action.remove:
+            to_remove.append(tag)
+            continue
+        value = "" if action.empty else evaluator.evaluate(action.script, tag)
+        evaluator.replaced[tag] = value
+    for tag in to_remove:
+        del ds[tag]
+    for tag, value in evaluator.replaced.items():
+        _set_value(ds, tag, value)
+
+
+def _provider_id(site_id: str) -> str:
+    # See `dcm_deidentify.run_ctp` for the rationale
+    return sha256(site_id.encode()).hexdigest()
+
+
+def compile_with_params(anon_script: Path, site_id: str, pepper: str) -> CompiledScript:
+    """Compiles the script, setting the parameters that `run_ctp` passes to CTP"""
+    compiled = compile_script(str(anon_script))
+    params = {
+        **compiled.params,
+        "UIDROOT": DEFAULT_UIDROOT,
+        "PROVIDERID": _provider_id(site_id),
+        "SECRET_KEY": pepper,
+    }
+    return replace(compiled, params=params)
+
+
+# Per (worker) process state, set up by `_init_worker`
+_compiled: CompiledScript | None = None
+_cache: FileCache | None = None
+_cache_key_parts: tuple[str, ...] = ()
+
+
+def _init_worker(
+    compiled: CompiledScript,
+    cache: FileCache | None = None,
+    cache_key_parts: tuple[str, ...] = (),
+) -> None:
+    global _compiled, _cache, _cache_key_parts
+    _compiled = compiled
+    _cache = cache
+    _cache_key_parts = cache_key_parts
+
+
+def _anonymize_file(task: tuple[Path, Path]) -> AnonResult:
+    file_path, output_path = task
+    try:
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        key = None
+        if _cache is not None:
+            key = cache_key("native", file_hash(file_path), *_cache_key_parts)
+            if _cache.get(key, output_path):
+                return AnonResult(file_path, None, True)
+        try:
+            ds = dcmread(file_path)
+        except InvalidDicomError:
+            return AnonResult(file_path, NOT_DICOM, False)
+        anonymize_dataset(ds, _compiled)
+        if SOP_INSTANCE_UID_TAG in ds:
+            ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+        ds.save_as(output_path)
+        if key is not None:
+            _cache.put(key, output_path)
+    except Exception as e:
+        return AnonResult(file_path, f"{type(e).__name__}: {e}", False)
+    return AnonResult(file_path, None, False)
+
+
+def run_native(
+    *,
+    input_dir: Path,
+    output_dir: Path,
+    anon_script: Path,
+    site_id: str,
+    pepper: str,
+    threads: int,
+    cache: FileCache | None = None,
+    skip: Callable[[Path], bool] | None = None,
+    on_result: Callable[[AnonResult], None] | None = None,
+) -> None:
+    """
+    Anonymizes the DICOM files in `input_dir` with the given CTP anonymization script and
+    writes them to `output_dir` keeping their relative paths, like `run_ctp` does, but
+    without using Java. The files are processed by a pool of `threads` worker processes.
+
+    The input files for which `skip` returns True are not processed, and the result of
+    each file is passed to the `on_result` callback.
+    """
+    logger.info(f"Running native anonymizer, output will be saved to {output_dir}")
+    compiled = compile_with_params(anon_script, site_id, pepper)
+    cache_key_parts = (pepper, site_id, DEFAULT_UIDROOT, file_hash(anon_script))
+    tasks = (
+        (path, output_dir / path.relative_to(input_dir))
+        for path in sorted(input_dir.rglob("*"))
+        if path.is_file()
+        and not is_index_file(path.name)
+        and (skip is None or not skip(path))
+    )
+    time_start = time.time()
+    processed = cached = failed = 0
+    with multiprocessing.Pool(
+        threads,
+        initializer=_init_worker,
+        initargs=(compiled, cache, cache_key_parts),
+    ) as pool:
+        for result in pool.imap(_anonymize_file, tasks, chunksize=16):
+            if on_result is not None:
+                on_result(result)
+            if result.error is not None:
+                failed += 1
+                logger.warning(f"Skipping file {result.path}: {result.error}")
+                continue
+            processed += 1
+            cached += result.cached
+    logger.info(
+        f"Native anonymizer completed, elapsed time: {time.time() - time_start:.3f} "
+        f"seconds, files anonymized: {processed} ({cached} from cache), "
+        f"files skipped: {failed}"
+    )
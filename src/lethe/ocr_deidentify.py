@@ -1,11 +1,504 @@
-import os
+import importlib.util
+import multiprocessing
+import shutil
 import time
+from collections import Counter, namedtuple
+from itertools import islice
 from pathlib import Path
+from typing import TYPE_CHECKING, Callable, Generator, Iterable
 
 from loguru import logger
+from pydicom import Dataset, dcmread
 from tqdm import tqdm
 
-from .defaults import DEFAULT_CPU_THREADS
+from .cache import FileCache, cache_key, file_hash
+from .defaults import DEFAULT_CPU_THREADS, DEFAULT_OCR_WORKERS
+from .dicom_utils import dcm_generator, is_dicom_file
+from .frame_ocr import needs_frame_ocr, redact_frames
+from .ocr_prefilter import PrefilterRules, skip_reason
+from .paddle_backend import PaddleBackend
+from .pii_analyzer import AnalyzerProfile, metadata_recognizers, preload_analyzer
+from .pixel_redaction import (
+    fill_boxes,
+    fill_mask,
+    is_greyscale,
+    redact_dataset,
+    write_redacted,
+)
+from .series_ocr import (
+    Box,
+    boxes_agree,
+    group_series,
+    image_geometry,
+    region_mask,
+    sample_indices,
+)
+
+if TYPE_CHECKING:
+    from .dicom_index import DicomIndex
+
+PADDLE_OCR_CONFIG = "PaddleOCR.yaml"
+# The padding added around the images before OCR (the default of the redactor engine)
+OCR_PADDING_WIDTH = 25
+# The values larger than this (i.e. the pixels) are read only when they are accessed,
+# when the files are read by the OCR pre-filter
+PREFILTER_DEFER_SIZE = 1024 * 1024
+
+# `skipped` is the name of the pre-filter rule that skipped the OCR of the file, if any
+OCRResult = namedtuple(
+    "OCRResult", ["path", "error", "cached", "skipped"], defaults=(None,)
+)
+
+# The redactor engine of the current process. It is created once per (worker)
+# process by `_init_worker` since loading the OCR and NLP models is expensive.
+_engine = None
+_paddle_ocr: bool = False
+_paddle_backend: PaddleBackend | None = None
+_analyzer: AnalyzerProfile = AnalyzerProfile.full
+# The (optional) cache of redacted files and the "fingerprint" of the OCR
+# configuration that is part of the cache keys
+_cache: FileCache | None = None
+_ocr_config_hash: str = ""
+# The (optional) rules of the pre-filter that skips the files without burned-in text
+_rules: PrefilterRules | None = None
+# The maximum size of the images (after downscaling) for the detection of the text of
+# large and multi-frame images, which are then OCRed frame by frame (if set)
+_max_side: int | None = None
+# The number of images that are OCRed at once (if the OCR supports it)
+_batch_size: int = 1
+
+
+def create_redactor_engine(
+    paddle_ocr: bool,
+    threads: int,
+    batch_size: int = 1,
+    analyzer: AnalyzerProfile = AnalyzerProfile.full,
+    paddle_backend: PaddleBackend | None = None,
+):
+    from presidio_image_redactor import DicomImageRedactorEngine, ImageAnalyzerEngine
+
+    from .pii_analyzer import load_analyzer
+
+    engine = DicomImageRedactorEngine(
+        image_analyzer_engine=ImageAnalyzerEngine(
+            analyzer_engine=load_analyzer(analyzer)
+        )
+    )
+    if paddle_ocr:
+        from .paddle_ocr import PresidioPaddleOCR
+
+        engine.image_analyzer_engine.ocr = PresidioPaddleOCR(
+            config_file=PADDLE_OCR_CONFIG,
+            num_threads=threads,
+            batch_size=batch_size,
+            backend=paddle_backend,
+        )
+    elif tesseract_api_available():
+        from .tesseract_ocr import PresidioTesserOCR
+
+        engine.image_analyzer_engine.ocr = PresidioTesserOCR()
+    return engine
+
+
+def tesseract_api_available() -> bool:
+    """
+    Whether tesserocr (the Python binding of the Tesseract API) is installed, so that
+    Tesseract OCR is performed in process (see `tesseract_ocr`) instead of running
+    a `tesseract` process for each image (pytesseract)
+    """
+    return importlib.util.find_spec("tesserocr") is not None
+
+
+def ocr_config_fingerprint(
+    paddle_ocr: bool,
+    analyzer: AnalyzerProfile = AnalyzerProfile.full,
+    paddle_backend: PaddleBackend | None = None,
+) -> str:
+    if paddle_ocr:
+        # The backend of the configuration file is part of its hash
+        fingerprint = cache_key("paddle", file_hash(Path(PADDLE_OCR_CONFIG)))
+        if paddle_backend is not None:
+            fingerprint = cache_key(fingerprint, "backend", paddle_backend.value)
+    elif tesseract_api_available():
+        fingerprint = cache_key("tesseract", "api")
+    else:
+        fingerprint = cache_key("tesseract")
+    if analyzer != AnalyzerProfile.full:
+        fingerprint = cache_key(fingerprint, "analyzer", analyzer.value)
+    return fingerprint
+
+
+def _init_worker(
+    paddle_ocr: bool,
+    threads: int,
+    cache: FileCache | None = None,
+    rules: PrefilterRules | None = None,
+    batch_size: int = 1,
+    max_side: int | None = None,
+    analyzer: AnalyzerProfile = AnalyzerProfile.full,
+    paddle_backend: PaddleBackend | None = None,
+) -> None:
+    global _engine, _paddle_ocr, _paddle_backend, _analyzer, _batch_size
+    _engine = create_redactor_engine(
+        paddle_ocr, threads, batch_size, analyzer, paddle_backend
+    )
+    _batch_size = batch_size
+    _paddle_ocr = paddle_ocr
+    _paddle_backend = paddle_backend
+    _analyzer = analyzer
+    _configure(cache, rules, max_side)
+
+
+def _configure(
+    cache: FileCache | None, rules: PrefilterRules | None, max_side: int | None
+) -> None:
+    """Sets the settings of the current run in a (worker) process"""
+    global _cache, _ocr_config_hash, _rules, _max_side
+    _cache = cache
+    _rules = rules
+    _max_side = max_side
+    if cache is not None:
+        _ocr_config_hash = ocr_config_fingerprint(
+            _paddle_ocr, _analyzer, _paddle_backend
+        )
+        if max_side is not None:
+            _ocr_config_hash = cache_key(_ocr_config_hash, "frames", str(max_side))
+
+
+def find_text_boxes(engine, analyzer: AnalyzerProfile, image, header) -> list[Box]:
+    """
+    Detects the text to redact in a (padded) image with a redactor engine, as it does
+    (using the metadata of the `header`), returning its bounding boxes in the original
+    image
+    """
+    results = engine._get_analyzer_results(
+        image, header, True, None, metadata_recognizers(analyzer, header)
+    )
+    bboxes = engine.bbox_processor.get_bboxes_from_analyzer_results(results)
+    return engine.bbox_processor.remove_bbox_padding(bboxes, OCR_PADDING_WIDTH)
+
+
+def ocr_input_image(engine, ds):
+    """The (padded) image of a dataset that a redactor engine passes to the OCR"""
+    from PIL import Image
+
+    greyscale = engine._check_if_greyscale(ds)
+    image = engine._rescale_dcm_pixel_array(ds, greyscale)
+    image = Image.fromarray(image, mode="L" if greyscale else "RGB")
+    return engine._add_padding(image, greyscale, OCR_PADDING_WIDTH)
+
+
+def redact_dataset_text(engine, analyzer: AnalyzerProfile, ds) -> bool:
+    """
+    Redacts (in place) the text found in the image of a (single frame) dataset read in
+    memory, see `pixel_redaction.redact_dataset`. Returns True if any was found.
+    """
+    boxes = find_text_boxes(engine, analyzer, ocr_input_image(engine, ds), ds)
+    if not boxes:
+        return False
+    greyscale = is_greyscale(ds)
+    return redact_dataset(ds, lambda _, frame: fill_boxes(frame, boxes, greyscale), [0])
+
+
+def _prefetch(images: list) -> list[dict | None]:
+    """
+    Performs the OCR of a batch of (padded) images at once, if the OCR supports it,
+    returning their results for `_find_prefetched_boxes` (None if not OCRed)
+    """
+    ocr = _engine.image_analyzer_engine.ocr
+    if len(images) > 1 and hasattr(ocr, "prefetch"):
+        try:
+            return ocr.prefetch(images)
+        except Exception as e:
+            logger.warning(f"Batch OCR failed, OCRing the images one by one: {e}")
+    return [None] * len(images)
+
+
+def _find_prefetched_boxes(image, header, prefetched: dict | None) -> list[Box]:
+    """
+    Detects the text to redact in an image as `find_text_boxes`, using the result of
+    its OCR if it was `prefetched` (in a batch)
+    """
+    if prefetched is None:
+        return find_text_boxes(_engine, _analyzer, image, header)
+    ocr = _engine.image_analyzer_engine.ocr
+    ocr.set_next_result(prefetched)
+    try:
+        return find_text_boxes(_engine, _analyzer, image, header)
+    finally:
+        if ocr.set_next_result(None) is not None:
+            logger.warning("The batch OCR result of an image was not used")
+
+
+def padded_frame_image(engine, image):
+    """The (padded) image that a redactor engine passes to the OCR, of an 8 bit frame"""
+    from PIL import Image
+
+    greyscale = image.ndim == 2
+    image = Image.fromarray(image, mode="L" if greyscale else "RGB")
+    return engine._add_padding(image, greyscale, OCR_PADDING_WIDTH)
+
+
+def _detect_text(images: list, header) -> list[list[Box]]:
+    """Detects the text to redact in a batch of 8 bit images (of frames)"""
+    padded = [padded_frame_image(_engine, image) for image in images]
+    return [
+        _find_prefetched_boxes(image, header, prefetched)
+        for image, prefetched in zip(padded, _prefetch(padded))
+    ]
+
+
+def _redact_frames(file_path: Path, output_path: Path, header) -> None:
+    """
+    Redacts a file frame by frame (see `frame_ocr`), detecting the text of batches of
+    its frames if the OCR supports it
+    """
+    ocr = _engine.image_analyzer_engine.ocr
+    redact_frames(
+        file_path,
+        output_path,
+        lambda images: _detect_text(images, header),
+        _max_side,
+        _batch_size if hasattr(ocr, "prefetch") else 1,
+    )
+
+
+def _write_boxes(file_path: Path, output_path: Path, ds, boxes: list[Box]) -> None:
+    """
+    Redacts the boxes in the pixels of a (single frame) file, see `write_redacted`, or
+    passes it through untouched if there are none
+    """
+    if not boxes:
+        shutil.copyfile(file_path, output_path)
+        return
+    greyscale = is_greyscale(ds)
+    write_redacted(
+        file_path,
+        output_path,
+        ds,
+        lambda _, frame: fill_boxes(frame, boxes, greyscale),
+        [0],
+    )
+
+
+def _frame_header_of(file_path: Path, ds=None):
+    """
+    The header of a file if it must be OCRed frame by frame, None otherwise. The
+    dataset `ds` of the file is used as its header, if it has already been read.
+    """
+    if _max_side is None:
+        return None
+    header = ds if ds is not None else dcmread(file_path, stop_before_pixels=True)
+    return header if needs_frame_ocr(header, _max_side) else None
+
+
+def _prepare_file(
+    task: tuple[Path, Path],
+) -> tuple[OCRResult | None, Path, str | None, Dataset | None]:
+    """
+    Checks whether a file needs to be OCRed: returns its result if it was skipped by the
+    pre-filter or found in the cache, its output path, its cache key (if any) and its
+    dataset if it was read by the pre-filter (to be reused for the redaction)
+    """
+    file_path, output_path_dir = task
+    output_path_dir.mkdir(parents=True, exist_ok=True)
+    # The output file has the same name as the input file
+    output_path = output_path_dir / file_path.name
+    ds = None
+    if _rules is not None:
+        # The pixels are only read when they are accessed, and the first frame of the
+        # images that are OCRed frame by frame is read on its own
+        ds = dcmread(file_path, defer_size=PREFILTER_DEFER_SIZE)
+        frames = _frame_header_of(file_path, ds) is not None
+        reason = skip_reason(ds, _rules, file_path if frames else None)
+        if reason is not None:
+            # Passed through untouched
+            shutil.copyfile(file_path, output_path)
+            return OCRResult(file_path, None, False, reason), output_path, None, None
+    key = None
+    if _cache is not None:
+        key = cache_key("ocr", file_hash(file_path), _ocr_config_hash)
+        if _cache.get(key, output_path):
+            return OCRResult(file_path, None, True), output_path, key, None
+    return None, output_path, key, ds
+
+
+def _redact_file(task: tuple[Path, Path]) -> OCRResult:
+    file_path, output_path_dir = task
+    try:
+        result, output_path, key, ds = _prepare_file(task)
+        if result is not None:
+            return result
+        if (header := _frame_header_of(file_path, ds)) is not None:
+            _redact_frames(file_path, output_path, header)
+        else:
+            if ds is None:
+                ds = dcmread(file_path)
+            image = ocr_input_image(_engine, ds)
+            boxes = find_text_boxes(_engine, _analyzer, image, ds)
+            _write_boxes(file_path, output_path, ds, boxes)
+        if key is not None:
+            _cache.put(key, output_path)
+    except Exception as e:
+        # A partial output file would be taken as a redacted file by the next steps
+        (output_path_dir / file_path.name).unlink(missing_ok=True)
+        return OCRResult(file_path, f"{type(e).__name__}: {e}", False)
+    return OCRResult(file_path, None, False)
+
+
+def _redact_batch(tasks: list[tuple[Path, Path]]) -> list[OCRResult]:
+    """
+    Redacts a batch of files, performing the OCR of all their images at once (if the
+    OCR supports it). The images that are OCRed frame by frame (see `frame_ocr`) are
+    OCRed on their own, in batches of their frames.
+    """
+    results: list[OCRResult | None] = [None] * len(tasks)
+    pending = []
+    images = []
+    for i, task in enumerate(tasks):
+        try:
+            result, output_path, key, ds = _prepare_file(task)
+            if result is not None:
+                results[i] = result
+                continue
+            if (header := _frame_header_of(task[0], ds)) is not None:
+                # Large images are OCRed on their own, frame by frame
+                _redact_frames(task[0], output_path, header)
+                if key is not None:
+                    _cache.put(key, output_path)
+                results[i] = OCRResult(task[0], None, False)
+                continue
+            if ds is None:
+                ds = dcmread(task[0])
+            image = ocr_input_image(_engine, ds)
+            pending.append((i, ds, image, output_path, key))
+            images.append(image)
+        except Exception as e:
+            (task[1] / task[0].name).unlink(missing_ok=True)
+            results[i] = OCRResult(task[0], f"{type(e).__name__}: {e}", False)
+    prefetched = _prefetch(images)
+    for (i, ds, image, output_path, key), result in zip(pending, prefetched):
+        file_path = tasks[i][0]
+        try:
+            _write_boxes(
+                file_path,
+                output_path,
+                ds,
+                _find_prefetched_boxes(image, ds, result),
+            )
+            if key is not None:
+                _cache.put(key, output_path)
+            results[i] = OCRResult(file_path, None, False)
+        except Exception as e:
+            output_path.unlink(missing_ok=True)
+            results[i] = OCRResult(file_path, f"{type(e).__name__}: {e}", False)
+    return results
+
+
+def _batches(tasks: Iterable, batch_size: int) -> Generator[list, None, None]:
+    tasks = iter(tasks)
+    while batch := list(islice(tasks, batch_size)):
+        yield batch
+
+
+def _redact_series(
+    task: tuple[list[tuple[Path, Path]], int],
+) -> tuple[list[tuple[Path, Path]], list[OCRResult] | None]:
+    """
+    Redacts a series (the tasks of its files, in order) by detecting the text regions
+    in `samples` of its slices and redacting their union in all the slices. Returns
+    the tasks of the series and their results, or None as results if the samples do
+    not agree (or cannot be processed), in which case each slice must be OCRed.
+
+    Samples without any text are no evidence that the other slices have none (e.g. the
+    text may only be in some of them), so they do not count as agreeing.
+    """
+    tasks, samples = task
+    try:
+        sample_boxes = []
+        geometry = None
+        for i in sample_indices(len(tasks), samples):
+            ds = dcmread(tasks[i][0])
+            if geometry is None:
+                geometry = image_geometry(ds)
+            if image_geometry(ds) != geometry or geometry[3] != 1:
+                return tasks, None
+            image = ocr_input_image(_engine, ds)
+            sample_boxes.append(find_text_boxes(_engine, _analyzer, image, ds))
+        if not any(sample_boxes) or not boxes_agree(sample_boxes):
+            return tasks, None
+    except Exception as e:
+        logger.warning(
+            f"Cannot detect the text regions of the series of {tasks[0][0]}, OCRing "
+            f"its slices one by one: {type(e).__name__}: {e}"
+        )
+        return tasks, None
+    mask = region_mask(sample_boxes, geometry[0], geometry[1])
+    return tasks, [_fill_file(t, mask, geometry) for t in tasks]
+
+
+def _fill_file(task: tuple[Path, Path], mask, geometry: tuple) -> OCRResult:
+    """Redacts the text regions (`mask`) of a series in one of its slices"""
+    file_path, output_path_dir = task
+    try:
+        output_path_dir.mkdir(parents=True, exist_ok=True)
+        output_path = output_path_dir / file_path.name
+        # The pixels are only read (if needed) when the file is redacted
+        ds = dcmread(
+            file_path, stop_before_pixels=_rules is None or not _rules.text_likelihood
+        )
+        if _rules is not None:
+            reason = skip_reason(ds, _rules)
+            if reason is not None:
+                shutil.copyfile(file_path, output_path)
+                return OCRResult(file_path, None, False, reason)
+        if image_geometry(ds) != geometry:
+            # A slice that differs from the rest of the series
+            return _redact_file(task)
+        if not mask.any():
+            # Nothing to redact, so the file is passed through untouched
+            shutil.copyfile(file_path, output_path)
+        else:
+            greyscale = is_greyscale(ds)
+            write_redacted(
+                file_path,
+                output_path,
+                ds,
+                lambda _, frame: fill_mask(frame, mask, greyscale),
+                [0],
+            )
+    except Exception as e:
+        (output_path_dir / file_path.name).unlink(missing_ok=True)
+        return OCRResult(file_path, f"{type(e).__name__}: {e}", False)
+    return OCRResult(file_path, None, False)
+
+
+# The functions that the OCR server (see `ocr_server`) runs for its clients
+SERVED_FUNCTIONS = {
+    f.__name__: f for f in (_redact_file, _redact_batch, _redact_series)
+}
+
+
+def _serve_task(function: str, settings: tuple, task):
+    """
+    Runs an OCR task for a client of the OCR server, with the `settings` of its run: the
+    directory and maximum size of the cache (if any), the pre-filter rules and the
+    maximum side of the images for the frame by frame OCR
+    """
+    cache_settings, rules, max_side = settings
+    cache = _cache
+    if cache_settings is None:
+        cache = None
+    elif cache is None or (cache.cache_dir, cache.max_size) != cache_settings:
+        cache = FileCache(*cache_settings)
+    _configure(cache, rules, max_side)
+    return SERVED_FUNCTIONS[function](task)
+
+
+def _dicom_files(input_dir: Path) -> Generator[Path, None, None]:
+    for file_path in input_dir.rglob("*"):
+        if file_path.is_file() and is_dicom_file(file_path):
+            yield file_path
 
 
 def perform_ocr(
@@ -14,43 +507,228 @@ def perform_ocr(
     paddle_ocr: bool = True,
     verbose: bool = False,
     threads: int = DEFAULT_CPU_THREADS,
+    workers: int = DEFAULT_OCR_WORKERS,
+    cache: FileCache | None = None,
+    index: "DicomIndex | None" = None,
+    skip: Callable[[Path], bool] | None = None,
+    on_result: Callable[[OCRResult], None] | None = None,
+    prefilter: PrefilterRules | None = None,
+    series_samples: int | None = None,
+    batch_size: int = 1,
+    max_side: int | None = None,
+    server: Path | None = None,
+    analyzer: AnalyzerProfile = AnalyzerProfile.full,
+    paddle_backend: PaddleBackend | None = None,
 ) -> None:
-    from presidio_image_redactor import DicomImageRedactorEngine
+    """
+    Redacts the burned-in text of all the DICOM files found in `input_dir` and writes
+    the redacted files in `output_dir`, keeping the same relative paths.
 
-    engine = DicomImageRedactorEngine()
-    if paddle_ocr:
-        from .paddle_ocr import PresidioPaddleOCR
+    If `workers` is more than 1, the files are distributed to a pool of worker
+    processes, each one with its own redactor engine, and the available `threads` are
+    split among them. Results are logged in the order of the input files. A file that
+    fails to be redacted is reported and skipped, i.e. it is not written to the output
+    directory.
 
-        engine.image_analyzer_engine.ocr = PresidioPaddleOCR(
-            config_file="PaddleOCR.yaml",
-            num_threads=threads,
-        )
+    If a `cache` is given, files that were redacted in previous runs (with the same OCR
+    configuration) are copied from the cache instead of being processed again.
+
+    If an `index` of the `input_dir` is given, the DICOM files are taken from it
+    instead of checking all the files of the folder.
+
+    The input files for which `skip` returns True are not processed (e.g. files already
+    redacted by an interrupted run), and the result of each file is passed to the
+    `on_result` callback.
+
+    If `prefilter` rules are given, the files that cannot contain burned-in text
+    according to them (see `ocr_prefilter`) are copied unchanged to the `output_dir`
+    instead of being OCRed, and the number of files skipped by each rule is reported.
+
+    If `series_samples` is given, the files are grouped by series and the text regions
+    of each series are detected in that number of sample slices. If the regions of the
+    samples agree (and have some text), their union is redacted in all the slices of the
+    series, without OCR. Otherwise (and for the series with no more slices than the
+    samples) each slice is OCRed. The cache is only used for the slices that are OCRed.
+
+    With PaddleOCR, the files are processed in batches of `batch_size` files whose
+    images are OCRed together, which reduces the overhead of each OCR call.
+
+    If `max_side` is given, the multi-frame images and the images larger than it are
+    OCRed one frame at a time, detecting the text on a copy of each frame downscaled to
+    `max_side`, so that the memory used does not depend on the number of frames (see
+    `frame_ocr`).
+
+    If the path of the Unix socket of an OCR `server` is given and a compatible server
+    is listening on it (see `ocr_server`), the files are redacted by the server, which
+    has the OCR models already loaded, instead of local worker processes.
+
+    The `analyzer` is the profile of the analyzer that finds the PII in the text found
+    by the OCR (see `pii_analyzer`). With more than one worker, it is loaded before
+    the workers are forked, so that they share its memory.
+
+    The `paddle_backend`, if given, overrides the backend of the PaddleOCR configuration
+    that runs its models (see `paddle_backend`).
+    """
     logger.info("Starting OCR pipeline, output will be saved to {}".format(output_dir))
+    files = (
+        file_path
+        for file_path in (
+            index.dicom_files() if index is not None else _dicom_files(input_dir)
+        )
+        if skip is None or not skip(file_path)
+    )
+
+    def task(file_path: Path) -> tuple[Path, Path]:
+        output_path_dir = output_dir / file_path.parent.relative_to(input_dir)
+        # Absolute paths, that an OCR server can also use
+        return file_path.absolute(), output_path_dir.absolute()
+
+    if not paddle_ocr:
+        batch_size = 1
+
+    def redact_files(run, file_tasks) -> Iterable[OCRResult]:
+        if batch_size <= 1:
+            return run(_redact_file, file_tasks)
+        return (
+            result
+            for batch in run(_redact_batch, _batches(file_tasks, batch_size))
+            for result in batch
+        )
+
+    series_stats: Counter[str] = Counter()
+
+    def series_results(run) -> Generator[OCRResult, None, None]:
+        file_list = list(files)
+        file_infos = (
+            index.file_infos() if index is not None else dcm_generator(input_dir)
+        )
+        wanted = set(file_list)
+        series = group_series(info for info in file_infos if info.path in wanted)
+        # The files not in a series large enough are OCRed one by one
+        in_series = {
+            path
+            for paths in series.values()
+            if len(paths) > series_samples
+            for path in paths
+        }
+        singles = [task(path) for path in file_list if path not in in_series]
+        series_tasks = (
+            ([task(path) for path in paths], series_samples)
+            for paths in series.values()
+            if len(paths) > series_samples
+        )
+        for tasks, results in run(_redact_series, series_tasks):
+            if results is None:
+                series_stats["fallback"] += 1
+                singles.extend(tasks)
+                continue
+            series_stats["reused"] += 1
+            yield from results
+        yield from redact_files(run, singles)
+
+    pool = None
+    client = None
+    if server is not None:
+        from .ocr_server import OCRClient
+
+        cache_settings = (cache.cache_dir.absolute(), cache.max_size) if cache else None
+        client = OCRClient.connect(
+            server,
+            paddle_ocr,
+            analyzer,
+            paddle_backend,
+            (cache_settings, prefilter, max_side),
+        )
+    if client is not None:
+        run = client.imap
+    elif workers > 1:
+        worker_threads = max(1, threads // workers)
+        logger.info(
+            f"Using {workers} OCR worker processes with {worker_threads} thread(s) each"
+        )
+        preload_analyzer(analyzer)
+        # Forked, to share the analyzer loaded in this process
+        pool = multiprocessing.get_context("fork").Pool(
+            workers,
+            initializer=_init_worker,
+            initargs=(
+                paddle_ocr,
+                worker_threads,
+                cache,
+                prefilter,
+                batch_size,
+                max_side,
+                analyzer,
+                paddle_backend,
+            ),
+        )
+        run = pool.imap
+    else:
+        _init_worker(
+            paddle_ocr,
+            threads,
+            cache,
+            prefilter,
+            batch_size,
+            max_side,
+            analyzer,
+            paddle_backend,
+        )
+        run = map
+    if series_samples is None:
+        results = redact_files(run, map(task, files))
+    else:
+        results = series_results(run)
+
     cnt = 0
-    files_to_process = input_dir.rglob("*")
-    files_with_progress = files_to_process if verbose else tqdm(files_to_process)
+    cached = 0
+    failed = 0
+    skipped: Counter[str] = Counter()
     time_start = time.time()
-    for file_path in files_with_progress:
-        if not file_path.is_file():
-            continue
-        is_dicom: bool = False
-        with open(file_path, "rb") as f:
-            is_dicom = f.seek(128) == 128 and f.read(4) == b"DICM"
-        if not is_dicom:
-            continue
-        output_path_dir = output_dir / file_path.parent.relative_to(input_dir)
-        if not output_path_dir.exists():
-            output_path_dir.mkdir(parents=True, exist_ok=True)
-        if verbose:
-            logger.info(f"OCR processing file {file_path}")
-        engine.redact_from_file(
-            os.fspath(file_path),
-            os.fspath(output_path_dir),
-            fill="contrast",
-            use_metadata=True,
-            save_bboxes=False,
-            verbose=False,
-        )
-        cnt += 1
+    try:
+        for result in results if verbose else tqdm(results):
+            if on_result is not None:
+                on_result(result)
+            if result.error is not None:
+                failed += 1
+                logger.error(f"OCR failed for file {result.path}: {result.error}")
+                continue
+            if result.skipped is not None:
+                skipped[result.skipped] += 1
+                if verbose:
+                    logger.info(
+                        f"OCR skipped ({result.skipped}) for file {result.path}"
+                    )
+                continue
+            if verbose:
+                logger.info(
+                    f"OCR {'cached' if result.cached else 'processed'} file {result.path}"
+                )
+            cnt += 1
+            cached += result.cached
+    finally:
+        if pool is not None:
+            # All the results have been consumed at this point (unless interrupted)
+            pool.terminate()
+            pool.join()
+        if client is not None:
+            client.close()
     time_end = time.time()
     logger.info(f"Redacted {cnt} files in {time_end - time_start:.3f} seconds")
+    if cache is not None:
+        logger.info(f"{cached} of the redacted files were found in the cache")
+    if series_samples is not None:
+        logger.info(
+            f"Reused the text regions of {series_stats['reused']} series, "
+            f"{series_stats['fallback']} series were OCRed slice by slice "
+            "because their samples did not agree or had no text"
+        )
+    if prefilter is not None:
+        logger.info(
+            f"OCR pre-filter passed through {skipped.total()} file(s) without OCR"
+            + "".join(f", {rule}: {n}" for rule, n in sorted(skipped.items()))
+        )
+    if failed:
+        logger.warning(
+            f"{failed} file(s) failed OCR and were not written to the output"
+        )
@@ -0,0 +1,163 @@
+"""
+A fast "pre-filter" of the DICOM files before OCR: files that cannot contain burned-in text,
+according to their headers or to a cheap check of their pixels, are not sent to the (slow)
+OCR and are passed through untouched.
+
+The header rules are checked first. If they cannot decide, the pixels of the (first frame
+of the) image are downsampled and checked for "text like" pixels: burned-in text is drawn
+with (nearly) the maximum intensity of the image and has sharp edges. The checks err on the
+side of OCR: a file is skipped only when a rule clearly says so.
+"""
+
+import json
+from dataclasses import dataclass, field, fields
+from pathlib import Path
+
+import numpy as np
+from pydicom import Dataset
+from pydicom.pixels import pixel_array
+
+# The SOP classes of the "Secondary Capture" images (e.g. screenshots, scanned documents)
+# that usually contain burned-in text
+SECONDARY_CAPTURE_SOP_CLASSES = [
+    "1.2.840.10008.5.1.4.1.1.7",
+    "1.2.840.10008.5.1.4.1.1.7.1",
+    "1.2.840.10008.5.1.4.1.1.7.2",
+    "1.2.840.10008.5.1.4.1.1.7.3",
+    "1.2.840.10008.5.1.4.1.1.7.4",
+]
+
+# The names of the rules, as reported in the statistics of the skipped files
+NO_IMAGE = "no_image"
+BURNED_IN_ANNOTATION = "burned_in_annotation"
+TOO_SMALL = "too_small"
+ORIGINAL_IMAGE_MODALITY = "original_image_modality"
+NO_TEXT_LIKE_PIXELS = "no_text_like_pixels"
+
+
+@dataclass(kw_only=True)
+class PrefilterRules:
+    # Trust the BurnedInAnnotation tag, when it is present
+    use_burned_in_annotation: bool = True
+    # The SOP classes of the images that are always OCRed
+    always_ocr_sop_classes: list[str] = field(
+        default_factory=lambda: list(SECONDARY_CAPTURE_SOP_CLASSES)
+    )
+    # The "original" (acquired, i.e. not derived or secondary) images of these
+    # modalities are not OCRed
+    original_image_modalities: list[str] = field(
+        default_factory=lambda: ["CT", "MR", "PT", "NM"]
+    )
+    # Images smaller than this (in either dimension) are not OCRed
+    min_size: int = 32
+    # Check the pixels of the images for text like pixels
+    text_likelihood: bool = True
+    # The size (of the largest dimension) of the downsampled image that is checked
+    downsample_size: int = 256
+    # The images with fewer text like pixels (in the downsampled image) are not OCRed
+    min_text_pixels: int = 10
+
+
+def load_prefilter_rules(config_file: Path | None) -> PrefilterRules:
+    """
+    Loads the rules from a JSON file, whose keys are the names of the `PrefilterRules`
+    fields to override. Returns the default rules if no file is given.
+    """
+    if config_file is None:
+        return PrefilterRules()
+    config = json.loads(config_file.read_text())
+    names = {f.name for f in fields(PrefilterRules)}
+    unknown = set(config) - names
+    if unknown:
+        raise ValueError(f"Unknown OCR pre-filter rules in {config_file}: {unknown}")
+    return PrefilterRules(**config)
+
+
+# The result of the header rules when the image must be OCRed
+_MUST_OCR = "must_ocr"
+
+
+def _check_header(ds: Dataset, rules: PrefilterRules) -> str | None:
+    """
+    Checks the header of a DICOM dataset (the pixels are not needed) and returns the
+    name of the rule that says that it cannot contain burned-in text, `_MUST_OCR` if
+    it must be OCRed, or None if the header rules cannot decide
+    """
+    if "Rows" not in ds or "Columns" not in ds:
+        return NO_IMAGE
+    burned_in = str(ds.get("BurnedInAnnotation", "")).upper()
+    if rules.use_burned_in_annotation and burned_in == "YES":
+        return _MUST_OCR
+    if str(ds.get("SOPClassUID", "")) in rules.always_ocr_sop_classes:
+        return _MUST_OCR
+    if rules.use_burned_in_annotation and burned_in == "NO":
+        return BURNED_IN_ANNOTATION
+    if min(ds.Rows, ds.Columns) < rules.min_size:
+        return TOO_SMALL
+    image_type = ds.get("ImageType", [])
+    if (
+        ds.get("Modality", "") in rules.original_image_modalities
+        and len(image_type) > 0
+        and image_type[0] == "ORIGINAL"
+    ):
+        return ORIGINAL_IMAGE_MODALITY
+    return None
+
+
+def text_like_pixels(frame: np.ndarray, size: int) -> int:
+    """
+    Counts the "text like" pixels of an image frame, downsampled so that its largest
+    dimension is about `size`: the pixels with (nearly) the maximum intensity that
+    differ sharply from a neighbouring pixel. The image is downsampled by taking the
+    maximum of each block of pixels, so that thin bright strokes are not lost.
+    """
+    if frame.ndim == 3:
+        # Color images: use the brightest channel
+        frame = frame.max(axis=-1)
+    step = max(1, max(frame.shape) // size)
+    h, w = (frame.shape[0] // step) * step, (frame.shape[1] // step) * step
+    small = (
+        frame[:h, :w]
+        .reshape(h // step, step, w // step, step)
+        .max(axis=(1, 3))
+        .astype(np.float32)
+    )
+    lo, hi = small.min(), small.max()
+    if hi <= lo:
+        return 0
+    norm = (small - lo) / (hi - lo)
+    bright = norm >= 0.9
+    edges = np.zeros_like(bright)
+    edges[:, 1:] |= np.abs(np.diff(norm, axis=1)) >= 0.5
+    edges[:, :-1] |= edges[:, 1:]
+    vertical = np.abs(np.diff(norm, axis=0)) >= 0.5
+    edges[1:, :] |= vertical
+    edges[:-1, :] |= vertical
+    return int(np.count_nonzero(bright & edges))
+
+
+def skip_reason(
+    ds: Dataset, rules: PrefilterRules, path: Path | None = None
+) -> str | None:
+    """
+    Returns the name of the rule that says that the DICOM dataset cannot contain
+    burned-in text, or None if it should be OCRed. Only the first frame of the pixels
+    is decoded: from the file at `path` if given (e.g. for large multi-frame images,
+    without reading the other frames), otherwise from the `ds` if it has them (i.e. it
+    was not read with `stop_before_pixels`).
+    """
+    reason = _check_header(ds, rules)
+    if reason == _MUST_OCR:
+        return None
+    if reason is not None or not rules.text_likelihood:
+        return reason
+    if path is None and "PixelData" not in ds:
+        return reason
+    try:
+        pixels = pixel_array(path if path is not None else ds, index=0)
+    except Exception:
+        # Cannot decode the pixels here, so let the OCR decide
+        return None
+    if text_like_pixels(pixels, rules.downsample_size) < rules.min_text_pixels:
+        return NO_TEXT_LIKE_PIXELS
+    return None
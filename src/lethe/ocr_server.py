@@ -0,0 +1,294 @@
+"""
+A long-lived local OCR server (`lethe serve-ocr`), that keeps the OCR and NLP models loaded in
+a pool of worker processes and redacts files for the `run` commands that connect to it through
+a Unix socket, so that they do not pay the (long) model loading time each time.
+
+The requests and the results are sent as pickled Python objects (using the connections of the
+`multiprocessing` module), so the socket is only accessible by its owner, it must be in a
+directory that only its owner can write to, and the connections are authenticated with a
+random key that the server writes next to the socket (readable only by its owner). A client
+connects only to a socket (and key) owned by the same user. The server and the clients must
+see the files at the same paths.
+"""
+
+import multiprocessing
+import os
+import queue
+import signal
+import sys
+import threading
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import (
+    Client,
+    Connection,
+    Listener,
+    answer_challenge,
+    deliver_challenge,
+)
+from pathlib import Path
+from typing import Any, Callable, Iterable, Iterator
+
+from loguru import logger
+
+from .ocr_deidentify import (
+    SERVED_FUNCTIONS,
+    _init_worker,
+    _serve_task,
+    ocr_config_fingerprint,
+)
+from .paddle_backend import PaddleBackend
+from .pii_analyzer import AnalyzerProfile, preload_analyzer
+from .version import __version__
+
+
+def _handle_connection(
+    conn: Connection, pool, hello: dict[str, Any], authkey: bytes
+) -> None:
+    """
+    Serves the requests of a client, once authenticated with the `authkey`: each request
+    is submitted to the pool as soon as it is received, and the results are sent back in
+    the order of the requests
+    """
+    try:
+        # As `Listener.accept` does, but in the thread of the connection, so that a
+        # client that does not authenticate does not block the others
+        deliver_challenge(conn, authkey)
+        answer_challenge(conn, authkey)
+    except (AuthenticationError, EOFError, OSError) as e:
+        logger.warning(f"Rejected a connection to the OCR server: {e}")
+        conn.close()
+        return
+    pending: queue.Queue = queue.Queue()
+
+    def send_results() -> None:
+        while (async_result := pending.get()) is not None:
+            try:
+                response = (True, async_result.get())
+            except Exception as e:
+                response = (False, f"{type(e).__name__}: {e}")
+            try:
+                conn.send(response)
+            except OSError:
+                return
+
+    sender = threading.Thread(target=send_results, daemon=True)
+    sender.start()
+    try:
+        conn.send(hello)
+        while True:
+            function, settings, task = conn.recv()
+            if function not in SERVED_FUNCTIONS:
+                raise ValueError(f"Unknown function {function}")
+            pending.put(pool.apply_async(_serve_task, (function, settings, task)))
+    except (EOFError, OSError):
+        pass
+    except Exception as e:
+        logger.warning(f"Closing connection after an invalid request: {e}")
+    finally:
+        pending.put(None)
+        sender.join()
+        conn.close()
+
+
+def _key_path(socket_path: Path) -> Path:
+    """The file of the authentication key of the server listening on `socket_path`"""
+    return socket_path.with_name(f"{socket_path.name}.key")
+
+
+def _unsafe_reason(path: Path) -> str | None:
+    """
+    Why the socket (or key) `path` cannot be trusted: it, or its directory, is not owned
+    by the current user, or its directory can be written by others (who could replace it)
+    """
+    uid = os.getuid()
+    parent = path.parent.stat()
+    if parent.st_uid != uid:
+        return f"{path.parent} is not owned by the current user"
+    if parent.st_mode & 0o022:
+        return f"{path.parent} is writable by other users"
+    if path.exists() and path.stat().st_uid != uid:
+        return f"{path} is not owned by the current user"
+    return None
+
+
+def _prepare_socket_dir(socket_path: Path) -> None:
+    """Creates the (private) directory of the socket, and checks that it is safe"""
+    socket_path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+    if reason := _unsafe_reason(socket_path):
+        raise RuntimeError(f"Cannot listen on {socket_path}: {reason}")
+
+
+def _write_key(key_path: Path) -> bytes:
+    key = os.urandom(32)
+    key_path.unlink(missing_ok=True)
+    fd = os.open(key_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        f.write(key)
+    return key
+
+
+def _remove_stale_socket(socket_path: Path) -> None:
+    if not socket_path.exists():
+        return
+    try:
+        Client(os.fspath(socket_path), family="AF_UNIX").close()
+    except OSError:
+        socket_path.unlink()
+        return
+    raise RuntimeError(f"An OCR server is already listening on {socket_path}")
+
+
+def serve(
+    socket_path: Path,
+    *,
+    paddle_ocr: bool,
+    threads: int,
+    workers: int,
+    batch_size: int = 1,
+    analyzer: AnalyzerProfile = AnalyzerProfile.full,
+    paddle_backend: PaddleBackend | None = None,
+) -> None:
+    """
+    Runs the OCR server on the `socket_path` until it is interrupted, with a pool of
+    `workers` processes that load the OCR models once (splitting the `threads`, and
+    with the `paddle_backend` if given) and share the PII `analyzer`, loaded before
+    they are forked
+    """
+    _prepare_socket_dir(socket_path)
+    _remove_stale_socket(socket_path)
+    worker_threads = max(1, threads // workers)
+    hello = {
+        "version": __version__,
+        "ocr_config": ocr_config_fingerprint(paddle_ocr, analyzer, paddle_backend),
+        "paddle_ocr": paddle_ocr,
+        "workers": workers,
+    }
+    preload_analyzer(analyzer)
+    pool = multiprocessing.get_context("fork").Pool(
+        workers,
+        initializer=_init_worker,
+        initargs=(
+            paddle_ocr,
+            worker_threads,
+            None,
+            None,
+            batch_size,
+            None,
+            analyzer,
+            paddle_backend,
+        ),
+    )
+    key_path = _key_path(socket_path)
+    # Only the owner can connect to the socket:
+    umask = os.umask(0o177)
+    try:
+        authkey = _write_key(key_path)
+        listener = Listener(os.fspath(socket_path), family="AF_UNIX")
+    finally:
+        os.umask(umask)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    logger.info(
+        f"OCR server listening on {socket_path} with {workers} worker(s) "
+        f"({'PaddleOCR' if paddle_ocr else 'Tesseract OCR'})"
+    )
+    try:
+        while True:
+            conn = listener.accept()
+            threading.Thread(
+                target=_handle_connection,
+                args=(conn, pool, hello, authkey),
+                daemon=True,
+            ).start()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        logger.info("Stopping the OCR server")
+        listener.close()
+        pool.terminate()
+        pool.join()
+        socket_path.unlink(missing_ok=True)
+        key_path.unlink(missing_ok=True)
+
+
+class OCRClient:
+    """
+    A connection to an OCR server, which processes the OCR tasks of `perform_ocr`
+    instead of local worker processes
+    """
+
+    def __init__(self, conn: Connection, hello: dict[str, Any], settings: tuple):
+        self.conn = conn
+        self.workers: int = hello["workers"]
+        # The settings of the run that apply to each task, see `_serve_task`:
+        self.settings = settings
+
+    @classmethod
+    def connect(
+        cls,
+        socket_path: Path,
+        paddle_ocr: bool,
+        analyzer: AnalyzerProfile,
+        paddle_backend: PaddleBackend | None,
+        settings: tuple,
+    ) -> "OCRClient | None":
+        """
+        Connects to the OCR server listening on `socket_path`, if there is one, it is run
+        by the same user (see `_unsafe_reason`) and it uses the same OCR (configuration
+        and backend), PII analyzer and version of lethe
+        """
+        if not socket_path.exists():
+            return None
+        key_path = _key_path(socket_path)
+        reason = _unsafe_reason(socket_path) or _unsafe_reason(key_path)
+        if reason is not None:
+            logger.warning(f"Not using the OCR server on {socket_path}: {reason}")
+            return None
+        try:
+            authkey = key_path.read_bytes()
+            conn = Client(os.fspath(socket_path), family="AF_UNIX", authkey=authkey)
+            hello = conn.recv()
+        except (OSError, EOFError, AuthenticationError) as e:
+            logger.warning(f"Cannot connect to the OCR server on {socket_path}: {e}")
+            return None
+        expected = (
+            __version__,
+            paddle_ocr,
+            ocr_config_fingerprint(paddle_ocr, analyzer, paddle_backend),
+        )
+        if (hello["version"], hello["paddle_ocr"], hello["ocr_config"]) != expected:
+            logger.warning(
+                f"The OCR server on {socket_path} uses a different version or OCR "
+                "configuration, performing OCR locally"
+            )
+            conn.close()
+            return None
+        logger.info(
+            f"Using the OCR server on {socket_path} ({hello['workers']} workers)"
+        )
+        return cls(conn, hello, settings)
+
+    def imap(self, function: Callable, tasks: Iterable) -> Iterator:
+        """
+        Like `Pool.imap`: sends the tasks to the server, keeping a bounded number of
+        them in flight, and yields their results in order
+        """
+        tasks = iter(tasks)
+        in_flight = 0
+        max_in_flight = 2 * self.workers
+        while True:
+            while in_flight < max_in_flight:
+                task = next(tasks, None)
+                if task is None:
+                    break
+                self.conn.send((function.__name__, self.settings, task))
+                in_flight += 1
+            if not in_flight:
+                return
+            ok, result = self.conn.recv()
+            in_flight -= 1
+            if not ok:
+                raise RuntimeError(f"OCR server error: {result}")
+            yield result
+
+    def close(self) -> None:
+        self.conn.close()
@@ -0,0 +1,355 @@
+"""
+The text detection and recognition of PaddleOCR with the ONNX exports of its models run by
+ONNX Runtime (the "onnx" and "onnx-int8" backends, see `paddle_backend`), without loading
+PaddlePaddle or PaddleX.
+
+The steps of the OCR pipeline of PaddleOCR that lethe uses are reproduced with the settings
+of its configuration: the text lines are detected by the DB model on the image resized as
+configured for the `TextDetection` module, then each line is cropped (and straightened) and
+its text is recognized by the CTC model, in batches of lines of similar widths. The document
+preprocessing and the text line orientation models are not supported (they are disabled in
+the configuration of lethe). The results have the `rec_boxes` and `rec_texts` of the results
+of PaddleOCR.
+"""
+
+import math
+
+import cv2
+import numpy as np
+import onnxruntime as ort
+import yaml
+
+from .paddle_backend import (
+    MODEL_CONFIG_FILE,
+    PaddleBackend,
+    onnx_model_dir,
+    onnx_model_path,
+)
+
+# The defaults of the OCR pipeline of PaddleOCR
+DEFAULT_LIMIT_SIDE_LEN = 960
+DEFAULT_LIMIT_TYPE = "max"
+DEFAULT_MAX_SIDE_LIMIT = 4000
+DEFAULT_THRESH = 0.3
+DEFAULT_BOX_THRESH = 0.6
+DEFAULT_UNCLIP_RATIO = 2.0
+DEFAULT_MEAN = [0.485, 0.456, 0.406]
+DEFAULT_STD = [0.229, 0.224, 0.225]
+DEFAULT_REC_IMAGE_SHAPE = [3, 48, 320]
+# The text regions smaller than this (in pixels of the detection map) are ignored
+MIN_BOX_SIZE = 3
+MAX_CANDIDATES = 1000
+# The maximum width of the text lines given to the recognition model
+MAX_REC_WIDTH = 3200
+# The boxes whose tops are closer than this (in pixels) are on the same line
+SAME_LINE_TOLERANCE = 10
+
+
+def _create_session(model_dir, backend: PaddleBackend, num_threads: int):
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = num_threads
+    options.inter_op_num_threads = 1
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    return ort.InferenceSession(
+        str(onnx_model_path(model_dir, backend)),
+        options,
+        providers=["CPUExecutionProvider"],
+    )
+
+
+def _model_config(model_dir) -> dict:
+    with open(model_dir / MODEL_CONFIG_FILE) as f:
+        return yaml.safe_load(f)
+
+
+def _transform_args(model_config: dict, name: str) -> dict:
+    """The arguments of a preprocessing operator of a model, empty if it has none"""
+    for op in model_config.get("PreProcess", {}).get("transform_ops", []):
+        if name in op:
+            return op[name] or {}
+    return {}
+
+
+def _scale(value: float | str | None) -> float:
+    # e.g. "1./255."
+    if value is None:
+        return 1 / 255
+    if isinstance(value, str):
+        numerator, _, denominator = value.partition("/")
+        return float(numerator) / float(denominator or 1)
+    return float(value)
+
+
+def _to_rgb(image: str | np.ndarray) -> np.ndarray:
+    if isinstance(image, str):
+        return cv2.cvtColor(cv2.imread(image, cv2.IMREAD_COLOR), cv2.COLOR_BGR2RGB)
+    if image.ndim == 2:
+        return cv2.cvtColor(image, cv2.COLOR_GRAY2RGB)
+    if image.shape[2] == 4:
+        return cv2.cvtColor(image, cv2.COLOR_RGBA2RGB)
+    return image
+
+
+def _min_area_box(points: np.ndarray) -> tuple[np.ndarray, float]:
+    """
+    The corners of the minimum area rectangle of some points (clockwise from the top
+    left one) and the length of its shorter side
+    """
+    rect = cv2.minAreaRect(points)
+    corners = sorted(cv2.boxPoints(rect).tolist(), key=lambda p: p[0])
+    left = sorted(corners[:2], key=lambda p: p[1])
+    right = sorted(corners[2:], key=lambda p: p[1])
+    box = np.array([left[0], right[0], right[1], left[1]], dtype=np.float32)
+    return box, min(rect[1])
+
+
+class TextDetector:
+    """The DB text detection model, that finds the (quadrilateral) boxes of text lines"""
+
+    def __init__(self, config: dict, backend: PaddleBackend, num_threads: int):
+        model_dir = onnx_model_dir(config)
+        self.session_ = _create_session(model_dir, backend, num_threads)
+        self.input_name_ = self.session_.get_inputs()[0].name
+        normalize = _transform_args(_model_config(model_dir), "NormalizeImage")
+        scale = _scale(normalize.get("scale"))
+        mean = np.array(normalize.get("mean", DEFAULT_MEAN), dtype=np.float32)
+        std = np.array(normalize.get("std", DEFAULT_STD), dtype=np.float32)
+        # (pixel * scale - mean) / std
+        self.alpha_ = scale / std
+        self.beta_ = -mean / std
+        self.limit_side_len = config.get("limit_side_len", DEFAULT_LIMIT_SIDE_LEN)
+        self.limit_type = config.get("limit_type", DEFAULT_LIMIT_TYPE)
+        self.max_side_limit = config.get("max_side_limit", DEFAULT_MAX_SIDE_LIMIT)
+        self.thresh = config.get("thresh", DEFAULT_THRESH)
+        self.box_thresh = config.get("box_thresh", DEFAULT_BOX_THRESH)
+        self.unclip_ratio = config.get("unclip_ratio", DEFAULT_UNCLIP_RATIO)
+
+    def _resized_shape(self, height: int, width: int) -> tuple[int, int]:
+        """The shape of the image given to the model: multiples of 32 within the limits"""
+        if self.limit_type == "max":
+            ratio = min(1.0, self.limit_side_len / max(height, width))
+        elif self.limit_type == "min":
+            ratio = max(1.0, self.limit_side_len / min(height, width))
+        else:  # resize_long
+            ratio = self.limit_side_len / max(height, width)
+        resized_height, resized_width = int(height * ratio), int(width * ratio)
+        if max(resized_height, resized_width) > self.max_side_limit:
+            ratio = self.max_side_limit / max(resized_height, resized_width)
+            resized_height = int(resized_height * ratio)
+            resized_width = int(resized_width * ratio)
+        return (
+            max(round(resized_height / 32) * 32, 32),
+            max(round(resized_width / 32) * 32, 32),
+        )
+
+    def _preprocess(self, image: np.ndarray, shape: tuple[int, int]) -> np.ndarray:
+        if image.shape[:2] != shape:
+            image = cv2.resize(image, (shape[1], shape[0]))
+        data = image.astype(np.float32) * self.alpha_ + self.beta_
+        return data.transpose((2, 0, 1))
+
+    def _boxes(self, pred: np.ndarray, height: int, width: int) -> list[np.ndarray]:
+        """The boxes of the text found in a probability map, in image coordinates"""
+        map_height, map_width = pred.shape
+        scale = np.array([width / map_width, height / map_height], dtype=np.float32)
+        bitmap = (pred > self.thresh).astype(np.uint8) * 255
+        contours, _ = cv2.findContours(bitmap, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
+        boxes = []
+        for contour in contours[:MAX_CANDIDATES]:
+            box, short_side = _min_area_box(contour)
+            if short_side < MIN_BOX_SIZE:
+                continue
+            if self._box_score(pred, box) < self.box_thresh:
+                continue
+            # The DB model predicts shrunk text regions: the box is expanded by the
+            # offset of the unclip of PaddleOCR (for a rectangle, its minimum area
+            # rectangle is the rectangle grown by the offset on each side)
+            (center, (w, h), angle) = cv2.minAreaRect(box)
+            offset = w * h * self.unclip_ratio / (2 * (w + h))
+            box, short_side = _min_area_box(
+                cv2.boxPoints((center, (w + 2 * offset, h + 2 * offset), angle))
+            )
+            if short_side < MIN_BOX_SIZE + 2:
+                continue
+            box = np.round(box * scale)
+            box[:, 0] = np.clip(box[:, 0], 0, width)
+            box[:, 1] = np.clip(box[:, 1], 0, height)
+            boxes.append(box.astype(np.int32))
+        return boxes
+
+    @staticmethod
+    def _box_score(pred: np.ndarray, box: np.ndarray) -> float:
+        """The mean probability of the map inside a box"""
+        height, width = pred.shape
+        x_min = int(np.clip(np.floor(box[:, 0].min()), 0, width - 1))
+        x_max = int(np.clip(np.ceil(box[:, 0].max()), 0, width - 1))
+        y_min = int(np.clip(np.floor(box[:, 1].min()), 0, height - 1))
+        y_max = int(np.clip(np.ceil(box[:, 1].max()), 0, height - 1))
+        mask = np.zeros((y_max - y_min + 1, x_max - x_min + 1), dtype=np.uint8)
+        points = (box - [x_min, y_min]).astype(np.int32)
+        cv2.fillPoly(mask, points.reshape(1, -1, 2), 1)
+        return cv2.mean(pred[y_min : y_max + 1, x_min : x_max + 1], mask)[0]
+
+    def __call__(self, images: list[np.ndarray]) -> list[list[np.ndarray]]:
+        """The boxes of the text lines of each image. The images resized to the same
+        shape (e.g. the slices of a series) are given to the model as a batch."""
+        shapes = [self._resized_shape(*image.shape[:2]) for image in images]
+        groups: dict[tuple[int, int], list[int]] = {}
+        for i, shape in enumerate(shapes):
+            groups.setdefault(shape, []).append(i)
+        results: list[list[np.ndarray]] = [[] for _ in images]
+        for shape, indices in groups.items():
+            batch = np.stack([self._preprocess(images[i], shape) for i in indices])
+            preds = self.session_.run(None, {self.input_name_: batch})[0]
+            for i, pred in zip(indices, preds):
+                results[i] = self._boxes(pred[0], *images[i].shape[:2])
+        return results
+
+
+class TextRecognizer:
+    """The CTC text recognition model, that reads the text of the lines"""
+
+    def __init__(self, config: dict, backend: PaddleBackend, num_threads: int):
+        model_dir = onnx_model_dir(config)
+        self.session_ = _create_session(model_dir, backend, num_threads)
+        self.input_name_ = self.session_.get_inputs()[0].name
+        model_config = _model_config(model_dir)
+        self.image_shape_ = _transform_args(model_config, "RecResizeImg").get(
+            "image_shape", DEFAULT_REC_IMAGE_SHAPE
+        )
+        characters = list(model_config["PostProcess"]["character_dict"])
+        if characters and characters[0] == "blank":
+            characters = characters[1:]
+        # The index 0 is the "blank" of CTC
+        self.characters_ = ["", *characters, " "]
+        self.batch_size = config.get("batch_size", 1)
+        self.score_thresh = config.get("score_thresh", 0.0)
+
+    def _preprocess(self, image: np.ndarray) -> np.ndarray:
+        """Resizes a line to the height of the model, keeping its aspect ratio"""
+        _, height, width = self.image_shape_
+        ratio = image.shape[1] / image.shape[0]
+        max_width = int(height * max(width / height, ratio))
+        if max_width > MAX_REC_WIDTH:
+            resized_width = max_width = MAX_REC_WIDTH
+        else:
+            resized_width = min(max_width, math.ceil(height * ratio))
+        resized = cv2.resize(image, (resized_width, height)).astype(np.float32)
+        data = np.zeros((3, height, max_width), dtype=np.float32)
+        data[:, :, :resized_width] = resized.transpose((2, 0, 1)) / 127.5 - 1
+        return data
+
+    def _decode(self, preds: np.ndarray) -> list[tuple[str, float]]:
+        indices = preds.argmax(axis=-1)
+        probs = preds.max(axis=-1)
+        results = []
+        for line_indices, line_probs in zip(indices, probs):
+            keep = np.ones(len(line_indices), dtype=bool)
+            keep[1:] = line_indices[1:] != line_indices[:-1]
+            keep &= line_indices != 0
+            text = "".join(self.characters_[i] for i in line_indices[keep])
+            score = float(line_probs[keep].mean()) if keep.any() else 0.0
+            results.append((text, score))
+        return results
+
+    def __call__(self, lines: list[np.ndarray]) -> list[tuple[str, float]]:
+        """The text and the score of each line"""
+        # In batches of lines of similar widths, which are padded to the widest one
+        order = sorted(
+            range(len(lines)), key=lambda i: lines[i].shape[1] / lines[i].shape[0]
+        )
+        results: list[tuple[str, float]] = [("", 0.0)] * len(lines)
+        for start in range(0, len(order), self.batch_size):
+            indices = order[start : start + self.batch_size]
+            data = [self._preprocess(lines[i]) for i in indices]
+            batch_width = max(d.shape[2] for d in data)
+            batch = np.zeros((len(data), *data[0].shape[:2], batch_width), np.float32)
+            for j, d in enumerate(data):
+                batch[j, :, :, : d.shape[2]] = d
+            preds = self.session_.run(None, {self.input_name_: batch})[0]
+            for i, result in zip(indices, self._decode(preds)):
+                results[i] = result
+        return results
+
+
+def _crop_line(image: np.ndarray, box: np.ndarray) -> np.ndarray:
+    """The image of a text line, straightened (and turned horizontal if vertical)"""
+    box = box.astype(np.float32)
+    width = int(max(np.linalg.norm(box[0] - box[1]), np.linalg.norm(box[2] - box[3])))
+    height = int(max(np.linalg.norm(box[0] - box[3]), np.linalg.norm(box[1] - box[2])))
+    if width == 0 or height == 0:
+        return np.empty((0, 0, 3), dtype=image.dtype)
+    corners = np.array(
+        [[0, 0], [width, 0], [width, height], [0, height]], dtype=np.float32
+    )
+    line = cv2.warpPerspective(
+        image,
+        cv2.getPerspectiveTransform(box, corners),
+        (width, height),
+        borderMode=cv2.BORDER_REPLICATE,
+        flags=cv2.INTER_CUBIC,
+    )
+    if height / width >= 1.5:
+        line = np.rot90(line)
+    return line
+
+
+def _sort_boxes(boxes: list[np.ndarray]) -> list[np.ndarray]:
+    """Sorts the boxes from top to bottom and then from left to right on each line"""
+    boxes = sorted(boxes, key=lambda b: (b[0][1], b[0][0]))
+    for i in range(len(boxes) - 1):
+        for j in range(i, -1, -1):
+            if (
+                abs(boxes[j + 1][0][1] - boxes[j][0][1]) < SAME_LINE_TOLERANCE
+                and boxes[j + 1][0][0] < boxes[j][0][0]
+            ):
+                boxes[j], boxes[j + 1] = boxes[j + 1], boxes[j]
+            else:
+                break
+    return boxes
+
+
+class OnnxOCR:
+    """The OCR pipeline of PaddleOCR with the ONNX models of its configuration"""
+
+    def __init__(
+        self,
+        config: dict,
+        *,
+        backend: PaddleBackend = PaddleBackend.onnx,
+        num_threads: int = 1,
+    ):
+        if config.get("use_textline_orientation"):
+            raise ValueError(
+                f"The text line orientation is not supported by the {backend.value} "
+                "backend"
+            )
+        modules = config["SubModules"]
+        self.detector_ = TextDetector(modules["TextDetection"], backend, num_threads)
+        self.recognizer_ = TextRecognizer(
+            modules["TextRecognition"], backend, num_threads
+        )
+
+    def predict(self, images: list[str | np.ndarray]) -> list[dict]:
+        images = [_to_rgb(image) for image in images]
+        results = []
+        for image, boxes in zip(images, self.detector_(images)):
+            lines, line_boxes = [], []
+            for box in _sort_boxes(boxes):
+                line = _crop_line(image, box)
+                if line.size > 0:
+                    lines.append(line)
+                    line_boxes.append(box)
+            texts, rec_boxes = [], []
+            for box, (text, score) in zip(line_boxes, self.recognizer_(lines)):
+                if score < self.recognizer_.score_thresh:
+                    continue
+                texts.append(text)
+                rec_boxes.append([*box.min(axis=0), *box.max(axis=0)])
+            results.append(
+                {
+                    "rec_texts": texts,
+                    "rec_boxes": np.array(rec_boxes, dtype=np.int32).reshape(-1, 4),
+                }
+            )
+        return results
@@ -3,34 +3,196 @@ Copy from an input folder all dicom files to an output folder. In hte output fol
 will be organized in a hierarchical structure based on the patient ID , study UID, and series UID.
 """
 
+import errno
+import fcntl
+import os
 import shutil
+import sqlite3
+import tempfile
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from enum import Enum
 from pathlib import Path
+from typing import TYPE_CHECKING, Callable, Generator, Iterable
 
 from loguru import logger
 
-from .dicom_utils import dcm_generator
+from .defaults import DEFAULT_CPU_THREADS
 
+if TYPE_CHECKING:
+    from .dicom_utils import DcmFileInfo
 
-def copy_and_organize(input_folder: Path, output_folder: Path):
+# The ioctl request for cloning a file (sharing its data blocks) in Linux, see ioctl_ficlone(2)
+FICLONE = 0x40049409
+
+# The errors that mean that a link or clone cannot be made between two paths (e.g. they
+# are on different filesystems, or the filesystem does not support it)
+_UNSUPPORTED_ERRNOS = {
+    errno.EXDEV,
+    errno.EOPNOTSUPP,
+    errno.ENOTTY,
+    errno.EINVAL,
+    errno.EPERM,
+    errno.EMLINK,
+}
+
+
+class OrganizeMode(str, Enum):
+    copy = "copy"
+    move = "move"
+    hardlink = "hardlink"
+    reflink = "reflink"
+
+
+class OrganizeOrder(str, Enum):
+    discovery = "discovery"
+    instance = "instance"
+
+
+def instance_ordered(
+    file_infos: Iterable["DcmFileInfo"], tmp_dir: Path
+) -> Generator["DcmFileInfo", None, None]:
+    """
+    Sorts the files by series and, in each series, by InstanceNumber (files without one
+    are placed last) and SOPInstanceUID. The sorting is done by SQLite in a temporary
+    database in `tmp_dir`, which uses an external merge sort for large tables, so that
+    millions of files can be sorted without keeping them all in memory.
+    """
+    from .dicom_utils import DcmFileInfo
+
+    with tempfile.TemporaryDirectory(prefix=".lethe-", dir=tmp_dir) as sort_dir:
+        db = sqlite3.connect(os.path.join(sort_dir, "files.sqlite"))
+        try:
+            db.execute("PRAGMA temp_store=FILE")
+            db.execute(
+                "CREATE TABLE files (path TEXT, patient_id TEXT, study_uid TEXT, "
+                "series_uid TEXT, instance_number INTEGER, sop_uid TEXT)"
+            )
+            db.executemany(
+                "INSERT INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                ((os.fspath(info.path), *info[1:]) for info in file_infos),
+            )
+            for row in db.execute(
+                "SELECT * FROM files ORDER BY patient_id, study_uid, series_uid, "
+                "instance_number IS NULL, instance_number, sop_uid, path"
+            ):
+                yield DcmFileInfo(Path(row[0]), *row[1:])
+        finally:
+            db.close()
+
+
+def _reflink(src: Path, dest: Path) -> None:
+    with open(src, "rb") as f_src, open(dest, "wb") as f_dest:
+        fcntl.ioctl(f_dest.fileno(), FICLONE, f_src.fileno())
+
+
+def _transfer(src: Path, dest: Path, mode: OrganizeMode) -> bool:
+    """
+    Places the `src` file at `dest` using the given mode. Returns False if the mode is
+    not supported for these paths, in which case the file is copied instead.
+
+    A moved file is hard linked (or copied) at first, its source is removed once all the
+    files have been placed (see `copy_and_organize`).
+    """
+    try:
+        if mode in (OrganizeMode.move, OrganizeMode.hardlink):
+            dest.unlink(missing_ok=True)
+            os.link(src, dest)
+        elif mode == OrganizeMode.reflink:
+            _reflink(src, dest)
+        else:
+            shutil.copy(src, dest)
+        return True
+    except OSError as e:
+        if mode == OrganizeMode.copy or e.errno not in _UNSUPPORTED_ERRNOS:
+            raise
+    shutil.copy(src, dest)
+    # A copy instead of a move is not a fallback, the source is removed later anyway
+    return mode == OrganizeMode.move
+
+
+def copy_and_organize(
+    input_folder: Path,
+    output_folder: Path,
+    *,
+    mode: OrganizeMode = OrganizeMode.copy,
+    order: OrganizeOrder = OrganizeOrder.instance,
+    threads: int = DEFAULT_CPU_THREADS,
+    on_organized: Callable[[], None] | None = None,
+):
+    """
+    Places the DICOM files of the `input_folder` into a Patient / Study / Series folder
+    structure in the `output_folder`, numbering the files of each series.
+
+    The files are copied, moved, hard linked or cloned ("reflink", sharing the data
+    blocks in filesystems like Btrfs and XFS) depending on the `mode`. When the mode is
+    not possible (e.g. the folders are on different filesystems) the files are copied
+    instead. The files are transferred by a pool of `threads` threads, but their numbers
+    are assigned before they are transferred, so they do not depend on the parallelism.
+
+    With the "instance" `order` the files of each series are numbered in the order of
+    their InstanceNumber (and SOPInstanceUID), so that the same input always produces
+    the same output. With the "discovery" order they are numbered in the order they
+    are found in the `input_folder`.
+
+    With the "move" mode the files of the `input_folder` are removed only after all of
+    them have been placed, and after calling `on_organized` (e.g. for recording that
+    this step is complete), so that an interrupted run can be organized again from the
+    start without losing files.
+    """
     cnt = 0
+    fallbacks = 0
     dirs: dict[str, int] = {}
-    # XXX: Should we order by InstanceNumber ??
-    for dcm_info in dcm_generator(input_folder):
-        current_output_folder = (
-            output_folder
-            / dcm_info.patient_id
-            / dcm_info.study_uid
-            / dcm_info.series_uid
-        )
-        if current_output_folder not in dirs:
-            # Since we walk the input directory in top down manner, we are sure that when we visit
-            # a directory its parent directory has already been visited and created. So
-            # parents=True, exist_ok=True are not needed but ..ok :-)
-            current_output_folder.mkdir(parents=True, exist_ok=True)
-            dirs[current_output_folder] = 1
-        index = dirs[current_output_folder]
-        dirs[current_output_folder] += 1
-        output_file = current_output_folder / f"{index:05d}.dcm"
-        shutil.copy(dcm_info.path, output_file)
-        cnt += 1
-    logger.info(f"Copied and organized hierarchically {cnt} files")
+    # The sources of the moved files, removed at the end
+    moved: list[Path] = []
+    in_flight: deque[Future] = deque()
+
+    def finish(future: Future) -> None:
+        nonlocal fallbacks
+        if not future.result():
+            if not fallbacks:
+                logger.warning(
+                    f"Cannot {mode.value} files from {input_folder} to "
+                    f"{output_folder}, copying them instead"
+                )
+            fallbacks += 1
+
+    from .dicom_utils import dcm_generator
+
+    file_infos = dcm_generator(input_folder)
+    if order == OrganizeOrder.instance:
+        output_folder.mkdir(parents=True, exist_ok=True)
+        file_infos = instance_ordered(file_infos, output_folder)
+    with ThreadPoolExecutor(threads) as executor:
+        for dcm_info in file_infos:
+            current_output_folder = (
+                output_folder
+                / dcm_info.patient_id
+                / dcm_info.study_uid
+                / dcm_info.series_uid
+            )
+            if current_output_folder not in dirs:
+                current_output_folder.mkdir(parents=True, exist_ok=True)
+                dirs[current_output_folder] = 1
+            index = dirs[current_output_folder]
+            dirs[current_output_folder] += 1
+            output_file = current_output_folder / f"{index:05d}.dcm"
+            if mode == OrganizeMode.move:
+                moved.append(dcm_info.path)
+            in_flight.append(
+                executor.submit(_transfer, dcm_info.path, output_file, mode)
+            )
+            # Keep a bounded number of files in flight
+            if len(in_flight) >= 4 * threads:
+                finish(in_flight.popleft())
+            cnt += 1
+        while in_flight:
+            finish(in_flight.popleft())
+    if on_organized is not None:
+        on_organized()
+    for path in moved:
+        path.unlink(missing_ok=True)
+    logger.info(
+        f"Organized hierarchically {cnt} files ({mode.value}"
+        f"{f', {fallbacks} copied instead' if fallbacks else ''})"
+    )
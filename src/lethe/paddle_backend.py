@@ -0,0 +1,116 @@
+"""
+The inference backends of the PaddleOCR models (`--paddle-backend`):
+
+- "paddle": PaddleOCR itself, i.e. the models run by Paddle Inference
+- "onnx": the ONNX exports of the text detection and recognition models run by ONNX Runtime
+  (see `onnx_ocr`), without loading PaddlePaddle or PaddleX
+- "onnx-int8": the same, with the weights of the matrix multiplications of the models
+  quantized to int8 (dynamic quantization), once, next to the ONNX models
+
+The backend is set by the `backend` key of the PaddleOCR configuration (PaddleOCR.yaml), which
+is "paddle" if missing, or by the `--paddle-backend` option, which overrides it.
+
+The ONNX models are looked for in the `model_dir` of the `TextDetection` and `TextRecognition`
+modules of the configuration, or, if it is not set, in the directories of the official models
+of PaddleX (`<model_name>_onnx` or `<model_name>`, e.g. exported with
+`paddlex --paddle2onnx --paddle_model_dir ~/.paddlex/official_models/PP-OCRv5_mobile_det`).
+Each directory must also have the `inference.yml` of the model, which the export copies.
+"""
+
+import importlib.util
+import os
+from enum import Enum
+from pathlib import Path
+
+from loguru import logger
+
+
+class PaddleBackend(str, Enum):
+    paddle = "paddle"
+    onnx = "onnx"
+    onnx_int8 = "onnx-int8"
+
+
+# The key of the backend in the PaddleOCR configuration (not passed to PaddleX)
+BACKEND_KEY = "backend"
+ONNX_MODEL_FILE = "inference.onnx"
+INT8_MODEL_FILE = "inference.int8.onnx"
+MODEL_CONFIG_FILE = "inference.yml"
+# The operators whose weights are quantized: the dynamically quantized convolutions are
+# slower than the float ones on CPU (and less accurate), so it is mostly the recognition
+# model (whose encoder and head are matrix multiplications) that is quantized
+QUANTIZED_OP_TYPES = ["MatMul", "Gemm"]
+
+
+def onnx_runtime_available() -> bool:
+    return importlib.util.find_spec("onnxruntime") is not None
+
+
+def pop_backend(config: dict) -> PaddleBackend:
+    """Removes the backend from a PaddleOCR configuration and returns it"""
+    return PaddleBackend(config.pop(BACKEND_KEY, None) or PaddleBackend.paddle)
+
+
+def official_models_dir() -> Path:
+    """The directory where PaddleX downloads its official models"""
+    cache_home = os.environ.get("PADDLE_PDX_CACHE_HOME")
+    if cache_home:
+        return Path(cache_home) / "official_models"
+    return Path.home() / ".paddlex" / "official_models"
+
+
+def onnx_model_dir(module_config: dict) -> Path:
+    """The directory of the ONNX export of the model of a module of the configuration"""
+    if module_config.get("model_dir"):
+        candidates = [Path(module_config["model_dir"])]
+    else:
+        model_name = module_config["model_name"]
+        candidates = [
+            official_models_dir() / f"{model_name}_onnx",
+            official_models_dir() / model_name,
+        ]
+    for model_dir in candidates:
+        if (model_dir / ONNX_MODEL_FILE).exists():
+            return model_dir
+    raise FileNotFoundError(
+        f"The ONNX model of {module_config.get('model_name')} was not found in "
+        f"{' or '.join(str(d) for d in candidates)}, it can be exported with "
+        "`paddlex --paddle2onnx --paddle_model_dir <the directory of the model>`"
+    )
+
+
+def quantize_model(model_path: Path, output_path: Path) -> None:
+    """Quantizes (dynamically) the weights of an ONNX model to int8"""
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+
+    logger.info(f"Quantizing {model_path} to int8")
+    # Written to temporary files first, since the workers may quantize it concurrently
+    prefix = f".{output_path.name}.{os.getpid()}"
+    folded_path = output_path.with_name(f"{prefix}.folded")
+    temp_path = output_path.with_name(prefix)
+    try:
+        # The exported models have their weights in constant nodes, that are folded
+        # into initializers, which are the only weights quantized
+        quant_pre_process(model_path, folded_path, skip_symbolic_shape=True)
+        quantize_dynamic(
+            folded_path,
+            temp_path,
+            op_types_to_quantize=QUANTIZED_OP_TYPES,
+            weight_type=QuantType.QInt8,
+        )
+        temp_path.replace(output_path)
+    finally:
+        folded_path.unlink(missing_ok=True)
+        temp_path.unlink(missing_ok=True)
+
+
+def onnx_model_path(model_dir: Path, backend: PaddleBackend) -> Path:
+    """The ONNX model of a directory to run with the backend (quantized if needed)"""
+    model_path = model_dir / ONNX_MODEL_FILE
+    if backend != PaddleBackend.onnx_int8:
+        return model_path
+    quantized_path = model_dir / INT8_MODEL_FILE
+    if not quantized_path.exists():
+        quantize_model(model_path, quantized_path)
+    return quantized_path
@@ -1,53 +1,120 @@
 """
 An adapter for using PaddleOCR as the underlying OCR of Presidio.
+
+The models of PaddleOCR are run by the backend of the configuration or the one given (see
+`paddle_backend`): by PaddleOCR itself or by ONNX Runtime (see `onnx_ocr`).
 """
 
 import numpy as np
-from paddleocr import PaddleOCR
 from PIL.Image import Image
 from presidio_image_redactor import OCR
 
 from .defaults import DEFAULT_CPU_THREADS
+from .paddle_backend import PaddleBackend, onnx_runtime_available, pop_backend
+
+
+def _to_array(image: str | Image | np.ndarray) -> str | np.ndarray:
+    if isinstance(image, Image):
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        image = np.asarray(image)  # Convert of np.array
+    return image
+
+
+def _to_dict(result) -> dict[str, list]:
+    if not result or result["rec_boxes"].size == 0:
+        return {
+            "left": [],
+            "top": [],
+            "height": [],
+            "width": [],
+            "text": [],
+        }
+    rec_bboxes: np.ndarray = result["rec_boxes"]
+    # rec_bboxes.shape should be (<num of texts rec>, 4)
+    d = {
+        "left": rec_bboxes[:, 0].tolist(),
+        "top": rec_bboxes[:, 1].tolist(),
+        "height": (rec_bboxes[:, 3] - rec_bboxes[:, 1]).tolist(),
+        "width": (rec_bboxes[:, 2] - rec_bboxes[:, 0]).tolist(),
+        "text": result["rec_texts"],
+    }
+    return d
+
+
+def load_config(config_file: str | None) -> dict:
+    """The configuration of the OCR pipeline of PaddleOCR, the default one if no file"""
+    if config_file is None:
+        from paddlex.inference.pipelines import load_pipeline_config
+
+        return load_pipeline_config("OCR")
+    import yaml
+
+    with open(config_file) as f:
+        return yaml.safe_load(f)
+
+
+def create_batch_ocr(
+    *,
+    num_threads: int = DEFAULT_CPU_THREADS,
+    config_file: str | None = None,
+    batch_size: int = 1,
+    backend: PaddleBackend | None = None,
+):
+    """
+    Creates a function that performs OCR on a list of images, returning a dictionary of
+    results for each one. The text detection and the pipeline process the images in
+    batches of `batch_size` (overriding the configuration). The models are run by the
+    `backend`, if given, or by the one of the configuration.
+    """
+    config = load_config(config_file)
+    # Removed from the configuration of PaddleX even if overridden
+    configured_backend = pop_backend(config)
+    backend = PaddleBackend(backend or configured_backend)
+    if batch_size > 1:
+        config["batch_size"] = batch_size
+        config["SubModules"]["TextDetection"]["batch_size"] = batch_size
+    if backend == PaddleBackend.paddle:
+        from paddleocr import PaddleOCR
+
+        predict = PaddleOCR(
+            return_word_box=False,
+            use_doc_orientation_classify=False,
+            use_doc_unwarping=False,
+            use_textline_orientation=False,
+            cpu_threads=num_threads,
+            paddlex_config=config,
+        ).predict
+    else:
+        if not onnx_runtime_available():
+            raise RuntimeError(
+                f"The {backend.value} backend of PaddleOCR requires onnxruntime"
+            )
+        from .onnx_ocr import OnnxOCR
+
+        predict = OnnxOCR(config, backend=backend, num_threads=num_threads).predict
+
+    def _ocr_batch(images: list[str | Image | np.ndarray]) -> list[dict[str, list]]:
+        if not images:
+            return []
+        results = predict([_to_array(image) for image in images])
+        return [_to_dict(result) for result in results]
+
+    return _ocr_batch
 
 
 def create_ocr(
-    *, num_threads: int = DEFAULT_CPU_THREADS, config_file: str | None = None
+    *,
+    num_threads: int = DEFAULT_CPU_THREADS,
+    config_file: str | None = None,
+    backend: PaddleBackend | None = None,
 ):
-    ocr: PaddleOCR = PaddleOCR(
-        return_word_box=False,
-        use_doc_orientation_classify=False,
-        use_doc_unwarping=False,
-        use_textline_orientation=False,
-        cpu_threads=num_threads,
-        paddlex_config=config_file,
+    ocr_batch = create_batch_ocr(
+        num_threads=num_threads, config_file=config_file, backend=backend
     )
 
     def _ocr(image: str | Image | np.ndarray) -> dict[str, list[int]]:
-        if isinstance(image, Image):
-            if image.mode != "RGB":
-                image = image.convert("RGB")
-            image = np.asarray(image)  # Convert of np.array
-        result = ocr.predict(image)
-        if not result or result[0]["rec_boxes"].size == 0:
-            return {
-                "left": [],
-                "top": [],
-                "height": [],
-                "width": [],
-                "text": [],
-            }
-        a = result[0]
-
-        rec_bboxes: np.ndarray = a["rec_boxes"]
-        # rec_bboxes.shape should be (<num of texts rec>, 4)
-        d = {
-            "left": rec_bboxes[:, 0].tolist(),
-            "top": rec_bboxes[:, 1].tolist(),
-            "height": (rec_bboxes[:, 3] - rec_bboxes[:, 1]).tolist(),
-            "width": (rec_bboxes[:, 2] - rec_bboxes[:, 0]).tolist(),
-            "text": a["rec_texts"],
-        }
-        return d
+        return ocr_batch([image])[0]
 
     return _ocr
 
@@ -55,11 +122,37 @@ def create_ocr(
 class PresidioPaddleOCR(OCR):
     """OCR class that performs OCR on a given image."""
 
-    def __init__(self, config_file: str | None = None, num_threads: int | None = None):
-        self.ocr_ = create_ocr(
+    def __init__(
+        self,
+        config_file: str | None = None,
+        num_threads: int | None = None,
+        batch_size: int = 1,
+        backend: PaddleBackend | None = None,
+    ):
+        self.ocr_batch_ = create_batch_ocr(
             config_file=config_file,
             num_threads=num_threads or DEFAULT_CPU_THREADS,
+            batch_size=batch_size,
+            backend=backend,
         )
+        # The result (OCRed in advance, in a batch) of the next `perform_ocr` call
+        self.next_result_: dict | None = None
+
+    def prefetch(self, images: list[Image | np.ndarray]) -> list[dict]:
+        """
+        Performs OCR on a batch of images, returning their results to be passed to
+        `set_next_result` before the OCR of each image by the redactor engine
+        """
+        return self.ocr_batch_(images)
+
+    def set_next_result(self, result: dict | None) -> dict | None:
+        """
+        Sets the result of the next `perform_ocr` call, which is then returned instead
+        of performing the OCR of its image. Returns the result that was set before, if
+        it has not been used.
+        """
+        previous, self.next_result_ = self.next_result_, result
+        return previous
 
     def perform_ocr(self, image: object, **kwargs) -> dict:
         """Perform OCR on a given image.
@@ -69,4 +162,7 @@ class PresidioPaddleOCR(OCR):
 
         :return: results dictionary containing bboxes and text for each detected word
         """
-        return self.ocr_(image)
+        if self.next_result_ is not None:
+            result, self.next_result_ = self.next_result_, None
+            return result
+        return self.ocr_batch_([image])[0]
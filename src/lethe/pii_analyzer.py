@@ -0,0 +1,247 @@
+"""
+The profiles of the Presidio analyzer that finds the PII in the text detected by the OCR.
+
+The "full" profile is Presidio's default analyzer, which runs the NER of the large spaCy
+model (en_core_web_lg, hundreds of MB in each OCR worker) on the text of every image. The
+lean profiles rely instead on what is known about the image, i.e. the values of its DICOM
+header, and on regular expressions, which is what most of the burned-in text is about:
+
+- "small": the small spaCy model (en_core_web_sm, which must be installed) keeping only
+  the components needed by its NER
+- "blank": no NER at all (a blank spaCy pipeline, i.e. only a tokenizer)
+
+Both use some of Presidio's regex recognizers (dates, emails, phone numbers, etc.), regexes
+of ID like numbers and of titled names, and deny lists of the identifiers and dates of the
+DICOM header of each image, in addition to the deny list of names that the redactor engine
+makes from it.
+
+The analyzer of a profile is loaded once per process. It can be loaded in the parent
+process before the worker processes are forked (see `preload_analyzer`), so that they share
+its memory (copy-on-write) instead of loading their own copy.
+"""
+
+import gc
+from collections.abc import Sequence
+from datetime import datetime
+from enum import Enum
+from typing import TYPE_CHECKING
+
+from loguru import logger
+
+if TYPE_CHECKING:
+    from presidio_analyzer import AnalyzerEngine, PatternRecognizer
+    from pydicom import Dataset
+
+
+class AnalyzerProfile(str, Enum):
+    full = "full"
+    small = "small"
+    blank = "blank"
+
+
+# The predefined recognizers of Presidio that the lean profiles use (the others are
+# mostly of US specific identifiers, that match the codes of the burned-in annotations,
+# e.g. "T2" as a driver license)
+LEAN_RECOGNIZERS = [
+    "SpacyRecognizer",
+    "DateRecognizer",
+    "EmailRecognizer",
+    "PhoneRecognizer",
+    "UrlRecognizer",
+    "IpRecognizer",
+]
+
+SMALL_SPACY_MODEL = "en_core_web_sm"
+# The components of the small spaCy model that its NER does not need
+SMALL_MODEL_EXCLUDE = ["tagger", "parser", "senter", "attribute_ruler", "lemmatizer"]
+
+# The identifiers of the DICOM header (besides the names and the attributes of the
+# patient, that are in the deny list of the redactor engine) that are redacted
+METADATA_IDENTIFIERS = [
+    "AccessionNumber",
+    "StudyID",
+    "InstitutionAddress",
+    "DeviceSerialNumber",
+    "RequestedProcedureID",
+    "PerformedProcedureStepID",
+]
+# Shorter identifiers (e.g. a StudyID "1") are not redacted, they would match any number
+MIN_IDENTIFIER_LENGTH = 4
+# The dates of the DICOM header that are redacted, in any of the `DATE_FORMATS`
+METADATA_DATES = [
+    "StudyDate",
+    "SeriesDate",
+    "AcquisitionDate",
+    "ContentDate",
+    "PatientBirthDate",
+]
+DATE_FORMATS = [
+    "%Y%m%d",
+    "%Y-%m-%d",
+    "%Y/%m/%d",
+    "%Y.%m.%d",
+    "%d/%m/%Y",
+    "%d.%m.%Y",
+    "%d-%m-%Y",
+    "%m/%d/%Y",
+    "%m-%d-%Y",
+    "%d-%b-%Y",
+    "%d %b %Y",
+    "%b %d %Y",
+    "%b %d, %Y",
+]
+
+# The analyzers loaded in this process
+_analyzers: dict[AnalyzerProfile, "AnalyzerEngine"] = {}
+
+
+def _regex_recognizers() -> list["PatternRecognizer"]:
+    """
+    Recognizers of ID like numbers (e.g. patient IDs or accession numbers) and of
+    names that follow a title (e.g. of the referring physician)
+    """
+    from presidio_analyzer import Pattern, PatternRecognizer
+
+    return [
+        PatternRecognizer(
+            supported_entity="ID",
+            name="DicomIdRecognizer",
+            patterns=[
+                Pattern("number", r"\b\d{6,}\b", 0.4),
+                Pattern("prefixed number", r"\b[A-Z]{1,4}[-_/]?\d{4,}\b", 0.4),
+            ],
+        ),
+        PatternRecognizer(
+            supported_entity="PERSON",
+            name="TitledNameRecognizer",
+            patterns=[
+                Pattern(
+                    "titled name",
+                    r"\b(?:Dr|DR|Prof|PROF|Mr|MR|Mrs|MRS|Ms|MS)\.?\s+[A-Z][A-Za-z'-]+",
+                    0.6,
+                )
+            ],
+        ),
+    ]
+
+
+def _create_analyzer(profile: AnalyzerProfile) -> "AnalyzerEngine":
+    from presidio_analyzer import AnalyzerEngine, RecognizerRegistry
+    from presidio_analyzer.nlp_engine import SpacyNlpEngine
+
+    if profile == AnalyzerProfile.full:
+        return AnalyzerEngine()
+    import spacy
+
+    if profile == AnalyzerProfile.small:
+        model_name = SMALL_SPACY_MODEL
+        try:
+            nlp = spacy.load(model_name, exclude=SMALL_MODEL_EXCLUDE)
+        except OSError as e:
+            raise RuntimeError(
+                f"The spaCy model {model_name} of the '{profile.value}' analyzer "
+                "profile is not installed"
+            ) from e
+        if "tok2vec" in nlp.pipe_names and not nlp.get_pipe("tok2vec").listeners:
+            # Only used by the excluded components
+            nlp.remove_pipe("tok2vec")
+    else:
+        model_name = "blank:en"
+        nlp = spacy.blank("en")
+    nlp_engine = SpacyNlpEngine(models=[{"lang_code": "en", "model_name": model_name}])
+    nlp_engine.nlp = {"en": nlp}
+    registry = RecognizerRegistry(supported_languages=["en"])
+    registry.load_predefined_recognizers(languages=["en"], nlp_engine=nlp_engine)
+    registry.recognizers = [
+        r for r in registry.recognizers if r.name in LEAN_RECOGNIZERS
+    ]
+    if profile == AnalyzerProfile.blank:
+        registry.remove_recognizer("SpacyRecognizer")
+    for recognizer in _regex_recognizers():
+        registry.add_recognizer(recognizer)
+    return AnalyzerEngine(
+        registry=registry, nlp_engine=nlp_engine, supported_languages=["en"]
+    )
+
+
+def load_analyzer(profile: AnalyzerProfile) -> "AnalyzerEngine":
+    """The analyzer of a profile, loaded once per process"""
+    if profile not in _analyzers:
+        _analyzers[profile] = _create_analyzer(profile)
+    return _analyzers[profile]
+
+
+def preload_analyzer(profile: AnalyzerProfile) -> None:
+    """
+    Loads the analyzer of a profile in the current process, before forking the worker
+    processes that will use it. The objects loaded are then moved to the permanent
+    generation of the garbage collector, so that the collections in the workers do not
+    write to (and copy) their memory pages.
+    """
+    if profile in _analyzers:
+        return
+    logger.info(f"Loading the '{profile.value}' PII analyzer for the OCR workers")
+    load_analyzer(profile)
+    gc.freeze()
+
+
+def _date_variants(value: str) -> list[str]:
+    try:
+        date = datetime.strptime(value.strip(), "%Y%m%d")
+    except ValueError:
+        return []
+    variants = {date.strftime(f) for f in DATE_FORMATS}
+    return sorted(variants | {v.upper() for v in variants})
+
+
+def _values(ds: "Dataset", keyword: str) -> list[str]:
+    value = ds.get(keyword)
+    if value is None:
+        return []
+    if isinstance(value, Sequence) and not isinstance(value, str):
+        return [str(v) for v in value]
+    return [str(value)]
+
+
+def metadata_recognizers(
+    profile: AnalyzerProfile, ds: "Dataset"
+) -> list["PatternRecognizer"] | None:
+    """
+    The ad hoc recognizers of the identifiers and dates of the header of a DICOM dataset,
+    for the lean profiles (None for the "full" profile, which does not use them, and if
+    there are none, since the redactor engine rejects an empty list)
+    """
+    if profile == AnalyzerProfile.full:
+        return None
+    from presidio_analyzer import PatternRecognizer
+
+    recognizers = []
+    identifiers = {
+        value.strip()
+        for keyword in METADATA_IDENTIFIERS
+        for value in _values(ds, keyword)
+        if len(value.strip()) >= MIN_IDENTIFIER_LENGTH
+    }
+    if identifiers:
+        recognizers.append(
+            PatternRecognizer(
+                supported_entity="ID",
+                name="DicomMetadataIdRecognizer",
+                deny_list=sorted(identifiers),
+            )
+        )
+    dates = {
+        variant
+        for keyword in METADATA_DATES
+        for value in _values(ds, keyword)
+        for variant in _date_variants(value)
+    }
+    if dates:
+        recognizers.append(
+            PatternRecognizer(
+                supported_entity="DATE_TIME",
+                name="DicomMetadataDateRecognizer",
+                deny_list=sorted(dates),
+            )
+        )
+    return recognizers or None
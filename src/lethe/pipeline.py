@@ -0,0 +1,363 @@
+"""
+A "single pass" version of the anonymization pipeline: each DICOM file is read once, redacted
+(OCR) and anonymized in memory, and written directly to its final location in the output
+folder, instead of passing through temporary folders between the steps.
+"""
+
+import json
+import multiprocessing
+import os
+import shutil
+import time
+from collections import Counter, deque, namedtuple
+from concurrent.futures import Future, ProcessPoolExecutor
+from pathlib import Path
+from typing import TYPE_CHECKING
+from uuid import uuid4
+
+from loguru import logger
+from pydicom import dcmread
+from pydicom.errors import InvalidDicomError
+
+from .cache import FileCache, cache_key, file_hash
+from .defaults import DEFAULT_UIDROOT
+from .dicom_utils import NOT_DICOM, DcmFileInfo, is_index_file, parse_int
+from .frame_ocr import needs_frame_ocr, redact_frames
+from .native_deidentify import (
+    SOP_INSTANCE_UID_TAG,
+    CompiledScript,
+    anonymize_dataset,
+    compile_with_params,
+)
+from .ocr_deidentify import (
+    create_redactor_engine,
+    find_text_boxes,
+    ocr_config_fingerprint,
+    padded_frame_image,
+    redact_dataset_text,
+)
+from .ocr_prefilter import PrefilterRules, skip_reason
+from .output_dir import OrganizeOrder, instance_ordered
+from .paddle_backend import PaddleBackend
+from .pii_analyzer import AnalyzerProfile, preload_analyzer
+from .pixel_redaction import frame_count
+
+if TYPE_CHECKING:
+    from .dicom_index import DicomIndex
+
+# The result of processing a single file: the (temporary) output file and the
+# anonymized patient/study/series identifiers (and instance number and UID) to place it
+# in the hierarchy
+PipelineResult = namedtuple(
+    "PipelineResult",
+    [
+        "path",
+        "output_path",
+        "patient_id",
+        "study_uid",
+        "series_uid",
+        "error",
+        "cached",
+        "ocr_skipped",
+        "instance_number",
+        "sop_uid",
+    ],
+    defaults=(None, None, ""),
+)
+
+# Per (worker) process state, set up by `_init_worker`
+_compiled: CompiledScript | None = None
+_engine = None
+_cache: FileCache | None = None
+_cache_key_parts: tuple[str, ...] = ()
+_rules: PrefilterRules | None = None
+_analyzer: AnalyzerProfile = AnalyzerProfile.full
+_max_side: int | None = None
+
+
+def _init_worker(
+    compiled: CompiledScript | None,
+    redact: bool,
+    paddle_ocr: bool,
+    threads: int,
+    cache: FileCache | None,
+    cache_key_parts: tuple[str, ...],
+    rules: PrefilterRules | None = None,
+    analyzer: AnalyzerProfile = AnalyzerProfile.full,
+    paddle_backend: PaddleBackend | None = None,
+    max_side: int | None = None,
+) -> None:
+    global _compiled, _engine, _cache, _cache_key_parts, _rules, _analyzer, _max_side
+    _compiled = compiled
+    _engine = (
+        create_redactor_engine(
+            paddle_ocr, threads, analyzer=analyzer, paddle_backend=paddle_backend
+        )
+        if redact
+        else None
+    )
+    _cache = cache
+    _cache_key_parts = cache_key_parts
+    _rules = rules
+    _analyzer = analyzer
+    _max_side = max_side
+
+
+def _redact(file_path: Path, output_path: Path, ds):
+    """
+    Redacts the text in the image of a dataset, returning the redacted dataset. Large
+    and multi-frame images are redacted frame by frame from the file to the output
+    file (see `frame_ocr`), which is then read back.
+    """
+    if _max_side is not None and needs_frame_ocr(ds, _max_side):
+
+        def detect(images):
+            return [
+                find_text_boxes(
+                    _engine, _analyzer, padded_frame_image(_engine, image), ds
+                )
+                for image in images
+            ]
+
+        if redact_frames(file_path, output_path, detect, _max_side):
+            return dcmread(output_path)
+        return ds
+    if frame_count(ds) > 1:
+        raise ValueError(
+            "Multi-frame images can only be redacted frame by frame, see --ocr-max-side"
+        )
+    redact_dataset_text(_engine, _analyzer, ds)
+    return ds
+
+
+def _process_file(task: tuple[Path, Path]) -> PipelineResult:
+    file_path, output_path = task
+    try:
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        key = None
+        ocr_skipped = None
+        if _cache is not None:
+            key = cache_key("pipeline", file_hash(file_path), *_cache_key_parts)
+        if key is None or not _cache.get(key, output_path):
+            try:
+                ds = dcmread(file_path)
+            except InvalidDicomError:
+                return PipelineResult(
+                    file_path, None, None, None, None, NOT_DICOM, False
+                )
+            if _engine is not None and _rules is not None:
+                ocr_skipped = skip_reason(ds, _rules)
+            if _engine is not None and ocr_skipped is None:
+                ds = _redact(file_path, output_path, ds)
+            if _compiled is not None:
+                anonymize_dataset(ds, _compiled)
+                if SOP_INSTANCE_UID_TAG in ds:
+                    ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+            ds.save_as(output_path)
+            if key is not None:
+                _cache.put(key, output_path)
+            cached = False
+        else:
+            ds = dcmread(output_path, stop_before_pixels=True)
+            cached = True
+        return PipelineResult(
+            file_path,
+            output_path,
+            ds.get("PatientID", ""),
+            ds.get("StudyInstanceUID", ""),
+            ds.get("SeriesInstanceUID", ""),
+            None,
+            cached,
+            ocr_skipped,
+            parse_int(ds.get("InstanceNumber")),
+            ds.get("SOPInstanceUID", ""),
+        )
+    except Exception as e:
+        output_path.unlink(missing_ok=True)
+        return PipelineResult(
+            file_path, None, None, None, None, f"{type(e).__name__}: {e}", False
+        )
+
+
+def run_pipeline(
+    *,
+    input_dir: Path,
+    output_dir: Path,
+    anon_script: Path | None,
+    site_id: str,
+    pepper: str,
+    redact: bool,
+    paddle_ocr: bool,
+    hierarchical: bool,
+    order: OrganizeOrder = OrganizeOrder.discovery,
+    workers: int,
+    threads: int,
+    max_in_flight: int,
+    cache: FileCache | None = None,
+    index: "DicomIndex | None" = None,
+    prefilter: PrefilterRules | None = None,
+    analyzer: AnalyzerProfile = AnalyzerProfile.full,
+    paddle_backend: PaddleBackend | None = None,
+    max_side: int | None = None,
+) -> None:
+    """
+    Processes the DICOM files of the `input_dir` in a single pass using a pool of `workers`
+    processes: each file is redacted (if `redact` is True), anonymized using the native
+    engine (if an `anon_script` is given) and written to the `output_dir`.
+
+    If `hierarchical` is True (and the files are anonymized) the files are written to a
+    Patient / Study / Series folder structure using the anonymized UIDs. With the
+    "discovery" `order` the files of each series are numbered in the order of their input
+    paths, and with the "instance" order in the order of their InstanceNumber (and
+    SOPInstanceUID) once all of them have been processed (see `copy_and_organize`).
+    Otherwise their relative paths are kept.
+
+    At most `max_in_flight` files are being processed at any time, so that memory usage
+    is bounded regardless of the number of the input files.
+
+    If an `index` of the `input_dir` is given, only the DICOM files found in it are
+    processed.
+
+    If `prefilter` rules are given, the files that cannot contain burned-in text
+    according to them are not redacted (see `ocr_prefilter`).
+
+    The PII `analyzer` of the redaction (see `pii_analyzer`) is loaded before the
+    workers are forked, so that they share its memory. The `paddle_backend`, if
+    given, overrides the backend of the PaddleOCR configuration.
+
+    If `max_side` is given, the multi-frame images and the images larger than it are
+    redacted one frame at a time, as `perform_ocr` does. Without it, the multi-frame
+    images that are not skipped by the `prefilter` cannot be redacted and fail.
+    """
+    hierarchical = hierarchical and anon_script is not None
+    compiled = None
+    key_parts: tuple[str, ...] = ()
+    if anon_script is not None:
+        compiled = compile_with_params(anon_script, site_id, pepper)
+        key_parts += (pepper, site_id, DEFAULT_UIDROOT, file_hash(anon_script))
+    if redact:
+        key_parts += (ocr_config_fingerprint(paddle_ocr, analyzer, paddle_backend),)
+        if prefilter is not None:
+            key_parts += (cache_key("prefilter", repr(prefilter)),)
+        if max_side is not None:
+            key_parts += (cache_key("frames", str(max_side)),)
+
+    logger.info(f"Running single pass pipeline, output will be saved to {output_dir}")
+    # The files are written with a temporary name and then renamed to their final
+    # name when their position in the series is known:
+    tmp_dir = output_dir / f".lethe-{uuid4().hex}"
+
+    def input_files():
+        if index is not None:
+            yield from index.dicom_files()
+            return
+        for root, dirs, files in os.walk(os.fspath(input_dir)):
+            dirs.sort()
+            for file in sorted(files):
+                if not is_index_file(file):
+                    yield Path(root) / file
+
+    def tasks():
+        for path in input_files():
+            if hierarchical:
+                yield path, tmp_dir / f"{uuid4().hex}.dcm"
+            else:
+                yield path, output_dir / path.relative_to(input_dir)
+
+    series_counters: dict[Path, int] = {}
+    stats: Counter[str] = Counter()
+    # With the instance order, the placement of the files waits for all of them, so
+    # their identifiers are kept in a file instead of memory:
+    placements = None
+    if hierarchical and order == OrganizeOrder.instance:
+        tmp_dir.mkdir(parents=True, exist_ok=True)
+        placements = open(tmp_dir / "placements.jsonl", "w+")
+
+    def place(output_path: Path, patient_id: str, study_uid: str, series_uid: str):
+        series_dir = output_dir / patient_id / study_uid / series_uid
+        if series_dir not in series_counters:
+            series_dir.mkdir(parents=True, exist_ok=True)
+            series_counters[series_dir] = 1
+        number = series_counters[series_dir]
+        series_counters[series_dir] += 1
+        os.replace(output_path, series_dir / f"{number:05d}.dcm")
+
+    def placed_files():
+        placements.seek(0)
+        for line in placements:
+            path, *ids = json.loads(line)
+            yield DcmFileInfo(Path(path), *ids)
+
+    def finish(result: PipelineResult) -> None:
+        if result.error is not None:
+            logger.warning(f"Skipping file {result.path}: {result.error}")
+            stats["failed"] += 1
+            return
+        stats["processed"] += 1
+        stats["cached"] += result.cached
+        if result.ocr_skipped is not None:
+            stats[f"ocr_skipped:{result.ocr_skipped}"] += 1
+        if not hierarchical:
+            return
+        info = DcmFileInfo(
+            result.output_path,
+            result.patient_id,
+            result.study_uid,
+            result.series_uid,
+            result.instance_number,
+            result.sop_uid,
+        )
+        if placements is not None:
+            placements.write(json.dumps([os.fspath(info.path), *info[1:]]) + "\n")
+        else:
+            place(*info[:4])
+
+    time_start = time.time()
+    in_flight: deque[Future] = deque()
+    worker_threads = max(1, threads // workers)
+    if redact:
+        preload_analyzer(analyzer)
+    with ProcessPoolExecutor(
+        workers,
+        mp_context=multiprocessing.get_context("fork"),
+        initializer=_init_worker,
+        initargs=(
+            compiled,
+            redact,
+            paddle_ocr,
+            worker_threads,
+            cache,
+            key_parts,
+            prefilter,
+            analyzer,
+            paddle_backend,
+            max_side,
+        ),
+    ) as executor:
+        for task in tasks():
+            in_flight.append(executor.submit(_process_file, task))
+            # Results are handled in the input order, which also makes the numbering
+            # of the files in the hierarchical output deterministic
+            while len(in_flight) >= max_in_flight or (
+                in_flight and in_flight[0].done()
+            ):
+                finish(in_flight.popleft().result())
+        while in_flight:
+            finish(in_flight.popleft().result())
+    if placements is not None:
+        for info in instance_ordered(placed_files(), tmp_dir):
+            place(*info[:4])
+        placements.close()
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    logger.info(
+        f"Single pass pipeline completed, elapsed time: "
+        f"{time.time() - time_start:.3f} seconds, files processed: "
+        f"{stats['processed']} ({stats['cached']} from cache), "
+        f"files skipped: {stats['failed']}"
+    )
+    if redact and prefilter is not None:
+        skipped = {k.split(":", 1)[1]: n for k, n in stats.items() if ":" in k}
+        logger.info(
+            f"OCR pre-filter skipped the redaction of {sum(skipped.values())} file(s)"
+            + "".join(f", {rule}: {n}" for rule, n in sorted(skipped.items()))
+        )
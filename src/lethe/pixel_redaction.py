@@ -0,0 +1,395 @@
+"""
+Writing of redacted DICOM files that rewrites only the pixels that are redacted, instead of
+decoding the whole image, converting it and saving a new file (as the redactor engine does):
+
+- natively encoded (uncompressed) pixel data are redacted in place in a copy of the input
+  file: only the frames to redact are read, through NumPy views of their bytes in the native
+  layout (whatever the planar configuration), and written back
+- compressed pixel data keep their transfer syntax if it is lossless and can be encoded
+  (RLE lossless, and JPEG-LS or JPEG 2000 lossless for greyscale images if their pydicom
+  plugins are installed): only the frames to redact are decoded and re-encoded, the other
+  frames are copied as they are. Otherwise (e.g. lossy JPEG, or deflated and big endian
+  data) all the frames are re-encoded RLE lossless, as the redactor engine does
+- files in which nothing is redacted are copied byte for byte
+
+`redact_dataset` does the same for the datasets read in memory (see `pipeline`).
+"""
+
+import os
+import shutil
+import struct
+from collections.abc import Collection
+from pathlib import Path
+from typing import Callable
+
+import numpy as np
+from pydicom import Dataset, dcmread
+from pydicom.encaps import encapsulate, generate_frames, itemize_frame
+from pydicom.pixels import get_decoder, get_encoder, iter_pixels
+from pydicom.uid import (
+    ExplicitVRLittleEndian,
+    HTJ2KLossless,
+    HTJ2KLosslessRPCL,
+    JPEG2000Lossless,
+    JPEGLosslessSV1,
+    JPEGLSLossless,
+    RLELossless,
+)
+
+from .series_ocr import Box, contrast_value
+
+# The tags of the encapsulated pixel data and its items, as written in little endian
+_PIXEL_DATA_HEADER = struct.pack("<HH2sHI", 0x7FE0, 0x0010, b"OB", 0, 0xFFFFFFFF)
+_EMPTY_OFFSET_TABLE = struct.pack("<HHI", 0xFFFE, 0xE000, 0)
+_SEQUENCE_DELIMITER = struct.pack("<HHI", 0xFFFE, 0xE0DD, 0)
+
+_PIXEL_DATA_TAG = 0x7FE00010
+# The tags that describe the fragments of the original encapsulated pixel data
+_EXTENDED_OFFSET_TAGS = [0x7FE00001, 0x7FE00002]
+
+# The compressed transfer syntaxes whose frames can be re-encoded without loss
+LOSSLESS_SYNTAXES = {
+    RLELossless,
+    JPEGLSLossless,
+    JPEG2000Lossless,
+    JPEGLosslessSV1,
+    HTJ2KLossless,
+    HTJ2KLosslessRPCL,
+}
+
+# A function that fills (in place) the regions to redact of a frame, given its index,
+# returning whether it filled any
+Filler = Callable[[int, np.ndarray], bool]
+
+
+def frame_count(ds: Dataset) -> int:
+    return int(ds.get("NumberOfFrames", 1) or 1)
+
+
+def is_greyscale(ds: Dataset) -> bool:
+    return ds.get("PhotometricInterpretation") in ("MONOCHROME1", "MONOCHROME2")
+
+
+def fill_boxes(frame: np.ndarray, boxes: list[Box], greyscale: bool) -> bool:
+    """Fills the boxes of a frame with a value contrasting with its background"""
+    if not boxes:
+        return False
+    value = contrast_value(frame, greyscale)
+    for box in boxes:
+        frame[
+            box["top"] : box["top"] + box["height"],
+            box["left"] : box["left"] + box["width"],
+        ] = value
+    return True
+
+
+def fill_mask(frame: np.ndarray, mask: np.ndarray, greyscale: bool) -> bool:
+    """
+    Fills the pixels of a mask of a frame with a value contrasting with its background,
+    using a single vectorized assignment
+    """
+    if not mask.any():
+        return False
+    frame[mask] = contrast_value(frame, greyscale)
+    return True
+
+
+def _is_native(ds: Dataset) -> bool:
+    """Whether the pixel data of a dataset (in memory) can be viewed as they are"""
+    transfer_syntax = ds.file_meta.TransferSyntaxUID
+    return (
+        not transfer_syntax.is_compressed
+        and transfer_syntax.is_little_endian
+        and ds.get("BitsAllocated") in (8, 16, 32)
+        and not str(ds.get("PhotometricInterpretation", "")).endswith("422")
+    )
+
+
+def _can_patch(ds: Dataset) -> bool:
+    """Whether the pixel data of a dataset can be redacted in place in the file"""
+    return _is_native(ds) and not ds.file_meta.TransferSyntaxUID.is_deflated
+
+
+def _frame_size(ds: Dataset) -> int:
+    return ds.Rows * ds.Columns * ds.get("SamplesPerPixel", 1) * ds.BitsAllocated // 8
+
+
+def _frame_view(buffer: bytearray | memoryview, ds: Dataset) -> np.ndarray:
+    """
+    A (writable) view of the bytes of a natively encoded frame, as an array of
+    (rows, columns[, samples]) whatever its planar configuration
+    """
+    kind = "i" if ds.get("PixelRepresentation", 0) else "u"
+    pixels = np.frombuffer(buffer, np.dtype(f"<{kind}{ds.BitsAllocated // 8}"))
+    samples = ds.get("SamplesPerPixel", 1)
+    if samples == 1:
+        return pixels.reshape(ds.Rows, ds.Columns)
+    if ds.get("PlanarConfiguration", 0) == 1:
+        return pixels.reshape(samples, ds.Rows, ds.Columns).transpose(1, 2, 0)
+    return pixels.reshape(ds.Rows, ds.Columns, samples)
+
+
+def _patch_frames(
+    file_path: Path,
+    output_path: Path,
+    header: Dataset,
+    fill: Filler,
+    indices: Collection[int],
+) -> bool:
+    """Redacts the frames of natively encoded pixel data in a copy of the input file"""
+    # The element is kept deferred, so that its value (the pixels) is not read
+    element = dcmread(file_path, defer_size=1024).get_item(
+        "PixelData", keep_deferred=True
+    )
+    frame_size = _frame_size(header)
+    offset = getattr(element, "value_tell", None)
+    if offset is None or element.length < frame_count(header) * frame_size:
+        raise ValueError(f"Unexpected size of the pixel data of {file_path}")
+    shutil.copyfile(file_path, output_path)
+    redacted = False
+    with open(output_path, "r+b") as f:
+        for index in indices:
+            f.seek(offset + index * frame_size)
+            buffer = bytearray(f.read(frame_size))
+            if fill(index, _frame_view(buffer, header)):
+                f.seek(offset + index * frame_size)
+                f.write(buffer)
+                redacted = True
+    return redacted
+
+
+def _image_options(header: Dataset) -> dict:
+    """The description of a frame of the image of a dataset, for its encoder"""
+    return {
+        "rows": header.Rows,
+        "columns": header.Columns,
+        "samples_per_pixel": header.get("SamplesPerPixel", 1),
+        "bits_allocated": header.BitsAllocated,
+        "bits_stored": header.BitsStored,
+        "pixel_representation": header.PixelRepresentation,
+        "photometric_interpretation": str(header.PhotometricInterpretation),
+        "number_of_frames": 1,
+        "planar_configuration": 0,
+    }
+
+
+def _lossless_encoder(header: Dataset):
+    """
+    The encoder of the (lossless) transfer syntax of compressed pixel data, if its frames
+    can be re-encoded in it, None otherwise. The JPEG encoders are only used for greyscale
+    images, since they may transform the colors of the others (e.g. to YBR_RCT).
+    """
+    transfer_syntax = header.file_meta.TransferSyntaxUID
+    if transfer_syntax not in LOSSLESS_SYNTAXES:
+        return None
+    if transfer_syntax != RLELossless and header.get("SamplesPerPixel", 1) != 1:
+        return None
+    try:
+        encoder = get_encoder(transfer_syntax)
+    except NotImplementedError:
+        return None
+    return encoder if encoder.is_available else None
+
+
+def _extended_offsets(header: Dataset) -> tuple | None:
+    if all(tag in header for tag in _EXTENDED_OFFSET_TAGS):
+        return header.ExtendedOffsetTable, header.ExtendedOffsetTableLengths
+    return None
+
+
+def _write_encapsulated_header(f, header: Dataset) -> None:
+    """
+    Writes the header (without the pixels, and the tables of the original fragments)
+    of a file with encapsulated pixel data, and the start of its pixel data
+    """
+    for tag in [
+        t for t in header.keys() if t in _EXTENDED_OFFSET_TAGS or t >= _PIXEL_DATA_TAG
+    ]:
+        del header[tag]
+    header.save_as(f, enforce_file_format=True)
+    f.write(_PIXEL_DATA_HEADER + _EMPTY_OFFSET_TABLE)
+
+
+def _replace_frames(
+    file_path: Path,
+    output_path: Path,
+    header: Dataset,
+    fill: Filler,
+    indices: Collection[int],
+    encoder,
+) -> bool:
+    """
+    Redacts the frames of compressed pixel data, re-encoding only the frames redacted
+    in the same transfer syntax, and copying the (encoded) others
+    """
+    element = dcmread(file_path, defer_size=1024).get_item(
+        "PixelData", keep_deferred=True
+    )
+    extended_offsets = _extended_offsets(header)
+    options = _image_options(header)
+    selected = set(indices)
+    # The frames to redact, decoded in order
+    frames = iter_pixels(file_path, indices=sorted(selected), raw=True)
+    redacted = False
+    with open(file_path, "rb") as src, open(output_path, "wb") as f:
+        _write_encapsulated_header(f, header)
+        src.seek(element.value_tell)
+        for index, data in enumerate(
+            generate_frames(
+                src,
+                number_of_frames=frame_count(header),
+                extended_offsets=extended_offsets,
+            )
+        ):
+            if index in selected:
+                frame = next(frames)
+                if not frame.flags.writeable:
+                    frame = frame.copy()
+                if fill(index, frame):
+                    data = encoder.encode(frame, **options)
+                    redacted = True
+            for item in itemize_frame(data):
+                f.write(item)
+        f.write(_SEQUENCE_DELIMITER)
+    return redacted
+
+
+def _reencode_frames(
+    file_path: Path,
+    output_path: Path,
+    header: Dataset,
+    fill: Filler,
+    indices: Collection[int],
+) -> bool:
+    """Redacts and re-encodes (RLE lossless) all the frames of the pixel data"""
+    transfer_syntax = header.file_meta.TransferSyntaxUID
+    if str(header.PhotometricInterpretation).startswith("YBR"):
+        # The frames are decoded as RGB
+        header.PhotometricInterpretation = "RGB"
+    if header.get("SamplesPerPixel", 1) > 1:
+        header.PlanarConfiguration = 1
+    header.file_meta.TransferSyntaxUID = RLELossless
+    encoder = get_encoder(RLELossless)
+    options = _image_options(header)
+    selected = set(indices)
+    # The pixels can only be read lazily from the file if it is not deflated
+    src = dcmread(file_path) if transfer_syntax.is_deflated else file_path
+    redacted = False
+    with open(output_path, "wb") as f:
+        _write_encapsulated_header(f, header)
+        for index, frame in enumerate(iter_pixels(src)):
+            if index in selected:
+                if not frame.flags.writeable:
+                    frame = frame.copy()
+                redacted |= fill(index, frame)
+            for item in itemize_frame(encoder.encode(frame, **options)):
+                f.write(item)
+        f.write(_SEQUENCE_DELIMITER)
+    return redacted
+
+
+def write_redacted(
+    file_path: Path,
+    output_path: Path,
+    header: Dataset,
+    fill: Filler,
+    indices: Collection[int] | None = None,
+) -> bool:
+    """
+    Writes to `output_path` the DICOM file `file_path` whose frames (of the `indices`,
+    all if None) are redacted by `fill`, given its `header` (or dataset, whose pixels
+    are then dropped if the header has to be written). The frames are passed to `fill`
+    as stored, unless all the frames have to be re-encoded RLE lossless, in which case
+    they are decoded as by default and the `header` is updated to describe them.
+    Returns True if anything was redacted, the output file being an exact copy of the
+    input file otherwise.
+    """
+    if indices is None:
+        indices = range(frame_count(header))
+    tmp_path = output_path.with_name(f".{output_path.name}.tmp")
+    try:
+        if _can_patch(header):
+            redacted = _patch_frames(file_path, tmp_path, header, fill, indices)
+        elif (encoder := _lossless_encoder(header)) is not None:
+            redacted = _replace_frames(
+                file_path, tmp_path, header, fill, indices, encoder
+            )
+        else:
+            redacted = _reencode_frames(file_path, tmp_path, header, fill, indices)
+        if redacted:
+            os.replace(tmp_path, output_path)
+        else:
+            shutil.copyfile(file_path, output_path)
+        return redacted
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+
+def redact_dataset(
+    ds: Dataset, fill: Filler, indices: Collection[int] | None = None
+) -> bool:
+    """
+    Redacts (in place) the frames (of the `indices`, all if None) of a dataset read in
+    memory with `fill`, as `write_redacted` does for files: natively encoded frames are
+    filled in a copy of the pixel data, compressed frames are re-encoded in the same
+    (lossless) transfer syntax. Otherwise the pixel data are decoded, redacted and
+    compressed again (RLE lossless) if they were compressed. Returns True if anything
+    was redacted, the dataset being unchanged otherwise.
+    """
+    if indices is None:
+        indices = range(frame_count(ds))
+    redacted = False
+    if _is_native(ds):
+        frame_size = _frame_size(ds)
+        buffer = bytearray(ds.PixelData)
+        for index in indices:
+            view = memoryview(buffer)[index * frame_size : (index + 1) * frame_size]
+            redacted |= fill(index, _frame_view(view, ds))
+        if redacted:
+            ds.PixelData = bytes(buffer)
+        return redacted
+    if (encoder := _lossless_encoder(ds)) is not None:
+        frames = list(
+            generate_frames(
+                ds.PixelData,
+                number_of_frames=frame_count(ds),
+                extended_offsets=_extended_offsets(ds),
+            )
+        )
+        decoder = get_decoder(ds.file_meta.TransferSyntaxUID)
+        options = _image_options(ds)
+        for index in indices:
+            frame, _ = decoder.as_array(ds, index=index, raw=True)
+            if not frame.flags.writeable:
+                frame = frame.copy()
+            if fill(index, frame):
+                frames[index] = encoder.encode(frame, **options)
+                redacted = True
+        if redacted:
+            for tag in _EXTENDED_OFFSET_TAGS:
+                if tag in ds:
+                    del ds[tag]
+            ds.PixelData = encapsulate(frames)
+        return redacted
+    pixels = ds.pixel_array
+    if frame_count(ds) == 1:
+        pixels = pixels[None]
+    if not pixels.flags.writeable:
+        pixels = pixels.copy()
+    for index in indices:
+        redacted |= fill(index, pixels[index])
+    if not redacted:
+        return False
+    compressed = ds.file_meta.TransferSyntaxUID.is_compressed
+    # Written natively encoded first (e.g. the data of a big endian transfer syntax)
+    ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds.PixelData = pixels.astype(pixels.dtype.newbyteorder("<"), copy=False).tobytes()
+    if str(ds.get("PhotometricInterpretation", "")).startswith("YBR"):
+        # The pixel array has been converted to RGB
+        ds.PhotometricInterpretation = "RGB"
+    if ds.get("SamplesPerPixel", 1) > 1:
+        # The pixel array is always color-by-pixel
+        ds.PlanarConfiguration = 0
+    if compressed:
+        ds.compress(RLELossless, generate_instance_uid=False)
+    return True
@@ -0,0 +1,151 @@
+"""
+Helpers for the "series" mode of the OCR: in a series of slices (e.g. CT or MR) the
+burned-in text is usually at the same place in every slice, so the text regions are
+detected (OCR) in a few sample slices and, if the samples agree (and have some text),
+the union of their regions is redacted in all the slices of the series without running
+the OCR on them.
+"""
+
+import math
+from pathlib import Path
+from typing import Iterable
+
+import numpy as np
+from pydicom import Dataset
+
+from .dicom_utils import DcmFileInfo
+
+# The part of the image (its corners) that is used to find the background value,
+# as in Presidio's DicomImageRedactorEngine
+CROP_RATIO = 0.75
+# The minimum overlap (intersection over union) of two boxes in different samples
+# to be considered the same text region
+MIN_BOX_IOU = 0.5
+# The regions are enlarged by these fractions of their height (horizontally and
+# vertically), since the text of the slices that are not sampled may be a bit
+# longer, e.g. a slice number with more digits
+BOX_MARGIN_X = 0.5
+BOX_MARGIN_Y = 0.1
+
+# A bounding box as returned by Presidio: {"left", "top", "width", "height"}
+Box = dict[str, int]
+
+
+def group_series(
+    file_infos: Iterable[DcmFileInfo],
+) -> dict[tuple[str, str, str], list[Path]]:
+    """
+    Groups the files by series, each one sorted by InstanceNumber (files without one
+    are placed last), SOPInstanceUID and path
+    """
+    series: dict[tuple[str, str, str], list[DcmFileInfo]] = {}
+    for info in file_infos:
+        key = (info.patient_id, info.study_uid, info.series_uid)
+        series.setdefault(key, []).append(info)
+    return {
+        key: [
+            info.path
+            for info in sorted(
+                infos,
+                key=lambda i: (
+                    i.instance_number is None,
+                    i.instance_number or 0,
+                    i.sop_uid or "",
+                    str(i.path),
+                ),
+            )
+        ]
+        for key, infos in series.items()
+    }
+
+
+def sample_indices(count: int, samples: int) -> list[int]:
+    """The indices of `samples` slices evenly spread in a series of `count` slices"""
+    if samples <= 1:
+        return [count // 2]
+    return sorted({round(i * (count - 1) / (samples - 1)) for i in range(samples)})
+
+
+def image_geometry(ds: Dataset) -> tuple:
+    """The dimensions of the image of a dataset, which must match in all the slices"""
+    return (
+        ds.get("Rows"),
+        ds.get("Columns"),
+        ds.get("SamplesPerPixel", 1),
+        int(ds.get("NumberOfFrames", 1) or 1),
+    )
+
+
+def _iou(a: Box, b: Box) -> float:
+    w = min(a["left"] + a["width"], b["left"] + b["width"]) - max(a["left"], b["left"])
+    h = min(a["top"] + a["height"], b["top"] + b["height"]) - max(a["top"], b["top"])
+    if w <= 0 or h <= 0:
+        return 0.0
+    intersection = w * h
+    union = a["width"] * a["height"] + b["width"] * b["height"] - intersection
+    return intersection / union
+
+
+def boxes_agree(samples: list[list[Box]], min_iou: float = MIN_BOX_IOU) -> bool:
+    """
+    Checks that the text regions found in each sample match (overlap by at least
+    `min_iou`) the regions found in the first sample, and vice versa
+    """
+    first = samples[0]
+    for boxes in samples[1:]:
+        if not all(any(_iou(a, b) >= min_iou for b in first) for a in boxes):
+            return False
+        if not all(any(_iou(a, b) >= min_iou for b in boxes) for a in first):
+            return False
+    return True
+
+
+def region_mask(samples: list[list[Box]], rows: int, columns: int) -> np.ndarray:
+    """The mask of the union of the (enlarged) text regions of all the samples"""
+    mask = np.zeros((rows, columns), dtype=bool)
+    for boxes in samples:
+        for box in boxes:
+            dx = math.ceil(box["height"] * BOX_MARGIN_X)
+            dy = math.ceil(box["height"] * BOX_MARGIN_Y)
+            top = max(0, box["top"] - dy)
+            left = max(0, box["left"] - dx)
+            mask[
+                top : box["top"] + box["height"] + dy,
+                left : box["left"] + box["width"] + dx,
+            ] = True
+    return mask
+
+
+def contrast_value(pixels: np.ndarray, greyscale: bool):
+    """
+    The value of the redaction boxes, contrasting with the background (the most
+    common value in the corners of the image), as Presidio's "contrast" fill
+    """
+    rows, columns = pixels.shape[:2]
+    h = int(rows * CROP_RATIO / 2)
+    w = int(columns * CROP_RATIO / 2)
+    corners = np.concatenate(
+        [
+            c.reshape(-1, *pixels.shape[2:])
+            for c in (
+                pixels[:h, :w],
+                pixels[:h, columns - w :],
+                pixels[rows - h :, :w],
+                pixels[rows - h :, columns - w :],
+            )
+        ]
+    )
+    if greyscale:
+        values, counts = np.unique(corners, return_counts=True)
+        top = corners.max()
+    else:
+        values, counts = np.unique(corners, axis=0, return_counts=True)
+        top = corners.max(axis=0)
+    # Computed in a wider type, since the difference may not fit in the type of the
+    # pixels (e.g. signed 16 bit pixels with a large range)
+    wide = np.int64 if np.issubdtype(pixels.dtype, np.integer) else np.float64
+    value = np.asarray(top, dtype=wide) - np.asarray(values[np.argmax(counts)], wide)
+    if np.issubdtype(pixels.dtype, np.integer):
+        info = np.iinfo(pixels.dtype)
+        value = np.clip(value, info.min, info.max)
+    return value.astype(pixels.dtype)
@@ -0,0 +1,105 @@
+"""
+An adapter for using Tesseract OCR through its C++ API (tesserocr) as the underlying OCR of
+Presidio, instead of pytesseract that runs a `tesseract` process, and writes the image to a
+temporary file, for each image.
+
+The API (and the loaded language model) is kept for the lifetime of the process, the pixels
+of the images are passed as they are (without encoding them), and the text is recognized
+only in the text lines found by the layout analysis of Tesseract, so that images without
+text (e.g. most of the slices of a CT series) cost only the layout analysis.
+"""
+
+import numpy as np
+from PIL import Image
+from presidio_image_redactor import OCR
+from tesserocr import PSM, RIL, PyTessBaseAPI, iterate_level
+
+DEFAULT_LANGUAGE = "eng"
+# The boxes of the text lines found by the layout analysis are tight, so they are
+# enlarged by this fraction of their height (and at least `MIN_LINE_MARGIN` pixels)
+# before the recognition, which otherwise misreads the characters at their edges
+LINE_MARGIN = 0.5
+MIN_LINE_MARGIN = 4
+
+
+def _to_array(image: Image.Image | np.ndarray) -> np.ndarray:
+    if isinstance(image, Image.Image):
+        if image.mode not in ("L", "RGB"):
+            image = image.convert("RGB")
+        image = np.asarray(image)
+    if image.dtype != np.uint8:
+        image = image.astype(np.uint8)
+    return np.ascontiguousarray(image)
+
+
+class PresidioTesserOCR(OCR):
+    """OCR class that performs OCR on a given image, using a persistent Tesseract API."""
+
+    def __init__(self, language: str = DEFAULT_LANGUAGE):
+        self.api_ = PyTessBaseAPI(lang=language, psm=PSM.AUTO)
+
+    def _set_image(self, image: str | Image.Image | np.ndarray) -> tuple[int, int]:
+        """Sets the image to OCR, returning its width and height"""
+        if isinstance(image, str):
+            self.api_.SetImageFile(image)
+            with Image.open(image) as img:
+                return img.size
+        data = _to_array(image)
+        height, width = data.shape[:2]
+        channels = data.shape[2] if data.ndim == 3 else 1
+        self.api_.SetImageBytes(
+            data.tobytes(), width, height, channels, width * channels
+        )
+        return width, height
+
+    def perform_ocr(self, image: object, **kwargs) -> dict:
+        """Perform OCR on a given image.
+
+        :param image: PIL Image/numpy array or file path(str) to be processed
+        :param kwargs: Ignored (the options of pytesseract do not apply)
+
+        :return: results dictionary containing bboxes and text for each detected word
+        """
+        result: dict[str, list] = {
+            "left": [],
+            "top": [],
+            "width": [],
+            "height": [],
+            "text": [],
+            "conf": [],
+        }
+        self.api_.SetPageSegMode(PSM.AUTO)
+        width, height = self._set_image(image)
+        # The layout analysis only, without recognition
+        lines = self.api_.GetComponentImages(RIL.TEXTLINE, True)
+        if not lines:
+            return result
+        # Each line is recognized as a block of text, since the boxes of the lines
+        # found may contain more than one line of small text
+        self.api_.SetPageSegMode(PSM.SINGLE_BLOCK)
+        for _, box, _, _ in lines:
+            margin = max(MIN_LINE_MARGIN, int(box["h"] * LINE_MARGIN))
+            left = max(0, box["x"] - margin)
+            top = max(0, box["y"] - margin)
+            right = min(width, box["x"] + box["w"] + margin)
+            bottom = min(height, box["y"] + box["h"] + margin)
+            self.api_.SetRectangle(left, top, right - left, bottom - top)
+            self.api_.Recognize()
+            for word in iterate_level(self.api_.GetIterator(), RIL.WORD):
+                try:
+                    text = word.GetUTF8Text(RIL.WORD)
+                except RuntimeError:
+                    # No text recognized in this part of the line
+                    continue
+                # In the coordinates of the whole image
+                bounding_box = word.BoundingBox(RIL.WORD)
+                if not text.strip() or bounding_box is None:
+                    continue
+                x1, y1, x2, y2 = bounding_box
+                result["left"].append(x1)
+                result["top"].append(y1)
+                result["width"].append(x2 - x1)
+                result["height"].append(y2 - y1)
+                result["text"].append(text)
+                result["conf"].append(word.Confidence(RIL.WORD))
+        return result
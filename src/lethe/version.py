@@ -1,3 +1,9 @@
-from importlib.metadata import version
+def __getattr__(name: str) -> str:
+    # The version is looked up when it is first used, since `importlib.metadata` is
+    # slow to import and most CLI commands (e.g. `utils secret`) do not need it
+    if name == "__version__":
+        from importlib.metadata import version
 
-__version__ = version("lethe")
+        globals()["__version__"] = version("lethe")
+        return globals()["__version__"]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,33 @@
+import warnings
+
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian
+
+from lethe.dicom_utils import HEADER_PREFIX_SIZE, read_header
+
+SERIES_UID = "1.2.826.0.1.3680043.8.498.12345678901234567890123456"
+
+
+def _write(path, padding: int) -> None:
+    ds = Dataset()
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds.file_meta.MediaStorageSOPClassUID = "1.2.840.10008.5.1.4.1.1.7"
+    ds.file_meta.MediaStorageSOPInstanceUID = "1.2.3.4"
+    ds.PatientID = "12345"
+    ds.StudyInstanceUID = "1.2.3"
+    # Long enough to push the SeriesInstanceUID to the end of the header prefix
+    ds.StudyDescription = "x" * padding
+    ds.SeriesInstanceUID = SERIES_UID
+    ds.add_new(0x7FE00010, "OB", bytes(2 * HEADER_PREFIX_SIZE))
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        ds.save_as(path, enforce_file_format=True)
+
+
+def test_values_cut_off_by_the_prefix_are_read_whole(tmp_path):
+    path = tmp_path / "file.dcm"
+    for padding in range(HEADER_PREFIX_SIZE - 500, HEADER_PREFIX_SIZE - 350, 2):
+        _write(path, padding)
+        ds = read_header(path, ["PatientID", "StudyInstanceUID", "SeriesInstanceUID"])
+        assert ds.SeriesInstanceUID == SERIES_UID
@@ -0,0 +1,63 @@
+import shutil
+import warnings
+from pathlib import Path
+
+import pytest
+from pydicom import Dataset, dcmread
+from pydicom.dataset import FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian
+
+from lethe.dcm_deidentify import run_ctp
+from lethe.native_deidentify import anonymize_dataset, compile_with_params, run_native
+
+ANON_SCRIPT = Path(__file__).parents[1] / "ctp" / "anon.script"
+SECRET_KEY = "0190c0a5d2a67c5b9a0bd6e6e1b4f1d2a"
+
+
+def _dataset() -> Dataset:
+    ds = Dataset()
+    ds.PatientID = "12345"
+    ds.PatientName = "Doe^John"
+    ds.StudyInstanceUID = "1.2.3"
+    ds.SeriesInstanceUID = "1.2.3.1"
+    ds.SOPClassUID = "1.2.840.10008.5.1.4.1.1.7"
+    ds.SOPInstanceUID = "1.2.3.4"
+    ref = Dataset()
+    ref.ReferencedSOPClassUID = "1.2.840.10008.5.1.4.1.1.7"
+    ref.ReferencedSOPInstanceUID = "1.2.3.9"
+    ds.ReferencedImageSequence = [ref]
+    return ds
+
+
+def test_kept_sequences_are_copied_as_is():
+    # As in CTP, only the items of `@process()` sequences are anonymized
+    compiled = compile_with_params(ANON_SCRIPT, "SITE", SECRET_KEY)
+    ds = _dataset()
+    anonymize_dataset(ds, compiled)
+
+    assert ds.PatientID != "12345"
+    assert ds.ReferencedImageSequence == _dataset().ReferencedImageSequence
+
+
+@pytest.mark.skipif(shutil.which("java") is None, reason="CTP needs Java")
+def test_native_engine_matches_ctp(tmp_path):
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    ds = _dataset()
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        ds.save_as(input_dir / "file.dcm", enforce_file_format=True)
+
+    options = dict(
+        anon_script=ANON_SCRIPT, site_id="SITE", pepper=SECRET_KEY, threads=1
+    )
+    run_ctp(input_dir=input_dir, output_dir=tmp_path / "ctp", **options)
+    run_native(input_dir=input_dir, output_dir=tmp_path / "native", **options)
+
+    ctp = dcmread(tmp_path / "ctp" / "file.dcm")
+    native = dcmread(tmp_path / "native" / "file.dcm")
+    for keyword in ("PatientID", "StudyInstanceUID", "SOPInstanceUID"):
+        assert native[keyword].value == ctp[keyword].value
+    assert native.ReferencedImageSequence == ctp.ReferencedImageSequence